@@ -40,6 +40,7 @@ def get_client_manager(backup_args):
         auth_url=options.pop('auth_url', None),
         auth_method=options.pop('auth_method', 'password'),
         dry_run=backup_args.get('dry_run', None),
+        auth_cache_dir=backup_args.get('auth_cache_dir', None),
         **options
     )
     return client_manager
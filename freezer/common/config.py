@@ -58,6 +58,12 @@ DEFAULT_PARAMS = {
     'backup_name': None, 'quiet': False,
     'container': 'freezer_backups', 'no_incremental': None,
     'max_segment_size': 33554432, 'lvm_srcvol': None,
+    'rsync_workers': 1, 'compress_workers': 1, 'frame_size': 0,
+    'restore_prefetch': 0,
+    'restore_spool_size': 0, 'swift_upload_workers': 1,
+    'swift_download_workers': 1, 'swift_read_ahead': 134217728,
+    'swift_slo': False, 'auth_cache_dir': None, 'metadata_cache_dir': None,
+    'journal_dir': None, 'remove_workers': 8,
     'download_limit': -1, 'hostname': None, 'remove_from_date': None,
     'restart_always_level': False, 'lvm_dirmount': None,
     'dereference_symlink': None,
@@ -76,6 +82,8 @@ DEFAULT_PARAMS = {
     'windows_volume': '', 'command': None, 'metadata_out': None,
     'storage': 'swift', 'ssh_key': '', 'ssh_username': '', 'ssh_host': '',
     'ssh_port': DEFAULT_SSH_PORT, 'compression': 'gzip',
+    'compression_level': None, 'min_compression_level': None,
+    'adaptive_compression': False, 'compression_dictionary': False,
     'overwrite': False, 'incremental': None,
     'consistency_check': False, 'consistency_checksum': None,
     'nova_restore_network': None, 'cindernative_backup_id': None,
@@ -230,6 +238,14 @@ _COMMON = [
                     "than the provided datetime in the form "
                     "'YYYY-MM-DDThh:mm:ss' i.e. '1974-03-25T23:23:23'. "
                     "Make sure the 'T' is between date and time "),
+    cfg.IntOpt('remove-workers',
+               dest='remove_workers',
+               default=DEFAULT_PARAMS['remove_workers'],
+               help="Number of files, or of Swift delete requests, removed "
+                    "at the same time when removing old backups. Swift uses "
+                    "bulk delete requests if the cluster supports them. "
+                    "Default 8."
+               ),
     cfg.StrOpt('no-incremental',
                dest='no_incremental',
                default=DEFAULT_PARAMS['no_incremental'],
@@ -290,6 +306,114 @@ _COMMON = [
                help="Set the maximum file chunk size in bytes to upload to "
                     "swift Default 33554432 bytes (32MB)"
                ),
+    cfg.IntOpt('swift-upload-workers',
+               dest='swift_upload_workers',
+               default=DEFAULT_PARAMS['swift_upload_workers'],
+               help="Number of segments uploaded at the same time to Swift. "
+                    "Each upload holds a segment of max-segment-size bytes "
+                    "in memory, i.e. 128MB with 4 workers and the default "
+                    "segment size. Default 1, the segments are uploaded one "
+                    "after the other."
+               ),
+    cfg.IntOpt('swift-download-workers',
+               dest='swift_download_workers',
+               default=DEFAULT_PARAMS['swift_download_workers'],
+               help="Number of segments downloaded at the same time from "
+                    "Swift during a restore, holding up to --swift-read-ahead "
+                    "bytes in memory. Default 1, the backup is read with a "
+                    "single request."
+               ),
+    cfg.IntOpt('swift-read-ahead',
+               dest='swift_read_ahead',
+               default=DEFAULT_PARAMS['swift_read_ahead'],
+               help="Bytes of segments downloaded from Swift ahead of the "
+                    "restore, and held in memory, with more than one "
+                    "--swift-download-workers. At least one segment is "
+                    "downloaded. Default 134217728 (128MB)."
+               ),
+    cfg.BoolOpt('swift-slo',
+                dest='swift_slo',
+                default=DEFAULT_PARAMS['swift_slo'],
+                help="Upload Static Large Object manifests listing the "
+                     "segments with their etags, instead of Dynamic Large "
+                     "Object manifests relying on the container listings. "
+                     "The restores read the segments from the manifest and "
+                     "check them against their etags. The segments of the "
+                     "backups above the max_manifest_segments of the "
+                     "cluster (1000 by default) are listed by nested Static "
+                     "Large Object manifests, checked as well. "
+                     "Default False."
+                ),
+    cfg.IntOpt('rsync-workers',
+               dest='rsync_workers',
+               default=DEFAULT_PARAMS['rsync_workers'],
+               help="Number of processes computing the file signatures and "
+                    "deltas on backup, and of threads writing the files on "
+                    "restore, with the rsync engine. The backup stream keeps "
+                    "the order of a single process. Default 1."
+               ),
+    cfg.IntOpt('compress-workers',
+               dest='compress_workers',
+               default=DEFAULT_PARAMS['compress_workers'],
+               help="Number of threads compressing the backup stream of the "
+                    "rsync engine. With more than one, the stream is "
+                    "compressed by blocks of 4MB, each one compressed "
+                    "separately, and the encryption follows in order on a "
+                    "single thread. The threads use several cores only "
+                    "with compression modules releasing the GIL while they "
+                    "compress, as zlib, bz2, lzma and lz4 do. A framed "
+                    "stream, see --frame-size, is encrypted on the threads "
+                    "as well. A zstd stream is compressed on the threads of "
+                    "the zstd compressor instead, as is the stream of the "
+                    "zstd and xz programs with the tar engine. The frames of "
+                    "a framed stream are decoded on as many threads on "
+                    "restore. Default 1."
+               ),
+    cfg.IntOpt('frame-size',
+               dest='frame_size',
+               default=DEFAULT_PARAMS['frame_size'],
+               help="Size in bytes of the data of each frame of a framed "
+                    "backup stream with the rsync engine, i.e. 4194304. The "
+                    "frames are compressed and encrypted independently, on "
+                    "--compress-workers threads, and decoded in parallel on "
+                    "restore. Default 0, a continuous stream."
+               ),
+    cfg.IntOpt('restore-prefetch',
+               dest='restore_prefetch',
+               default=DEFAULT_PARAMS['restore_prefetch'],
+               help="Number of backup levels downloaded while a level is "
+                    "restored, each one holding up to --restore-spool-size "
+                    "bytes in memory. Default 0, each level is downloaded "
+                    "when its restore starts."
+               ),
+    cfg.IntOpt('restore-spool-size',
+               dest='restore_spool_size',
+               default=DEFAULT_PARAMS['restore_spool_size'],
+               help="Size of the shared memory buffers carrying the backup "
+                    "levels from the download processes to the restore "
+                    "process, one for the level restored and one for each "
+                    "prefetched level, i.e. 134217728 (128MB). Default 0, "
+                    "two messages of --max-segment-size bytes, the least "
+                    "the restore needs."
+               ),
+    cfg.StrOpt('metadata-cache-dir',
+               dest='metadata_cache_dir',
+               default=DEFAULT_PARAMS['metadata_cache_dir'],
+               help="Directory of a local cache of the engine metadata of "
+                    "the backups, i.e. /var/cache/freezer. An incremental "
+                    "backup reads the metadata of the previous backup from "
+                    "the cache if it matches the stored one, instead of "
+                    "downloading it. Disabled by default."
+               ),
+    cfg.StrOpt('journal-dir',
+               dest='journal_dir',
+               default=DEFAULT_PARAMS['journal_dir'],
+               help="Directory of the checkpoint journals of the backups in "
+                    "progress, i.e. /var/lib/freezer/journal. A backup which "
+                    "failed after a checkpoint is resumed by the next run, "
+                    "keeping the segments already stored. Disabled by "
+                    "default."
+               ),
     cfg.StrOpt('restore-abs-path',
                dest='restore_abs_path',
                default=DEFAULT_PARAMS['restore_abs_path'],
@@ -327,6 +451,16 @@ _COMMON = [
                 dest='quiet',
                 help="Suppress error messages"
                 ),
+    cfg.StrOpt('auth-cache-dir',
+               dest='auth_cache_dir',
+               default=DEFAULT_PARAMS['auth_cache_dir'],
+               help="Directory of a cache of the Keystone tokens and service "
+                    "catalogs, shared by the freezer-agent processes so that "
+                    "they do not authenticate again until the token "
+                    "expires. The cached tokens are only readable by their "
+                    "owner, and a directory accessible by other users is "
+                    "not used. Disabled by default."
+               ),
     cfg.BoolOpt('insecure',
                 dest='insecure',
                 default=DEFAULT_PARAMS['insecure'],
@@ -395,9 +529,54 @@ _COMMON = [
     cfg.StrOpt('compression',
                dest='compression',
                default=DEFAULT_PARAMS['compression'],
-               choices=['gzip', 'bzip2', 'xz'],
-               help="Compression algorithm to use. Gzip is default algorithm"
+               choices=['gzip', 'bzip2', 'xz', 'zstd', 'lz4'],
+               help="Compression algorithm to use. Gzip is default "
+                    "algorithm. xz on Python 2, zstd and lz4 need the "
+                    "backports.lzma, zstandard and lz4 modules with the "
+                    "rsync engine, and their programs with the tar engine. "
+                    "The algorithm of each backup is recorded in its "
+                    "metadata and used to restore it."
                ),
+    cfg.IntOpt('compression-level',
+               dest='compression_level',
+               default=DEFAULT_PARAMS['compression_level'],
+               help="Compression level of the backups, from 0 or 1 to 9 "
+                    "with gzip, bzip2 and xz, 1 to 22 with zstd and 0 to 16 "
+                    "with lz4. Default: 9 with gzip and bzip2, the default "
+                    "level of the algorithm otherwise. With zstd, the "
+                    "stream of the rsync engine and the zstd program of the "
+                    "tar engine compress on --compress-workers threads."
+               ),
+    cfg.IntOpt('min-compression-level',
+               dest='min_compression_level',
+               default=DEFAULT_PARAMS['min_compression_level'],
+               help="Lowest compression level of the rsync engine. When the "
+                    "backup stream waits for the compression of its blocks, "
+                    "the level of the next blocks is lowered, down to this "
+                    "level, and raised back once the blocks are compressed "
+                    "in time. Needs more than one --compress-workers or a "
+                    "framed stream. Default: the level is not lowered."
+               ),
+    cfg.BoolOpt('adaptive-compression',
+                dest='adaptive_compression',
+                default=DEFAULT_PARAMS['adaptive_compression'],
+                help="Store raw the frames of the backup stream of the rsync "
+                     "engine which do not compress, such as compressed "
+                     "files, as estimated from samples of their data. The "
+                     "stream is framed, by frames of --frame-size or 4MB. "
+                     "The size of the data stored raw and compressed is "
+                     "recorded in the backup metadata."
+                ),
+    cfg.BoolOpt('compression-dictionary',
+                dest='compression_dictionary',
+                default=DEFAULT_PARAMS['compression_dictionary'],
+                help="Compress the backup stream of the rsync engine with a "
+                     "zstd dictionary, trained by each level zero backup on "
+                     "the file headers and small files of the tree and used "
+                     "by the increments of its chain. Best with small "
+                     "frames, see --frame-size, as each frame is compressed "
+                     "with the dictionary. Needs --compression zstd."
+                ),
     cfg.StrOpt('storage',
                dest='storage',
                default=DEFAULT_PARAMS['storage'],
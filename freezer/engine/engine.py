@@ -16,25 +16,39 @@ limitations under the License.
 """
 
 import abc
+import hashlib
 import json
 import multiprocessing
 from multiprocessing import queues
+import os
 import shutil
 import tempfile
-import time
 
 from oslo_log import log
 import six
 # PyCharm will not recognize queue. Puts red squiggle line under it. That's OK.
 from six.moves import queue
 
+from freezer.engine import journal as backup_journal
+from freezer.engine import metadata_cache
 from freezer.exceptions import engine as engine_exceptions
 from freezer.storage import base
+from freezer.storage import physical
+from freezer.utils import ringbuffer
 from freezer.utils import streaming
 from freezer.utils import utils
 
 LOG = log.getLogger(__name__)
 
+# Number of levels downloaded while a level is restored
+RESTORE_PREFETCH = 0
+# Number of bytes of each stream downloaded ahead of its restore, at least
+# two messages
+RESTORE_SPOOL_SIZE = 0
+# Size of the messages of the restore streams, if the storage has no
+# maximum segment size
+RING_SLOT_SIZE = 4194304
+
 
 @six.add_metaclass(abc.ABCMeta)
 class BackupEngine(object):
@@ -72,13 +86,38 @@ class BackupEngine(object):
     :type storage: freezer.storage.base.Storage
     """
 
-    def __init__(self, storage):
+    # Whether backup_data produces the same stream from the same data, so
+    # that a failed backup resumes by producing its stream again and
+    # checking the committed part instead of storing it
+    replayable_stream = False
+
+    def __init__(self, storage, restore_prefetch=RESTORE_PREFETCH,
+                 restore_spool_size=RESTORE_SPOOL_SIZE,
+                 metadata_cache_dir=None, journal_dir=None, **kwargs):
         """
         :type storage: freezer.storage.base.Storage
         :param storage:
+        :param restore_prefetch: number of levels downloaded ahead of the
+                                 level being restored
+        :param restore_spool_size: number of bytes of a level downloaded
+                                   ahead of its restore, at least two
+                                   messages
+        :param metadata_cache_dir: directory of a local cache of the engine
+                                   metadata of the backups, None to
+                                   download it on each incremental backup
+        :param journal_dir: directory of the checkpoint journals of the
+                            backups in progress, None to start a failed
+                            backup again
         :return:
         """
         self.storage = storage
+        self.restore_prefetch = max(0, int(restore_prefetch or 0))
+        self.restore_spool_size = restore_spool_size
+        self.metadata_cache = (metadata_cache.MetadataCache(
+            metadata_cache_dir) if metadata_cache_dir else None)
+        self.journal_dir = journal_dir
+        # Journal of the backup in progress
+        self.journal = None
 
     @abc.abstractproperty
     def name(self):
@@ -88,16 +127,74 @@ class BackupEngine(object):
         """
         pass
 
-    def backup_stream(self, backup_resource, rich_queue, manifest_path):
+    def backup_stream(self, backup_resource, rich_queue, manifest_path,
+                      journal=None):
         """
         :param rich_queue:
         :type rich_queue: freezer.streaming.RichQueue
         :type manifest_path: list[str]
         :param manifest_path:
+        :type journal: freezer.engine.journal.BackupJournal
+        :param journal: journal of the backup, which the engines record
+                        their checkpoints in
         :return:
         """
-        rich_queue.put_messages(self.backup_data(backup_resource,
-                                                 manifest_path))
+        self.journal = journal
+        data = self.backup_data(backup_resource, manifest_path)
+        if journal and self.replayable_stream:
+            data = self.replay_stream(data, journal)
+        rich_queue.put_messages(data)
+
+    @staticmethod
+    def replay_stream(data, journal):
+        """
+        Skips the resumed segments of a stream, checking that they are
+        produced again, and records a checkpoint after each message.
+
+        :param data: messages of the stream
+        :type journal: freezer.engine.journal.BackupJournal
+        :raises freezer.exceptions.engine.ResumeException: if the stream
+                differs from the resumed segments
+        """
+        segments = journal.resumed_segments
+        index = 0
+        remaining = segments[0][0] if segments else 0
+        md5 = hashlib.md5()
+        for message in data:
+            while index < len(segments) and message:
+                part = message[:remaining]
+                md5.update(part)
+                message = message[len(part):]
+                remaining -= len(part)
+                if remaining:
+                    continue
+                if md5.hexdigest() != segments[index][1]:
+                    raise engine_exceptions.ResumeException(
+                        'The data changed since segment {0} was '
+                        'stored'.format(index))
+                index += 1
+                md5 = hashlib.md5()
+                if index < len(segments):
+                    remaining = segments[index][0]
+            if message:
+                index += 1
+                journal.add_checkpoint(index, {})
+                yield message
+        if index < len(segments):
+            raise engine_exceptions.ResumeException(
+                'The stream ends before the stored segments')
+
+    def open_journal(self, hostname_backup_name):
+        """
+        :return: the journal of the backups of hostname_backup_name, None
+                 if journaling is disabled or the storage is not physical
+        :rtype: freezer.engine.journal.BackupJournal
+        """
+        if not self.journal_dir or not isinstance(
+                self.storage, physical.PhysicalStorage):
+            return None
+        return backup_journal.BackupJournal(
+            self.journal_dir, self.storage, self, hostname_backup_name)
 
     def backup(self, backup_resource, hostname_backup_name, no_incremental,
                max_level, always_level, restart_always_level, queue_size=2):
@@ -115,18 +212,9 @@ class BackupEngine(object):
             restart_always_level=restart_always_level
         )
 
-        try:
-            tmpdir = tempfile.mkdtemp()
-        except Exception:
-            LOG.error("Unable to create a tmp directory")
-            raise
-
-        try:
-            engine_meta = utils.path_join(tmpdir, "engine_meta")
-            freezer_meta = utils.path_join(tmpdir, "freezer_meta")
-            if prev_backup:
-                prev_backup.storage.get_file(prev_backup.engine_metadata_path,
-                                             engine_meta)
+        journal = self.open_journal(hostname_backup_name)
+        backup = journal.resume(prev_backup) if journal else None
+        if backup is None:
             timestamp = utils.DateTime.now().timestamp
             level_zero_timestamp = (prev_backup.level_zero_timestamp
                                     if prev_backup else timestamp)
@@ -137,6 +225,29 @@ class BackupEngine(object):
                 timestamp=timestamp,
                 level=(prev_backup.level + 1 if prev_backup else 0)
             )
+            if journal:
+                journal.start(backup)
+
+        if journal:
+            # The working files of the engine are kept for a resume
+            tmpdir = journal.work_dir
+        else:
+            try:
+                tmpdir = tempfile.mkdtemp()
+            except Exception:
+                LOG.error("Unable to create a tmp directory")
+                raise
+
+        try:
+            engine_meta = utils.path_join(tmpdir, "engine_meta")
+            freezer_meta = utils.path_join(tmpdir, "freezer_meta")
+            if os.path.exists(engine_meta):
+                os.remove(engine_meta)
+            if prev_backup and self.metadata_cache:
+                self.metadata_cache.get_file(prev_backup, engine_meta)
+            elif prev_backup:
+                prev_backup.storage.get_file(prev_backup.engine_metadata_path,
+                                             engine_meta)
 
             input_queue = streaming.RichQueue(queue_size)
             read_except_queue = queue.Queue()
@@ -147,13 +258,17 @@ class BackupEngine(object):
                 input_queue,
                 read_except_queue,
                 kwargs={"backup_resource": backup_resource,
-                        "manifest_path": engine_meta})
+                        "manifest_path": engine_meta,
+                        "journal": journal})
 
+            write_kwargs = {"backup": backup}
+            if journal:
+                write_kwargs["journal"] = journal
             write_stream = streaming.QueuedThread(
                 self.storage.write_backup,
                 input_queue,
                 write_except_queue,
-                kwargs={"backup": backup})
+                kwargs=write_kwargs)
 
             read_stream.daemon = True
             write_stream.daemon = True
@@ -162,12 +277,15 @@ class BackupEngine(object):
             read_stream.join()
             write_stream.join()
 
+            errors = []
+
             # queue handling is different from SimpleQueue handling.
             def handle_except_queue(except_queue):
                 if not except_queue.empty():
                     while not except_queue.empty():
                         e = except_queue.get_nowait()
                         LOG.critical('Engine error: {0}'.format(e))
+                        errors.append(e)
                     return True
                 else:
                     return False
@@ -178,41 +296,53 @@ class BackupEngine(object):
             got_exception = (handle_except_queue(write_except_queue) or
                              got_exception)
 
+            if got_exception and journal and any(
+                    isinstance(e, engine_exceptions.ResumeException)
+                    for e in errors):
+                LOG.warning('Cannot resume the backup, starting it again')
+                journal.abandon()
+                return self.backup(backup_resource, hostname_backup_name,
+                                   no_incremental, max_level, always_level,
+                                   restart_always_level, queue_size)
             if got_exception:
                 raise engine_exceptions.EngineException(
                     "Engine error. Failed to backup.")
 
             with open(freezer_meta, mode='wb') as b_file:
-                b_file.write(json.dumps(self.metadata()))
+                b_file.write(json.dumps(self.backup_metadata()))
             self.storage.put_metadata(engine_meta, freezer_meta, backup)
+            if self.metadata_cache and isinstance(
+                    self.storage, physical.PhysicalStorage):
+                self.metadata_cache.put_file(backup.copy(self.storage),
+                                             engine_meta)
+            if journal:
+                journal.finish()
         finally:
-            shutil.rmtree(tmpdir)
+            if not journal:
+                shutil.rmtree(tmpdir)
 
-    def read_blocks(self, backup, write_pipe, read_pipe, except_queue):
-        # Close the read pipe in this child as it is unneeded
-        # and download the objects from swift in chunks. The
-        # Chunk size is set by RESP_CHUNK_SIZE and sent to che write
-        # pipe
+    def read_blocks(self, backups, ring, except_queue):
+        """
+        Downloads the backups in chunks and sends them to the ring buffer,
+        each one ended by an end of stream.
 
+        :type backups: list[freezer.storage.base.Backup]
+        :type ring: freezer.utils.ringbuffer.RingBuffer
+        """
         try:
-
-            read_pipe.close()
-            for block in backup.storage.backup_blocks(backup):
-                write_pipe.send_bytes(block)
-
-            # Closing the pipe after checking no data
-            # is still available in the pipe.
-            while True:
-                if not write_pipe.poll():
-                    write_pipe.close()
-                    break
-                time.sleep(1)
-
-        except IOError:
+            for backup in backups:
+                try:
+                    for block in backup.storage.backup_blocks(backup):
+                        ring.send_bytes(block)
+                finally:
+                    ring.send_end()
+
+        except ringbuffer.RingAborted:
             pass
 
         except Exception as e:
             except_queue.put(e)
+            ring.abort()
             raise
 
     def restore(self, hostname_backup_name, restore_resource,
@@ -242,61 +372,127 @@ class BackupEngine(object):
 
         max_level = max(backups.keys())
 
-        # Use SimpleQueue because Queue does not work on Mac OS X.
-        read_except_queue = queues.SimpleQueue()
         LOG.info("Restoring backup {0}".format(hostname_backup_name))
-        for level in range(0, max_level + 1):
-            LOG.info("Restoring from level {0}".format(level))
-            backup = backups[level]
-            read_pipe, write_pipe = multiprocessing.Pipe()
-            process_stream = multiprocessing.Process(
-                target=self.read_blocks,
-                args=(backup, write_pipe, read_pipe, read_except_queue))
-
-            process_stream.daemon = True
-            process_stream.start()
-            write_pipe.close()
+        self.restore_backups(
+            restore_resource,
+            [backups[level] for level in range(0, max_level + 1)])
 
-            # Start the tar pipe consumer process
-
-            # Use SimpleQueue because Queue does not work on Mac OS X.
-            write_except_queue = queues.SimpleQueue()
-
-            engine_stream = multiprocessing.Process(
-                target=self.restore_level,
-                args=(restore_resource, read_pipe, backup, write_except_queue))
-
-            engine_stream.daemon = True
-            engine_stream.start()
+        LOG.info(
+            'Restore completed successfully for backup name '
+            '{0}'.format(hostname_backup_name))
 
-            read_pipe.close()
-            write_pipe.close()
-            process_stream.join()
-            engine_stream.join()
+    def restore_backups(self, restore_resource, backups):
+        """
+        Restores the backups of a level zero and its increments, one
+        level after the other. Engines can override it to restore the
+        levels in another order.
 
-            # SimpleQueue handling is different from queue handling.
-            def handle_except_SimpleQueue(except_queue):
-                if not except_queue.empty():
-                    while not except_queue.empty():
-                        e = except_queue.get()
-                        LOG.exception('Engine error: {0}'.format(e))
-                    return True
-                else:
-                    return False
+        :param restore_resource:
+        :param backups: backups sorted by level
+        :type backups: list[freezer.storage.base.Backup]
+        """
+        self.stream_backups(restore_resource, backups, self.restore_levels)
 
-            got_exception = None
-            got_exception = (handle_except_SimpleQueue(read_except_queue) or
-                             got_exception)
-            got_exception = (handle_except_SimpleQueue(write_except_queue) or
-                             got_exception)
+    def restore_levels(self, restore_resource, read_pipes, backups,
+                       except_queue):
+        """
+        Consumer process of stream_backups applying restore_level to each
+        backup.
+        """
+        for read_pipe, backup in zip(read_pipes, backups):
+            LOG.info("Restoring from level {0}".format(backup.level))
+            self.restore_level(restore_resource, read_pipe, backup,
+                               except_queue)
 
-            if engine_stream.exitcode or got_exception:
-                raise engine_exceptions.EngineException(
-                    "Engine error. Failed to restore.")
+    def stream_backups(self, restore_resource, backups, consumer):
+        """
+        Streams the data of the backups, one after the other, to a
+        consumer process.
+
+        The backups are downloaded by restore_prefetch + 1 reader
+        processes taking the levels in turn, each one sending them to its
+        own ring buffer. The rings hold up to restore_spool_size bytes
+        downloaded ahead of the consumer.
+
+        :param restore_resource:
+        :param backups: backups in the order they are consumed
+        :type backups: list[freezer.storage.base.Backup]
+        :param consumer: function called in the consumer process with
+                         restore_resource, the stream of each backup (see
+                         ringbuffer.RingBuffer.recv_bytes), the backups
+                         and the exception queue
+        """
+        aborted = multiprocessing.Event()
+        slot_size = (getattr(self.storage, 'max_segment_size', None) or
+                     RING_SLOT_SIZE)
+        rings = [ringbuffer.RingBuffer(self.restore_spool_size, slot_size,
+                                       aborted)
+                 for _ in range(min(len(backups), self.restore_prefetch + 1))]
+        streams = [rings[index % len(rings)]
+                   for index in range(len(backups))]
 
-        LOG.info(
-            'Restore completed successfully for backup name '
-            '{0}'.format(hostname_backup_name))
+        # Use SimpleQueue because Queue does not work on Mac OS X.
+        read_except_queue = queues.SimpleQueue()
+        write_except_queue = queues.SimpleQueue()
+
+        # Start the stream consumer process
+        engine_stream = multiprocessing.Process(
+            target=self._consume_backups,
+            args=(consumer, restore_resource, streams, backups,
+                  write_except_queue))
+        engine_stream.daemon = True
+        engine_stream.start()
+
+        readers = []
+        for index, ring in enumerate(rings):
+            process_stream = multiprocessing.Process(
+                target=self.read_blocks,
+                args=(backups[index::len(rings)], ring, read_except_queue))
+            process_stream.daemon = True
+            process_stream.start()
+            readers.append(process_stream)
+
+        # The readers are stopped once the consumer exits, or if a process
+        # is killed before aborting the streams
+        processes = readers + [engine_stream]
+        for process in processes:
+            while process.is_alive():
+                process.join(ringbuffer.ABORT_CHECK_INTERVAL)
+                if not engine_stream.is_alive() or any(
+                        other.exitcode for other in processes):
+                    aborted.set()
+        for ring in rings:
+            ring.close()
+
+        # SimpleQueue handling is different from queue handling.
+        def handle_except_SimpleQueue(except_queue):
+            if not except_queue.empty():
+                while not except_queue.empty():
+                    e = except_queue.get()
+                    LOG.exception('Engine error: {0}'.format(e))
+                return True
+            else:
+                return False
+
+        got_exception = None
+        got_exception = (handle_except_SimpleQueue(read_except_queue) or
+                         got_exception)
+        got_exception = (handle_except_SimpleQueue(write_except_queue) or
+                         got_exception)
+
+        if engine_stream.exitcode or got_exception:
+            raise engine_exceptions.EngineException(
+                "Engine error. Failed to restore.")
+
+    @staticmethod
+    def _consume_backups(consumer, restore_resource, streams, backups,
+                         except_queue):
+        try:
+            consumer(restore_resource, streams, backups, except_queue)
+        except Exception:
+            # Stop the readers waiting for the streams to be consumed
+            streams[0].abort()
+            raise
 
     @abc.abstractmethod
     def restore_level(self, restore_path, read_pipe, backup, except_queue):
@@ -314,3 +510,10 @@ class BackupEngine(object):
     @abc.abstractmethod
     def metadata(self):
         pass
+
+    def backup_metadata(self):
+        """
+        :return: the metadata written with the backup just made, the
+                 engine metadata and statistics of the backup
+        """
+        return self.metadata()
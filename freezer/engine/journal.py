@@ -0,0 +1,241 @@
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Checkpoint journal of the backup in progress of a backup name.
+
+The storage commits the segments of the backup stream, in order or not,
+and the engine records checkpoints: the state of its producer after a
+number of segments, from which it can produce the rest of the stream.
+Once the segments before a checkpoint are all committed, the journal
+file is replaced with the checkpoint and the size and md5 of these
+segments. The next run resumes a failed backup from its last checkpoint,
+as the same backup: the storage keeps the committed segments and the
+engine continues its stream. The data of an attempt which cannot be
+resumed is removed by the next run.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+from oslo_log import log
+
+from freezer.storage import base
+from freezer.utils import winutils
+
+LOG = log.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+
+
+class BackupJournal(object):
+    """
+    :param journal_dir: directory of the journals, created if needed
+    :type storage: freezer.storage.physical.PhysicalStorage
+    :type engine: freezer.engine.engine.BackupEngine
+    :type hostname_backup_name: str
+    """
+
+    def __init__(self, journal_dir, storage, engine, hostname_backup_name):
+        self.storage = storage
+        self.engine = engine
+        self.hostname_backup_name = hostname_backup_name
+        name = hashlib.sha256(json.dumps([
+            storage.type, storage.storage_path, engine.name,
+            hostname_backup_name]).encode('utf-8')).hexdigest()
+        self.path = os.path.join(os.path.expanduser(journal_dir), name)
+        self.journal_path = os.path.join(self.path, 'journal')
+        # Working files of the engine, kept until the backup is done
+        self.work_dir = os.path.join(self.path, 'work')
+        self.lock = threading.Lock()
+        self.state = None
+        # (size, md5) of the segments committed in order, and of the
+        # segments committed after a missing one by index
+        self.segments = []
+        self.committed = {}
+        # (number of segments, producer state) waiting for their segments
+        self.checkpoints = []
+        # Segments and producer state of the resumed checkpoint
+        self.resumed_segments = []
+        self.resumed_state = None
+
+    @property
+    def resumed_offset(self):
+        """
+        Length of the stream of the resumed segments.
+        """
+        return sum(size for size, _ in self.resumed_segments)
+
+    def load(self):
+        """
+        :return: the journal of the last attempt, None if missing or
+                 unreadable
+        """
+        try:
+            with open(self.journal_path) as journal_file:
+                state = json.load(journal_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if state.get('version') != JOURNAL_VERSION:
+            return None
+        return state
+
+    def _backup(self, state):
+        return base.Backup(
+            engine=self.engine,
+            hostname_backup_name=self.hostname_backup_name,
+            level_zero_timestamp=state['backup']['level_zero_timestamp'],
+            timestamp=state['backup']['timestamp'],
+            level=state['backup']['level'],
+            storage=self.storage)
+
+    def resume(self, prev_backup):
+        """
+        Returns the backup of the last attempt if it has a checkpoint and
+        still follows prev_backup with the same engine settings. The data
+        of an attempt which cannot be resumed is removed.
+
+        :type prev_backup: freezer.storage.base.Backup
+        :param prev_backup: previous backup of the backup to make
+        :rtype: freezer.storage.base.Backup
+        :return: the backup to resume, None to start a new one
+        """
+        state = self.load()
+        if state is None:
+            self.finish()
+            return None
+        backup = self._backup(state)
+        if prev_backup:
+            expected = (prev_backup.level_zero_timestamp,
+                        prev_backup.level + 1)
+        else:
+            expected = (backup.timestamp, 0)
+        checkpoint = state.get('checkpoint')
+        if (not checkpoint or not os.path.isdir(self.work_dir) or
+                (backup.level_zero_timestamp, backup.level) != expected or
+                state.get('engine') != self.engine.metadata()):
+            self.abandon()
+            return None
+        LOG.info('Resuming the backup {0} level {1} after {2} '
+                 'segments'.format(backup.timestamp, backup.level,
+                                   checkpoint['segments']))
+        self.state = state
+        self.segments = [tuple(segment) for segment in state['segments']]
+        self.resumed_segments = list(self.segments)
+        self.resumed_state = checkpoint['state']
+        return backup
+
+    def abandon(self):
+        """
+        Removes the data of the last attempt, unless it was completed, and
+        the journal.
+        """
+        state = self.state or self.load()
+        if state is not None:
+            backup = self._backup(state)
+            if ((backup.level, backup.timestamp) not in
+                    self.storage.list_increments(backup)):
+                LOG.info('Removing the data of the failed backup {0} level '
+                         '{1}'.format(backup.timestamp, backup.level))
+                self.storage.rmtrees([backup.data_prefix_path])
+        self.finish()
+
+    def start(self, backup):
+        """
+        Records a new attempt, before its data is written.
+
+        :type backup: freezer.storage.base.Backup
+        """
+        self.finish()
+        os.makedirs(self.work_dir, 0o700)
+        os.chmod(self.path, 0o700)
+        self.state = {
+            'version': JOURNAL_VERSION,
+            'backup': {'level_zero_timestamp': backup.level_zero_timestamp,
+                       'timestamp': backup.timestamp,
+                       'level': backup.level},
+            'engine': self.engine.metadata(),
+            'segments': [],
+            'checkpoint': None}
+        self.segments = []
+        self.committed = {}
+        self.checkpoints = []
+        self.resumed_segments = []
+        self.resumed_state = None
+        self._write()
+
+    def commit(self, index, size, md5):
+        """
+        Records a segment stored by the storage.
+
+        :param index: index of the segment in the stream
+        :param size: size of the segment
+        :param md5: md5 of the segment
+        """
+        with self.lock:
+            self.committed[index] = (size, md5)
+            self._advance()
+
+    def add_checkpoint(self, segments, state):
+        """
+        Records the state of the producer once it produced a number of
+        segments, in order.
+
+        :param segments: number of segments produced before the state
+        :param state: JSON serializable state of the producer
+        """
+        with self.lock:
+            self.checkpoints.append((segments, state))
+            self._advance()
+
+    def _advance(self):
+        while len(self.segments) in self.committed:
+            self.segments.append(self.committed.pop(len(self.segments)))
+        checkpoint = None
+        while self.checkpoints and self.checkpoints[0][0] <= len(
+                self.segments):
+            checkpoint = self.checkpoints.pop(0)
+        if checkpoint is None:
+            return
+        segments, state = checkpoint
+        self.state['segments'] = self.segments[:segments]
+        self.state['checkpoint'] = {'segments': segments, 'state': state}
+        try:
+            self._write()
+        except (IOError, OSError) as e:
+            # The backup resumes from an older checkpoint
+            LOG.warning('Cannot update the backup journal: {0}'.format(e))
+
+    def _write(self):
+        tmp_path = '{0}.{1}'.format(self.journal_path, uuid.uuid4().hex)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as journal_file:
+                json.dump(self.state, journal_file)
+            if winutils.is_windows() and os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            os.rename(tmp_path, self.journal_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def finish(self):
+        """
+        Removes the journal and the working files, once the backup is done.
+        """
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
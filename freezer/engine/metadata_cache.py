@@ -0,0 +1,154 @@
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Local cache of the engine metadata of the backups.
+
+An incremental backup needs the engine metadata of the previous backup,
+which the previous run of the agent wrote. The cache keeps a copy of the
+engine metadata of each backup, with the signature of the stored file
+(size and etag or modification time) and the md5 of its content, so that
+the next increment checks the stored file instead of downloading it.
+Only the backups of the last level zero backup of each backup name are
+kept.
+"""
+
+import hashlib
+import json
+import os
+import uuid
+
+from oslo_log import log
+
+from freezer.utils import winutils
+
+LOG = log.getLogger(__name__)
+
+CHUNK_SIZE = 1048576
+
+
+class MetadataCache(object):
+    """
+    :param cache_dir: directory of the cache, created if needed
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+
+    def _entry_path(self, backup):
+        """
+        :type backup: freezer.storage.base.Backup
+        :return: path of the cached engine metadata of backup, in the
+                 directory of its backup name
+        """
+        name = hashlib.sha256(json.dumps([
+            backup.storage.type, backup.storage.storage_path,
+            backup.engine.name, backup.hostname_backup_name]).encode(
+            'utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name, '{0}_{1}_{2}'.format(
+            backup.level_zero_timestamp, backup.level, backup.timestamp))
+
+    @staticmethod
+    def _signature(backup):
+        try:
+            return backup.storage.file_signature(backup.engine_metadata_path)
+        except Exception as e:
+            LOG.warning('Cannot check the engine metadata of {0}: {1}'.format(
+                backup.engine_metadata_path, e))
+            return None
+
+    def get_file(self, backup, to_path):
+        """
+        Copies the engine metadata of a backup from the cache if it matches
+        the stored file, downloads and caches it otherwise.
+
+        :type backup: freezer.storage.base.Backup
+        :param to_path: path of the copy
+        """
+        signature = self._signature(backup)
+        if signature and self._read(backup, signature, to_path):
+            LOG.info('Using the cached engine metadata of {0}'.format(
+                backup.engine_metadata_path))
+            return
+        backup.storage.get_file(backup.engine_metadata_path, to_path)
+        if signature:
+            self._write(backup, signature, to_path)
+
+    def put_file(self, backup, from_path):
+        """
+        Caches the engine metadata of a backup, once written in its
+        storage.
+
+        :type backup: freezer.storage.base.Backup
+        :param from_path: path of the engine metadata
+        """
+        signature = self._signature(backup)
+        if signature:
+            self._write(backup, signature, from_path)
+
+    def _read(self, backup, signature, to_path):
+        path = self._entry_path(backup)
+        try:
+            with open(path + '.json') as entry_file:
+                entry = json.load(entry_file)
+            if entry.get('signature') != signature:
+                return False
+            md5 = hashlib.md5()
+            with open(path, 'rb') as cached, open(to_path, 'wb') as copy:
+                for chunk in iter(lambda: cached.read(CHUNK_SIZE), b''):
+                    md5.update(chunk)
+                    copy.write(chunk)
+        except (IOError, OSError, ValueError):
+            return False
+        if md5.hexdigest() != entry.get('md5'):
+            LOG.warning('Discarding the damaged cached engine metadata of '
+                        '{0}'.format(backup.engine_metadata_path))
+            return False
+        return True
+
+    def _write(self, backup, signature, from_path):
+        path = self._entry_path(backup)
+        entry_dir = os.path.dirname(path)
+        tmp_path = '{0}.{1}'.format(path, uuid.uuid4().hex)
+        try:
+            if not os.path.isdir(entry_dir):
+                os.makedirs(entry_dir, 0o700)
+            md5 = hashlib.md5()
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+            with os.fdopen(fd, 'wb') as cached, open(from_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    md5.update(chunk)
+                    cached.write(chunk)
+            self._replace(tmp_path, path)
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+            with os.fdopen(fd, 'w') as entry_file:
+                json.dump({'signature': signature,
+                           'md5': md5.hexdigest()}, entry_file)
+            self._replace(tmp_path, path + '.json')
+            # The increments of older level zero backups are not needed
+            prefix = '{0}_'.format(backup.level_zero_timestamp)
+            for name in os.listdir(entry_dir):
+                if not name.startswith(prefix):
+                    os.remove(os.path.join(entry_dir, name))
+        except (IOError, OSError) as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            LOG.warning('Cannot cache the engine metadata of {0}: {1}'.format(
+                backup.engine_metadata_path, e))
+
+    @staticmethod
+    def _replace(from_path, to_path):
+        if winutils.is_windows() and os.path.exists(to_path):
+            os.remove(to_path)
+        os.rename(from_path, to_path)
@@ -0,0 +1,214 @@
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Collapsed restore of the levels of an rsync engine backup.
+
+Restoring the levels one after the other rewrites the blocks of a file
+changed by several levels once per level. The levels are restored here
+from the newest to level 0 instead: the first record of a path holds its
+final state, and a block of a file is written from the newest level
+holding it only. A file is complete, and its older records skipped, once
+its newest full record is restored; the blocks written by newer levels
+are kept track of until then.
+
+Only the paths seen in the levels above 0 are remembered: level 0,
+restored last, is applied to the other paths as a full backup.
+"""
+
+import os
+
+from freezer.engine.rsync import writers
+
+# State of a path whose older records are skipped
+RESTORED = object()
+
+
+class PartialFile(object):
+    """
+    Final size, inode fields and written blocks of a file restored from
+    incremental records, until its newest full record is restored.
+
+    :param size: final size of the file
+    :param inode: arguments of InodeSetter.apply after the path
+    :param block_size: size of the blocks of the incremental records
+    """
+
+    def __init__(self, size, inode, block_size):
+        self.size = size
+        self.inode = inode
+        self.block_size = block_size
+        blocks = (size + block_size - 1) // block_size
+        self.written = bytearray((blocks + 7) // 8)
+
+    def is_written(self, block_index):
+        return self.written[block_index >> 3] & (1 << (block_index & 7))
+
+    def mark_written(self, block_indexes):
+        """
+        Marks the blocks of a restored incremental record, so that the
+        older levels don't overwrite them.
+        """
+        for block_index in block_indexes:
+            if block_index * self.block_size < self.size:
+                self.written[block_index >> 3] |= 1 << (block_index & 7)
+
+    def write(self, file_fd, offset, data):
+        """
+        Writes the parts of data, found at offset in the file of an older
+        level, on the blocks not written yet, up to the final size.
+        """
+        end = min(offset + len(data), self.size)
+        position = offset
+        while position < end:
+            block_index = position // self.block_size
+            block_end = min((block_index + 1) * self.block_size, end)
+            if not self.is_written(block_index):
+                file_fd.seek(position)
+                file_fd.write(data[position - offset:block_end - offset])
+            position = block_end
+
+
+class CollapsedRestore(object):
+    """
+    Restores the version 2 streams of the levels of a backup, from the
+    newest level to level 0.
+
+    :param engine: RsyncEngine creating the special files and reading the
+                   records
+    :param restore_abs_path: restore path
+    :param block_size: size of the blocks of the incremental records
+    :param workers: number of threads writing the files not changed by
+                    an incremental record
+    """
+
+    def __init__(self, engine, restore_abs_path, block_size, workers=1):
+        self.engine = engine
+        self.restore_abs_path = restore_abs_path
+        self.block_size = block_size
+        self.inodes = writers.InodeSetter()
+        self.file_writers = None
+        if workers > 1:
+            self.file_writers = writers.FileWriters(workers)
+        # RESTORED or the PartialFile of the paths seen above level 0
+        self.paths = {}
+
+    def restore(self, reader, level):
+        """
+        Restores the records of a level, the newer levels being restored.
+
+        :param reader: stream.StreamReader on the backup stream
+        :param level: level of the backup
+        """
+        for header in iter(reader.next_header, None):
+            state = self.paths.get(header.path)
+            if state is RESTORED:
+                continue
+            file_abs_path = '{0}/{1}'.format(self.restore_abs_path,
+                                             header.path)
+            if state is None:
+                state = self.restore_newest(header, reader, file_abs_path,
+                                            level)
+                if state is None:
+                    continue
+            self.restore_blocks(header, reader, file_abs_path, state)
+
+    def restore_newest(self, header, reader, file_abs_path, level):
+        """
+        Restores the first record of a path, holding its final state.
+        Returns the PartialFile of a file restored from an incremental
+        record, None otherwise.
+        """
+        if level:
+            self.paths[header.path] = RESTORED
+        if not os.path.isdir(file_abs_path) and os.path.lexists(
+                file_abs_path):
+            os.unlink(file_abs_path)
+        if header.deleted:
+            return None
+
+        inode = (header.uname, header.gname, header.mode, header.mtime)
+        if not self.engine.is_reg_file(header.ftype):
+            self.engine.make_special_file(
+                header.ftype, file_abs_path, header.mode, header.lname,
+                header.devmajor, header.devminor)
+            if header.ftype != 'l':
+                self.inodes.defer(file_abs_path, *inode)
+            return None
+
+        if not header.incremental:
+            writes = self.engine.gen_record_writes(header, reader)
+            if self.file_writers:
+                self.file_writers.write(file_abs_path, False, header.size,
+                                        writes)
+            else:
+                writers.write_file(file_abs_path, False, header.size,
+                                   writes)
+            self.inodes.defer(file_abs_path, *inode)
+            return None
+
+        state = PartialFile(header.size, inode, self.block_size)
+        self.paths[header.path] = state
+        with open(file_abs_path, 'wb') as file_fd:
+            file_fd.truncate(header.size)
+        return state
+
+    def restore_blocks(self, header, reader, file_abs_path, state):
+        """
+        Restores the blocks of a record not written by a newer level on
+        a file partially restored.
+        """
+        if header.deleted or not self.engine.is_reg_file(header.ftype):
+            # The path was another file or deleted before the newer levels
+            # recreated it: the older records are not part of it
+            self.complete(header.path, file_abs_path, state)
+            return
+
+        with open(file_abs_path, 'rb+') as file_fd:
+            if header.incremental:
+                block_indexes = reader.read_block_indexes()
+                for block_index in block_indexes:
+                    offset = block_index * state.block_size
+                    block_len = max(0, min(state.block_size,
+                                           header.size - offset))
+                    for data in reader.iter_data(block_len):
+                        state.write(file_fd, offset, data)
+                        offset += len(data)
+                state.mark_written(block_indexes)
+                return
+
+            offset = 0
+            for data in reader.iter_data():
+                state.write(file_fd, offset, data)
+                offset += len(data)
+        self.complete(header.path, file_abs_path, state)
+
+    def complete(self, rel_path, file_abs_path, state):
+        self.paths[rel_path] = RESTORED
+        self.inodes.defer(file_abs_path, *state.inode)
+
+    def close(self):
+        """
+        Waits for the files to be written and sets the inode fields of the
+        restored files.
+        """
+        try:
+            if self.file_writers:
+                self.file_writers.close()
+        finally:
+            self.file_writers = None
+        for rel_path, state in list(self.paths.items()):
+            if state is not RESTORED:
+                self.complete(
+                    rel_path, '{0}/{1}'.format(self.restore_abs_path,
+                                               rel_path), state)
+        self.inodes.apply_deferred()
@@ -0,0 +1,376 @@
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Buffered implementation of the rsync signature and delta functions.
+
+blockchecksums and rsyncdelta have the same signature and produce the
+same output as their counterparts in freezer.engine.rsync.pyrsync, so
+manifests generated by either module are interchangeable. The input is
+read in large buffers instead of one byte at a time and, when NumPy is
+available, the weak checksum of every window position is computed at
+once from cumulative sums:
+
+    a(q) = S(q + n) - S(q)
+    b(q) = (n + q) * a(q) - (T(q + n) - T(q))
+
+where S and T are the cumulative sums of d(j) and j * d(j). Only the
+positions whose weak checksum is present in the remote signature are
+then examined one by one. Without NumPy the same positions are found
+with an inline rolling checksum over the buffer.
+"""
+
+import bisect
+import hashlib
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from freezer.engine.rsync import pyrsync
+
+__all__ = ["rsyncdelta", "blockchecksums", "iterblockchecksums",
+           "weakchecksums"]
+
+# Amount of data read from the stream at once
+READ_BUFFER_SIZE = 1048576
+# Number of window positions checksummed in one vectorized pass
+SCAN_WINDOW = 262144
+# Size of the lookup table used to filter the weak checksums with NumPy
+FILTER_BITS = 20
+
+
+def _read_full(instream, size):
+    """
+    Reads up to size bytes, retrying short reads until EOF.
+    """
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        data = instream.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    return b''.join(chunks)
+
+
+def _weakchecksum(window):
+    """
+    Same result as pyrsync.weakchecksum for a bytearray, using builtins
+    which loop in C.
+    """
+    a = sum(window)
+    b = sum(map(operator.mul, window, range(len(window), 0, -1)))
+    return (b << 16) | a
+
+
+def weakchecksums(data, blocksize=4096):
+    """
+    Returns the weak checksum of every consecutive block of data, the
+    last block being possibly shorter than blocksize.
+    """
+    data = bytes(data)
+    full_blocks = len(data) // blocksize
+    weak = []
+    if numpy is not None and full_blocks:
+        weights = numpy.arange(blocksize, 0, -1, dtype=numpy.int64)
+        blocks = numpy.frombuffer(
+            data, dtype=numpy.uint8,
+            count=full_blocks * blocksize).reshape(full_blocks, blocksize)
+        # Keep the int64 working copy small
+        step = max(1, SCAN_WINDOW // blocksize)
+        for start in range(0, full_blocks, step):
+            chunk = blocks[start:start + step].astype(numpy.int64)
+            a = chunk.sum(axis=1)
+            b = chunk.dot(weights)
+            weak.extend(((b << 16) | a).tolist())
+    else:
+        for offset in range(0, full_blocks * blocksize, blocksize):
+            weak.append(_weakchecksum(
+                bytearray(data[offset:offset + blocksize])))
+    if len(data) % blocksize:
+        weak.append(_weakchecksum(
+            bytearray(data[full_blocks * blocksize:])))
+    return weak
+
+
+def blockchecksums(instream, blocksize=4096):
+    """
+    Returns a list of weak and strong hashes for each block of the
+    defined size for the given data stream.
+    """
+
+    weakhashes = list()
+    stronghashes = list()
+    read_size = max(1, READ_BUFFER_SIZE // blocksize) * blocksize
+    read = _read_full(instream, read_size)
+
+    while read:
+        weakhashes.extend(weakchecksums(read, blocksize))
+        view = memoryview(read)
+        for offset in range(0, len(read), blocksize):
+            stronghashes.append(hashlib.sha1(
+                view[offset:offset + blocksize]).hexdigest())
+        read = _read_full(instream, read_size)
+
+    return weakhashes, stronghashes
+
+
+def iterblockchecksums(instream, blocksize=4096):
+    """
+    Yields the weak checksum and the raw SHA-1 digest of each block of
+    the defined size for the given data stream.
+    """
+
+    read_size = max(1, READ_BUFFER_SIZE // blocksize) * blocksize
+    read = _read_full(instream, read_size)
+
+    while read:
+        view = memoryview(read)
+        for index, weak in enumerate(weakchecksums(read, blocksize)):
+            offset = index * blocksize
+            yield weak, hashlib.sha1(
+                view[offset:offset + blocksize]).digest()
+        read = _read_full(instream, read_size)
+
+
+class _WindowScanner(object):
+    """
+    Finds the window positions whose weak checksum is a key of the
+    remote signature index.
+    """
+
+    def __init__(self, signature_index, blocksize):
+        self.keys = signature_index.weak_index
+        self.blocksize = blocksize
+        self.start = self.end = 0
+        self.hits = []
+        self.checksums = []
+        if numpy is not None:
+            self.key_array = numpy.array(sorted(self.keys),
+                                         dtype=numpy.int64)
+            self.key_filter = numpy.zeros(1 << FILTER_BITS, dtype=bool)
+            self.key_filter[self._filter_slot(self.key_array)] = True
+
+    @staticmethod
+    def _filter_slot(weak):
+        return (weak ^ (weak >> FILTER_BITS)) & ((1 << FILTER_BITS) - 1)
+
+    def next_hit(self, buf, base, position, last):
+        """
+        Returns the first position in [position, last] whose window
+        buf[pos - base:pos - base + blocksize] has a known weak checksum
+        together with that checksum, or (None, None). All the windows in
+        that range must be complete.
+        """
+        if position <= last and not self.start <= position < self.end:
+            # Right after a match the next block often matches too:
+            # check it alone before scanning the whole range.
+            offset = position - base
+            checksum = _weakchecksum(buf[offset:offset + self.blocksize])
+            if checksum in self.keys:
+                return position, checksum
+        while position <= last:
+            if not self.start <= position < self.end:
+                self._scan(buf, base, position, last)
+            index = bisect.bisect_left(self.hits, position)
+            if index < len(self.hits):
+                if self.hits[index] > last:
+                    break
+                return self.hits[index], self.checksums[index]
+            position = self.end
+        return None, None
+
+    def _scan(self, buf, base, position, last):
+        count = min(SCAN_WINDOW, last - position + 1)
+        self.start = position
+        self.end = position + count
+        if numpy is not None:
+            hits, self.checksums = self._scan_numpy(
+                buf, position - base, count)
+        else:
+            hits, self.checksums = self._scan_python(
+                buf, position - base, count)
+        self.hits = [position + offset for offset in hits]
+
+    def _scan_numpy(self, buf, offset, count):
+        size = self.blocksize
+        data = numpy.frombuffer(
+            buf, dtype=numpy.uint8, count=count + size - 1,
+            offset=offset).astype(numpy.int64)
+        zero = numpy.zeros(1, dtype=numpy.int64)
+        s = numpy.concatenate((zero, numpy.cumsum(data)))
+        t = numpy.concatenate((zero, numpy.cumsum(
+            data * numpy.arange(len(data), dtype=numpy.int64))))
+        a = s[size:size + count] - s[:count]
+        q = numpy.arange(count, dtype=numpy.int64)
+        b = (size + q) * a - (t[size:size + count] - t[:count])
+        weak = (b << 16) | a
+        keys = self.key_array
+        hits = numpy.flatnonzero(self.key_filter[self._filter_slot(weak)])
+        if len(hits):
+            index = numpy.searchsorted(keys, weak[hits])
+            numpy.minimum(index, len(keys) - 1, out=index)
+            hits = hits[keys[index] == weak[hits]]
+        return hits.tolist(), weak[hits].tolist()
+
+    def _scan_python(self, buf, offset, count):
+        size = self.blocksize
+        keys = self.keys
+        hits = []
+        checksums = []
+        a = b = 0
+        for i in range(size):
+            byte = buf[offset + i]
+            a += byte
+            b += (size - i) * byte
+        for i in range(count):
+            if i:
+                removed = buf[offset + i - 1]
+                a += buf[offset + i + size - 1] - removed
+                b -= removed * size - a
+            checksum = (b << 16) | a
+            if checksum in keys:
+                hits.append(i)
+                checksums.append(checksum)
+        return hits, checksums
+
+
+def rsyncdelta(datastream, remotesignatures, blocksize=4096):
+    """
+    Generates a binary patch when supplied with the weak and strong
+    hashes from an unpatched target and a readable stream for the
+    up-to-date data. The blocksize must be the same as the value
+    used to generate remotesignatures.
+
+    The generated items are identical to the ones produced by
+    pyrsync.rsyncdelta for the same input.
+    """
+
+    if isinstance(remotesignatures, pyrsync.SignatureIndex):
+        signature_index = remotesignatures
+    else:
+        signature_index = pyrsync.SignatureIndex(remotesignatures)
+    scanner = _WindowScanner(signature_index, blocksize)
+
+    buf = bytearray()
+    # Stream offset of buf[0]
+    base = 0
+    eof = False
+    # Start of the current window and of the pending literal data
+    position = literal = 0
+    matchblock = -1
+
+    def fill(needed):
+        # Make sure buf holds the stream up to offset needed (or EOF)
+        # and drop the data that was already yielded.
+        discard = min(literal, position) - base
+        if discard >= READ_BUFFER_SIZE:
+            del buf[:discard]
+            base_offset = base + discard
+        else:
+            base_offset = base
+        stream_eof = eof
+        while not stream_eof and base_offset + len(buf) < needed:
+            data = datastream.read(READ_BUFFER_SIZE)
+            if not data:
+                stream_eof = True
+            else:
+                buf.extend(data)
+        return base_offset, stream_eof
+
+    def find_match(checksum, start, end):
+        weakblock = signature_index.weak_match(checksum, matchblock + 1)
+        if weakblock is None:
+            return None, matchblock
+        stronghash = hashlib.sha1(
+            bytes(buf[start - base:end - base])).hexdigest()
+        return (signature_index.strong_match(stronghash, weakblock),
+                weakblock)
+
+    while True:
+        base, eof = fill(position + blocksize + 1)
+        end_of_data = base + len(buf) if eof else None
+
+        if end_of_data is None or position + blocksize < end_of_data:
+            # Full window which can roll forward: skip straight to the
+            # next position with a known weak checksum.
+            if end_of_data is None:
+                last = base + len(buf) - blocksize - 1
+            else:
+                last = end_of_data - blocksize - 1
+            hit, checksum = scanner.next_hit(buf, base, position, last)
+            if hit is None:
+                hit = last + 1
+            while hit - literal >= blocksize:
+                yield bytes(buf[literal - base:literal - base + blocksize])
+                literal += blocksize
+            position = hit
+            if checksum is None:
+                continue
+            window_end = position + blocksize
+            block, matchblock = find_match(checksum, position, window_end)
+            if block is not None:
+                matchblock = block
+                if position > literal:
+                    yield bytes(buf[literal - base:position - base])
+                yield matchblock
+                if datastream.closed:
+                    break
+                position = literal = window_end
+            else:
+                position += 1
+                if position - literal == blocksize:
+                    yield bytes(buf[literal - base:position - base])
+                    literal = position
+            continue
+
+        # The window reaches the end of the stream
+        checksum, a, b = pyrsync.weakchecksum(
+            bytearray(buf[position - base:end_of_data - base]))
+        block, matchblock = find_match(checksum, position, end_of_data)
+        if block is not None:
+            matchblock = block
+            if position > literal:
+                yield bytes(buf[literal - base:position - base])
+            yield matchblock
+            if datastream.closed:
+                break
+            position = literal = end_of_data
+            continue
+
+        # No more data: the window slowly shrinks, the removed bytes are
+        # replaced by zeros in the checksum.
+        tailsize = datastream.tell() % blocksize
+        while True:
+            if end_of_data - position <= tailsize:
+                yield bytes(buf[position - base:end_of_data - base])
+                return
+            oldbyte = buf[position - base]
+            checksum, a, b = pyrsync.rollingchecksum(
+                oldbyte, 0, a, b, blocksize)
+            position += 1
+            if position - literal == blocksize:
+                yield bytes(buf[literal - base:position - base])
+                literal = position
+            block, matchblock = find_match(checksum, position, end_of_data)
+            if block is not None:
+                # pyrsync fails at this point as the stream is gone; all
+                # the remaining data matched so the delta is complete.
+                matchblock = block
+                if position > literal:
+                    yield bytes(buf[literal - base:position - base])
+                yield matchblock
+                return
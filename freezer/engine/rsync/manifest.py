@@ -0,0 +1,388 @@
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Streamed manifest of the rsync engine.
+
+The manifest lists the directories and files of a backup sorted in the
+order of the file system walk (see sort_key), so that it can be written
+while the files are processed and the manifest of the previous backup
+can be read in step with the walk. The layout of the file is:
+
+    header | chunks | signature records | index | footer
+
+- header: MANIFEST_MAGIC, format version and block size
+- chunks: compressed JSON lines [kind, relative path, meta data], at
+  most CHUNK_SIZE bytes of JSON per chunk
+- signature records: see freezer.engine.rsync.signature
+- index: compressed JSON holding the global meta data of the backup and
+  the first entry, offset and length of every chunk (sparse index)
+- footer: offset and number of the signature records, offset and length
+  of the index, MANIFEST_MAGIC
+
+Version 1 manifests (compressed JSON followed by signature records)
+and older ones (compressed JSON only) are read in memory and yielded in
+the same order.
+"""
+
+import bisect
+import json
+import os
+import shutil
+import struct
+
+import six
+
+from freezer.engine.rsync import signature
+from freezer.utils import compress
+
+MANIFEST_MAGIC = b'FRZRSIG\x00'
+MANIFEST_VERSION = 2
+# Version 1: header, compressed JSON, signature records
+HEADER_V1_FORMAT = '<8sIIQQ'
+HEADER_FORMAT = '<8sII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+FOOTER_FORMAT = '<QQQQ8s'
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+# Size of the JSON lines compressed together
+CHUNK_SIZE = 1048576
+
+DIRECTORY = 'd'
+FILE = 'f'
+
+
+def sort_key(kind, rel_path):
+    """
+    Returns the position of an entry in the manifest.
+
+    A directory comes before its files, which come before its sub
+    directories, as in os.walk with sorted directory and file names.
+
+    :param kind: DIRECTORY or FILE
+    :param rel_path: path relative to the backup root
+    """
+    if rel_path in ('', os.curdir):
+        parts = ()
+    else:
+        parts = tuple(rel_path.split(os.sep))
+    if kind == DIRECTORY:
+        return parts, 0, ''
+    return parts[:-1], 1, parts[-1]
+
+
+def _native_path(path):
+    # JSON decodes the paths to unicode, the walk of Python 2 uses str
+    if six.PY2 and isinstance(path, six.text_type):
+        return path.encode('utf-8')
+    return path
+
+
+class ManifestWriter(object):
+    """
+    Writes a manifest entry by entry, in sort_key order.
+
+    :param checkpoint: state returned by the checkpoint method of the
+                       writer of the same file, to continue it
+    """
+
+    def __init__(self, path, compression_algo, blocksize, checkpoint=None):
+        self.path = path
+        self.compression_algo = compression_algo
+        self.blocksize = blocksize
+        self.chunks = []
+        self.lines = []
+        self.lines_size = 0
+        self.first_entry = None
+        self.last_entry = None
+        self.last_key = None
+        self.files_count = 0
+        self.directories_count = 0
+        if checkpoint:
+            self._resume(checkpoint)
+            return
+        self.fd = open(path, 'wb')
+        self.fd.write(struct.pack(
+            HEADER_FORMAT, MANIFEST_MAGIC, MANIFEST_VERSION, blocksize))
+        self.signatures = signature.SignatureWriter(
+            '{0}.signatures'.format(path))
+
+    def _resume(self, checkpoint):
+        self.fd = open(self.path, 'r+b')
+        self.fd.seek(0, os.SEEK_END)
+        if self.fd.tell() < checkpoint['offset']:
+            self.fd.close()
+            raise ValueError('Truncated manifest {0}'.format(self.path))
+        self.fd.truncate(checkpoint['offset'])
+        self.fd.seek(checkpoint['offset'])
+        try:
+            self.signatures = signature.SignatureWriter(
+                '{0}.signatures'.format(self.path), checkpoint['signatures'])
+        except (IOError, OSError, ValueError):
+            self.fd.close()
+            raise
+        self.chunks = checkpoint['chunks']
+        self.files_count = checkpoint['files']
+        self.directories_count = checkpoint['directories']
+        if checkpoint['last_entry']:
+            kind, rel_path = checkpoint['last_entry']
+            self.last_entry = [kind, _native_path(rel_path)]
+            self.last_key = sort_key(*self.last_entry)
+
+    def add(self, kind, rel_path, meta):
+        """
+        Appends an entry. The Signature of a file is moved to the
+        signature records and replaced by its reference.
+        """
+        key = sort_key(kind, rel_path)
+        if self.last_key is not None and key <= self.last_key:
+            raise ValueError(
+                'Manifest entry {0} out of order'.format(rel_path))
+        self.last_key = key
+
+        file_signature = meta.get('signature')
+        if isinstance(file_signature, signature.Signature):
+            meta['signature'] = self.signatures.add(file_signature)
+
+        if kind == DIRECTORY:
+            self.directories_count += 1
+        else:
+            self.files_count += 1
+        if self.first_entry is None:
+            self.first_entry = [kind, rel_path]
+        self.last_entry = [kind, rel_path]
+        line = json.dumps([kind, rel_path, meta]) + '\n'
+        self.lines.append(line)
+        self.lines_size += len(line)
+        if self.lines_size >= CHUNK_SIZE:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        if not self.lines:
+            return
+        data = compress.one_shot_compress(
+            self.compression_algo, ''.join(self.lines).encode('utf-8'))
+        self.chunks.append(
+            self.first_entry + [self.fd.tell(), len(data)])
+        self.fd.write(data)
+        self.lines = []
+        self.lines_size = 0
+        self.first_entry = None
+
+    def checkpoint(self):
+        """
+        Writes the entries added so far and returns the JSON serializable
+        state from which a new writer continues the file.
+        """
+        self._write_chunk()
+        self.fd.flush()
+        self.signatures.flush()
+        return {'offset': self.fd.tell(),
+                'chunks': list(self.chunks),
+                'signatures': self.signatures.count,
+                'files': self.files_count,
+                'directories': self.directories_count,
+                'last_entry': self.last_entry}
+
+    def close(self, meta):
+        """
+        Writes the remaining entries, the signature records, the index
+        and the footer.
+
+        :param meta: global meta data of the backup
+        """
+        self._write_chunk()
+        self.signatures.close()
+        records_offset = self.fd.tell()
+        with open(self.signatures.path, 'rb') as records:
+            shutil.copyfileobj(records, self.fd)
+        os.remove(self.signatures.path)
+
+        index_offset = self.fd.tell()
+        index = json.dumps({'meta': meta, 'chunks': self.chunks})
+        index = compress.one_shot_compress(
+            self.compression_algo, index.encode('utf-8'))
+        self.fd.write(index)
+        self.fd.write(struct.pack(
+            FOOTER_FORMAT, records_offset, self.signatures.count,
+            index_offset, len(index), MANIFEST_MAGIC))
+        self.fd.close()
+
+
+class ManifestReader(object):
+    """
+    Reads the entries of a manifest in sort_key order.
+
+    Entries are (kind, relative path, meta data) tuples. The signature
+    of each file is a signature.Signature reading the memory-mapped
+    records.
+
+    The compression algorithm of the manifest is detected, as the
+    previous backup may have been compressed with another algorithm
+    than compression_algo.
+    """
+
+    def __init__(self, path, compression_algo):
+        self.path = path
+        self.compression_algo = compression_algo
+        self.store = None
+        self.chunks = []
+        self.entries = None
+        self.meta = {}
+
+        with open(path, 'rb') as manifest_file:
+            header = manifest_file.read(HEADER_SIZE)
+            if (len(header) < HEADER_SIZE or
+                    not header.startswith(MANIFEST_MAGIC)):
+                self._load_json(header + manifest_file.read())
+                return
+            magic, version, blocksize = struct.unpack(HEADER_FORMAT, header)
+            if version == 1:
+                manifest_file.seek(0)
+                header = manifest_file.read(
+                    struct.calcsize(HEADER_V1_FORMAT))
+                magic, version, blocksize, meta_len, count = struct.unpack(
+                    HEADER_V1_FORMAT, header)
+                meta_data = manifest_file.read(meta_len)
+                self.store = signature.SignatureStore(
+                    path, len(header) + meta_len, count, blocksize)
+                self._load_json(meta_data)
+                return
+            if version != MANIFEST_VERSION:
+                raise ValueError(
+                    'Unsupported manifest version {0}'.format(version))
+            manifest_file.seek(-FOOTER_SIZE, os.SEEK_END)
+            (records_offset, count, index_offset, index_len,
+             magic) = struct.unpack(FOOTER_FORMAT,
+                                    manifest_file.read(FOOTER_SIZE))
+            if magic != MANIFEST_MAGIC:
+                raise ValueError('Truncated manifest {0}'.format(path))
+            manifest_file.seek(index_offset)
+            index = manifest_file.read(index_len)
+            self.compression_algo = compress.detect_compression_algo(
+                index, compression_algo)
+            index = json.loads(compress.one_shot_decompress(
+                self.compression_algo, index).decode('utf-8'))
+
+        self.meta = index['meta']
+        self.chunks = [
+            (sort_key(kind, _native_path(rel_path)), offset, length)
+            for kind, rel_path, offset, length in index['chunks']]
+        self.store = signature.SignatureStore(
+            path, records_offset, count, blocksize)
+
+    def _load_json(self, meta_data):
+        # Manifests written before the streamed format
+        self.compression_algo = compress.detect_compression_algo(
+            meta_data, self.compression_algo)
+        fs_meta_struct = json.loads(compress.one_shot_decompress(
+            self.compression_algo, meta_data).decode('utf-8'))
+        self.entries = []
+        for rel_path, file_meta in fs_meta_struct.pop('files').items():
+            self.entries.append((FILE, _native_path(rel_path), file_meta))
+        self.entries.sort(key=lambda entry: sort_key(entry[0], entry[1]))
+        # Directories were recorded with their absolute path
+        fs_meta_struct.pop('directories', None)
+        self.meta = fs_meta_struct
+
+    def _signature(self, file_meta):
+        file_signature = file_meta.get('signature')
+        if (file_signature is None or
+                isinstance(file_signature, signature.Signature)):
+            return
+        if self.store:
+            file_meta['signature'] = self.store.get(*file_signature)
+        else:
+            file_meta['signature'] = signature.Signature.from_checksums(
+                *file_signature)
+
+    def _read_chunk(self, offset, length):
+        with open(self.path, 'rb') as manifest_file:
+            manifest_file.seek(offset)
+            data = compress.one_shot_decompress(
+                self.compression_algo, manifest_file.read(length))
+        for line in data.decode('utf-8').splitlines():
+            kind, rel_path, meta = json.loads(line)
+            yield kind, _native_path(rel_path), meta
+
+    def __iter__(self):
+        if self.entries is not None:
+            entries = iter(self.entries)
+        else:
+            entries = (entry for _, offset, length in self.chunks
+                       for entry in self._read_chunk(offset, length))
+        for kind, rel_path, meta in entries:
+            if kind == FILE:
+                self._signature(meta)
+            yield kind, rel_path, meta
+
+    def lookup(self, kind, rel_path):
+        """
+        Returns the meta data of an entry or None, reading only the
+        chunk which may hold it.
+        """
+        if self.entries is not None:
+            entries = self.entries
+        else:
+            position = bisect.bisect_right(
+                [chunk[0] for chunk in self.chunks],
+                sort_key(kind, rel_path)) - 1
+            if position < 0:
+                return None
+            entries = self._read_chunk(*self.chunks[position][1:])
+        for entry_kind, entry_path, meta in entries:
+            if entry_kind == kind and entry_path == rel_path:
+                if kind == FILE:
+                    self._signature(meta)
+                return meta
+        return None
+
+    def close(self):
+        if self.store:
+            self.store.close()
+            self.store = None
+
+
+class ManifestJoin(object):
+    """
+    Reads the entries of a manifest in step with the walk of a backup.
+    """
+
+    def __init__(self, reader):
+        self.entries = iter(reader)
+        self.pending = next(self.entries, None)
+
+    def pop_before(self, key=None):
+        """
+        Yields the entries placed before key, all the remaining entries
+        if key is None.
+        """
+        while self.pending is not None and (
+                key is None or
+                sort_key(self.pending[0], self.pending[1]) < key):
+            entry = self.pending
+            self.pending = next(self.entries, None)
+            yield entry
+
+    def pop(self, kind, rel_path):
+        """
+        Returns the meta data of the given entry if it is the next one,
+        after the entries placed before it were popped.
+        """
+        key = sort_key(kind, rel_path)
+        for _ in self.pop_before(key):
+            pass
+        if (self.pending is not None and
+                sort_key(self.pending[0], self.pending[1]) == key):
+            entry = self.pending
+            self.pending = next(self.entries, None)
+            return entry[2]
+        return None
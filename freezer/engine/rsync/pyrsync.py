@@ -24,6 +24,7 @@ http://samba.anu.edu.au/rsync/.
 
 """
 
+import bisect
 import collections
 import hashlib
 
@@ -40,7 +41,7 @@ if six.PY2:
             return map(ord, var)
 
 __all__ = ["rollingchecksum", "weakchecksum", "rsyncdelta",
-           "blockchecksums"]
+           "blockchecksums", "SignatureIndex"]
 
 
 def rollingchecksum(removed, new, a, b, blocksize=4096):
@@ -85,6 +86,58 @@ def blockchecksums(instream, blocksize=4096):
     return weakhashes, stronghashes
 
 
+class SignatureIndex(object):
+    """
+    Hash index over the weak and strong hashes of a remote signature.
+
+    Every weak checksum is mapped to the ascending list of block indexes
+    that carry it, so looking up a rolling checksum costs a dictionary
+    probe instead of a scan over the whole signature. The strong hash
+    index is only built the first time a weak checksum matches.
+    """
+
+    def __init__(self, remotesignatures):
+        self.remote_weak, self.remote_strong = remotesignatures
+        self.weak_index = {}
+        for block_index, weak in enumerate(self.remote_weak):
+            self.weak_index.setdefault(weak, []).append(block_index)
+        self._strong_index = None
+
+    @property
+    def strong_index(self):
+        if self._strong_index is None:
+            self._strong_index = {}
+            for block_index, strong in enumerate(self.remote_strong):
+                self._strong_index.setdefault(strong, []).append(block_index)
+        return self._strong_index
+
+    def weak_match(self, checksum, start):
+        """
+        Returns the first block index >= start with the given weak
+        checksum, or None.
+        """
+        blocks = self.weak_index.get(checksum)
+        if not blocks:
+            return None
+        position = bisect.bisect_left(blocks, start)
+        if position == len(blocks):
+            return None
+        return blocks[position]
+
+    def strong_match(self, stronghash, start):
+        """
+        Returns the first block index >= start with the given strong
+        hash, or None.
+        """
+        blocks = self.strong_index.get(stronghash)
+        if not blocks:
+            return None
+        position = bisect.bisect_left(blocks, start)
+        if position == len(blocks):
+            return None
+        return blocks[position]
+
+
 def rsyncdelta(datastream, remotesignatures, blocksize=4096):
     """
     Generates a binary patch when supplied with the weak and strong
@@ -93,7 +146,10 @@ def rsyncdelta(datastream, remotesignatures, blocksize=4096):
     used to generate remotesignatures.
     """
 
-    remote_weak, remote_strong = remotesignatures
+    if isinstance(remotesignatures, SignatureIndex):
+        signature_index = remotesignatures
+    else:
+        signature_index = SignatureIndex(remotesignatures)
 
     match = True
     matchblock = -1
@@ -107,13 +163,18 @@ def rsyncdelta(datastream, remotesignatures, blocksize=4096):
             checksum, a, b = weakchecksum(window)
 
         try:
-            # If there are two identical weak checksums in a file, and the
-            # matching strong hash does not occur at the first match, it will
-            # be missed and the data sent over. May fix eventually, but this
-            # problem arises very rarely.
-            matchblock = remote_weak.index(checksum, matchblock + 1)
+            # Blocks are searched forward from the last match. The weak
+            # checksum lookup is a hash probe; the strong hash is only
+            # computed when the weak checksum is a hit.
+            weakblock = signature_index.weak_match(checksum, matchblock + 1)
+            if weakblock is None:
+                raise ValueError
+            matchblock = weakblock
             stronghash = hashlib.sha1(bytes(window)).hexdigest()
-            matchblock = remote_strong.index(stronghash, matchblock)
+            strongblock = signature_index.strong_match(stronghash, matchblock)
+            if strongblock is None:
+                raise ValueError
+            matchblock = strongblock
 
             match = True
             # print "MATCHBLOCK: {}".format(matchblock)
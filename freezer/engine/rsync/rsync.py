@@ -13,9 +13,14 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import getpass
+import base64
+import collections
+import functools
 import grp
+import itertools
 import json
+import multiprocessing
+from multiprocessing import pool
 import os
 import pwd
 import Queue
@@ -25,12 +30,19 @@ import sys
 import threading
 
 from oslo_log import log
-from six.moves import cStringIO
 
 from freezer.engine import engine
-from freezer.engine.rsync import pyrsync
+from freezer.engine.rsync import collapse
+from freezer.engine.rsync import fastrsync
+from freezer.engine.rsync import manifest
+from freezer.engine.rsync import signature
+from freezer.engine.rsync import stream
+from freezer.engine.rsync import writers
+from freezer.exceptions import engine as engine_exceptions
+from freezer.storage import base
 from freezer.utils import compress
 from freezer.utils import crypt
+from freezer.utils import frames
 from freezer.utils import winutils
 
 LOG = log.getLogger(__name__)
@@ -41,8 +53,28 @@ RSYNC_BLOCK_SIZE = 4096
 RSYNC_DATA_STRUCT_VERSION = 1
 # Rsync main block size for streams, 32MB (1024*1024*32)
 RSYNC_BLOCK_BUFF_SIZE = 33554432
+# Above this ratio of changed blocks at the same offsets, the rolling
+# search is used as data was likely inserted or removed
+RSYNC_ALIGNED_MAX_CHANGED_RATIO = 0.5
 # Files type where file data content can be backed up or restored
 REG_FILE = ('r', 'u')
+# Number of files scanned ahead of the stream by each worker
+RSYNC_SCAN_AHEAD = 8
+# Minimum number of segments of the backup stream between two
+# checkpoints of a journaled backup
+RSYNC_CHECKPOINT_SEGMENTS = 4
+# Maximum size of a zstd dictionary, and samples of the tree it is
+# trained from: number of files, total size and largest file sampled
+# with its data
+RSYNC_DICTIONARY_SIZE = 32768
+RSYNC_DICTIONARY_SAMPLES = 4000
+RSYNC_DICTIONARY_SAMPLES_SIZE = 3145728
+RSYNC_DICTIONARY_SMALL_FILE = 16384
+
+
+def scan_file(args):
+    """Entry point of the scan workers, see RsyncEngine.scan_file."""
+    return RsyncEngine.scan_file(*args)
 
 
 class RsyncEngine(engine.BackupEngine):
@@ -50,8 +82,17 @@ class RsyncEngine(engine.BackupEngine):
     def __init__(
             self, compression, symlinks, exclude, storage,
             max_segment_size, encrypt_key=None,
-            dry_run=False):
+            dry_run=False, rsync_workers=1, compress_workers=1,
+            frame_size=0, compression_level=None,
+            min_compression_level=None, adaptive_compression=False,
+            compression_dictionary=False, **kwargs):
         self.compression_algo = compression
+        # Compression level of the backup stream, None for the default
+        # level of the algorithm
+        self.compression_level = compression_level
+        if compression_level is not None:
+            self.compression_level = compress.get_compression_level(
+                compression, compression_level)
         self.encrypt_pass_file = encrypt_key
         self.dereference_symlink = symlinks
         self.exclude = exclude
@@ -59,23 +100,108 @@ class RsyncEngine(engine.BackupEngine):
         self.is_windows = winutils.is_windows()
         self.dry_run = dry_run
         self.max_segment_size = max_segment_size
+        # Number of processes computing the signatures and deltas on
+        # backup, of threads writing the files on restore
+        self.rsync_workers = max(1, int(rsync_workers or 1))
+        # Number of threads compressing the backup stream, by blocks
+        # compressed separately when more than one, except zstd streams
+        # compressed on the threads of the zstd compressor
+        self.compress_workers = max(1, int(compress_workers or 1))
+        # Lowest level of the compression of the blocks while they hold
+        # up the backup stream, see compress.ParallelCompressor
+        self.min_compression_level = min_compression_level
+        # Size of the data of the frames of a framed backup stream, 0 for
+        # a continuous stream, see freezer.utils.frames
+        self.frame_size = int(frame_size or 0)
+        # Whether the frames which do not compress are stored raw, in a
+        # framed stream
+        self.adaptive_compression = adaptive_compression
+        if adaptive_compression and not self.frame_size:
+            self.frame_size = compress.ParallelCompressor.BLOCK_SIZE
+        # Size of the data stored raw and compressed by the last backup
+        self.compression_stats = None
+        # Whether level zero backups train a zstd dictionary compressing
+        # the backups of their chain
+        self.compression_dictionary = compression_dictionary
+        if compression_dictionary and compression != 'zstd':
+            raise ValueError('Compression dictionaries need zstd '
+                             'compression')
+        # Content of the dictionary of the backup in progress, and its
+        # record in the manifest: id, content encoded in base64 and
+        # whether the backup trained it
+        self.dictionary = None
+        self.dictionary_record = None
+        # Dictionaries of the restored backups by id
+        self.dictionaries = {}
         # Compression and encryption objects
         self.compressor = None
         self.cipher = None
-        super(RsyncEngine, self).__init__(storage=storage)
+        # Inode fields of the restored files, set once the last level is
+        # restored
+        self.inodes = None
+        # Pool of the scan workers during a backup
+        self.scan_pool = None
+        # Pool of the compression threads during a backup
+        self.compress_pool = None
+        # Size of the backup stream since the last checkpoint
+        self.stream_size = 0
+        # Manifest key of the last entry written before the checkpoint
+        # of a resumed backup
+        self.resumed_key = None
+        super(RsyncEngine, self).__init__(storage=storage, **kwargs)
 
     @property
     def name(self):
         return "rsync"
 
     def metadata(self):
-        return {
+        metadata = {
             "engine_name": self.name,
             "compression": self.compression_algo,
             # the encrypt_pass_file might be key content so we need to convert
             # to boolean
-            "encryption": bool(self.encrypt_pass_file)
+            "encryption": bool(self.encrypt_pass_file),
+            "rsync_stream_version": stream.STREAM_VERSION
         }
+        if self.frame_size:
+            metadata["frame_version"] = frames.FRAME_VERSION
+        return metadata
+
+    def backup_metadata(self):
+        metadata = self.metadata()
+        if self.compression_stats:
+            metadata["compression_stats"] = self.compression_stats
+        if self.dictionary_record:
+            # The level zero backup holds the dictionary of its chain
+            record = self.dictionary_record
+            metadata["compression_dictionary"] = (
+                {'id': record['id'], 'data': record['data']}
+                if record['trained'] else {'id': record['id']})
+        return metadata
+
+    def backup(self, backup_resource, *args, **kwargs):
+        """Back up as BackupEngine.backup does. With more than one rsync
+        worker, the pool of the scan workers is forked first, before the
+        threads of the backup start and may hold a lock a forked worker
+        would inherit.
+        """
+
+        if (self.scan_pool is not None or self.rsync_workers <= 1 or
+                not os.path.isdir(backup_resource)):
+            return super(RsyncEngine, self).backup(
+                backup_resource, *args, **kwargs)
+        # The workers open the paths relative to the backed up directory,
+        # as get_sign_delta does
+        self.scan_pool = multiprocessing.Pool(
+            self.rsync_workers, os.chdir,
+            (os.path.abspath(backup_resource),))
+        try:
+            return super(RsyncEngine, self).backup(
+                backup_resource, *args, **kwargs)
+        finally:
+            self.scan_pool.terminate()
+            self.scan_pool.join()
+            self.scan_pool = None
 
     def backup_data(self, backup_resource, manifest_path):
         """Execute backup using rsync algorithm.
@@ -83,6 +209,22 @@ class RsyncEngine(engine.BackupEngine):
         If an existing rsync meta data is available the backup
         will be incremental, otherwise will be executed a level 0 backup
 
+        With a journal, the stream is checkpointed after a file once
+        RSYNC_CHECKPOINT_SEGMENTS segments were produced: the
+        compressed stream ends, the manifest is written up to the file
+        and the state of the engine is recorded. A resumed backup starts
+        a new compressed stream after the files of its checkpoint.
+
+        With a frame size, the stream is a framed stream encoded on
+        compress_workers threads, see freezer.utils.frames, and a
+        checkpoint ends the current frame. With adaptive compression,
+        the frames which do not compress are stored raw, and the size of
+        the data stored raw and compressed is recorded in the backup
+        metadata.
+
+        With a compression dictionary, see load_dictionary, each zstd
+        stream or frame is compressed with the dictionary of the chain.
+
         :param backup_resource:
         :param manifest_path:
         :return:
@@ -96,18 +238,61 @@ class RsyncEngine(engine.BackupEngine):
             'Recursively archiving and compressing files from {}'.format(
                 os.getcwd()))
 
-        self.compressor = compress.Compressor(self.compression_algo)
-
-        if self.encrypt_pass_file:
+        if self.frame_size or (self.compress_workers > 1 and
+                               self.compression_algo != 'zstd'):
+            self.compress_pool = pool.ThreadPool(self.compress_workers)
+        if (self.encrypt_pass_file and self.compress_workers > 1 and
+                not self.frame_size):
+            LOG.info('The backup stream is encrypted on a single thread, '
+                     'the frames of a framed stream are encrypted on the '
+                     'compression threads')
+        self.cipher = None
+        self.compression_stats = None
+        self.stream_size = 0
+        segments = 0
+        resumed = None
+        manifest_writer = None
+        if self.journal:
+            segments = len(self.journal.resumed_segments)
+            resumed = self.journal.resumed_state
+        self.load_dictionary(backup_resource, manifest_path)
+        if resumed:
+            try:
+                manifest_writer = manifest.ManifestWriter(
+                    '{0}.new'.format(manifest_path), self.compression_algo,
+                    RSYNC_BLOCK_SIZE, resumed['manifest'])
+            except (IOError, OSError, ValueError) as e:
+                raise engine_exceptions.ResumeException(
+                    'Cannot continue the manifest: {0}'.format(e))
+
+        if self.frame_size:
+            # The frames are encrypted by the encoder
+            self.compressor = frames.FrameEncoder(
+                self.compression_algo, self.compress_pool,
+                self.compress_workers, self.frame_size,
+                self.encrypt_pass_file, resumed and resumed['frames'],
+                self.compression_level, self.min_compression_level,
+                self.adaptive_compression, self.dictionary)
+            if not resumed:
+                data_chunk += self.compressor.header()
+        elif self.encrypt_pass_file and resumed:
+            self.compressor = self.new_compressor()
+            self.cipher = crypt.AESEncrypt(self.encrypt_pass_file,
+                                           resumed['cipher'])
+        elif self.encrypt_pass_file:
+            self.compressor = self.new_compressor()
             self.cipher = crypt.AESEncrypt(self.encrypt_pass_file)
             data_chunk += self.cipher.generate_header()
+        else:
+            self.compressor = self.new_compressor()
 
         rsync_queue = Queue.Queue(maxsize=2)
 
         t_get_sign_delta = threading.Thread(
             target=self.get_sign_delta,
             args=(
-                backup_resource, manifest_path, rsync_queue))
+                backup_resource, manifest_path, rsync_queue,
+                manifest_writer))
         t_get_sign_delta.daemon = True
 
         t_get_sign_delta.start()
@@ -117,6 +302,16 @@ class RsyncEngine(engine.BackupEngine):
 
             if file_block is False:
                 break
+            if isinstance(file_block, dict):
+                # The segments up to here hold the stream of the
+                # checkpoint
+                if data_chunk:
+                    yield data_chunk
+                    segments += 1
+                    data_chunk = b''
+                    file_read_limit = 0
+                self.journal.add_checkpoint(segments, file_block)
+                continue
             if len(file_block) == 0:
                 continue
 
@@ -124,6 +319,7 @@ class RsyncEngine(engine.BackupEngine):
             file_read_limit += len(file_block)
             if file_read_limit >= self.max_segment_size:
                 yield data_chunk
+                segments += 1
                 data_chunk = b''
                 file_read_limit = 0
 
@@ -133,12 +329,170 @@ class RsyncEngine(engine.BackupEngine):
 
         # Rejoining thread
         t_get_sign_delta.join()
+        if self.frame_size:
+            self.compression_stats = dict(self.compressor.stats)
+            LOG.info('Backup data stored raw: {raw_bytes} bytes, '
+                     'compressed: {compressed_bytes} bytes in '
+                     '{compressed_size} bytes'.format(
+                         **self.compression_stats))
+        if self.compress_pool:
+            self.compress_pool.close()
+            self.compress_pool = None
+
+    def new_compressor(self):
+        """Create the compressor of the backup stream, compressing on the
+        threads of compress_pool if any, or on compress_workers threads
+        of the zstd compressor.
+
+        :return: a compress.Compressor
+        """
+        if self.compress_pool:
+            return compress.ParallelCompressor(
+                self.compression_algo, self.compress_pool,
+                self.compress_workers, level=self.compression_level,
+                min_level=self.min_compression_level,
+                dictionary=self.dictionary)
+        threads = self.compress_workers if self.compress_workers > 1 else 0
+        return compress.Compressor(self.compression_algo,
+                                   self.compression_level, threads,
+                                   self.dictionary)
+
+    def load_dictionary(self, fs_path, manifest_path):
+        """Set up the zstd dictionary of a backup with compression
+        dictionaries. A level zero backup trains a dictionary on a sample
+        of the tree, recorded in the manifests and in its metadata, and
+        the increments of its chain compress with the dictionary
+        recorded in the manifest of the previous backup.
+
+        :param fs_path: path of the backup
+        :param manifest_path: path of the manifest of the previous backup
+        """
+        self.dictionary = None
+        self.dictionary_record = None
+        if not self.compression_dictionary:
+            return
+        old_manifest = self.get_fs_meta_struct(manifest_path)
+        if old_manifest:
+            record = old_manifest.meta.get('compression_dictionary')
+            old_manifest.close()
+            if not record:
+                # The chain started without dictionary
+                return
+            record = dict(record, trained=False)
+        else:
+            record = self.train_dictionary(
+                fs_path, '{0}.dictionary'.format(manifest_path))
+            if not record:
+                return
+        self.dictionary_record = record
+        self.dictionary = base64.b64decode(record['data'])
+
+    def train_dictionary(self, fs_path, record_path):
+        """Train a zstd dictionary on the headers of the files of a tree,
+        followed by the data of the small ones, as they are in the
+        backup stream. The dictionary is kept in record_path, from which
+        a resumed backup reads it.
+
+        :param fs_path: path of the backup
+        :param record_path: path of the record of the dictionary
+        :return: the record of the dictionary, None if it cannot be
+                 trained
+        """
+        if os.path.exists(record_path):
+            with open(record_path) as record_file:
+                return json.load(record_file)
+        record = None
+        if os.path.isdir(fs_path):
+            samples = list(itertools.islice(
+                self.dictionary_samples(fs_path), RSYNC_DICTIONARY_SAMPLES))
+            try:
+                dictionary_id, content = compress.train_dictionary(
+                    samples, RSYNC_DICTIONARY_SIZE)
+                record = {'id': dictionary_id,
+                          'data': base64.b64encode(content).decode('ascii'),
+                          'trained': True}
+                LOG.info('Trained the compression dictionary {0} from {1} '
+                         'files'.format(dictionary_id, len(samples)))
+            except ValueError as e:
+                LOG.warning('{0}, the backups of the chain are compressed '
+                            'without dictionary'.format(e))
+        with open(record_path, 'w') as record_file:
+            json.dump(record, record_file)
+        return record
+
+    def dictionary_samples(self, fs_path):
+        """Generate the records of the files of a tree to train a
+        dictionary from, up to RSYNC_DICTIONARY_SAMPLES_SIZE bytes.
+
+        :param fs_path: path of the backup
+        :return: generator of binary strings
+        """
+        size = 0
+        for root, dirs, files in os.walk(fs_path):
+            dirs.sort()
+            for name in sorted(files):
+                if self.exclude and self.exclude in name:
+                    continue
+                file_path = os.path.join(root, name)
+                try:
+                    file_struct = self.get_file_struct(file_path)
+                    if not file_struct:
+                        continue
+                    inode = file_struct['inode']
+                    data = b''
+                    if (self.is_reg_file(inode['ftype']) and
+                            inode['size'] <= RSYNC_DICTIONARY_SMALL_FILE):
+                        with open(file_path, 'rb') as file_path_fd:
+                            data = file_path_fd.read(
+                                RSYNC_DICTIONARY_SMALL_FILE)
+                except Exception as e:
+                    LOG.debug('Cannot sample {0}: {1}'.format(file_path, e))
+                    continue
+                sample = stream.pack_header(
+                    os.path.relpath(file_path, fs_path), inode,
+                    len(data)) + data
+                size += len(sample)
+                yield sample
+                if size >= RSYNC_DICTIONARY_SAMPLES_SIZE:
+                    return
+
+    def restore_dictionary(self, metadata, backup):
+        """Get the zstd dictionary of a backup, recorded in the metadata
+        of the level zero backup of its chain.
+
+        :param metadata: metadata of the backup
+        :type backup: freezer.storage.base.Backup
+        :return: the content of the dictionary, None if the backup was
+                 compressed without dictionary
+        """
+        record = metadata.get('compression_dictionary')
+        if not record:
+            return None
+        if record['id'] not in self.dictionaries:
+            if 'data' not in record:
+                level_zero = base.Backup(
+                    engine=self,
+                    hostname_backup_name=backup.hostname_backup_name,
+                    level_zero_timestamp=backup.level_zero_timestamp,
+                    timestamp=backup.level_zero_timestamp,
+                    level=0,
+                    storage=backup.storage)
+                level_zero_record = level_zero.metadata().get(
+                    'compression_dictionary') or {}
+                if level_zero_record.get('id') != record['id']:
+                    raise Exception(
+                        'Missing compression dictionary {0}'.format(
+                            record['id']))
+                record = level_zero_record
+            self.dictionaries[record['id']] = base64.b64decode(record['data'])
+        return self.dictionaries[record['id']]
 
     def restore_level(self, restore_resource, read_pipe, backup, except_queue):
         """Restore the provided file into restore_abs_path.
 
         Decrypt the file if backup_opt_dict.encrypt_pass_file key is provided.
-        Freezer rsync header data structure:
+        Backups without rsync_stream_version in their metadata have a
+        version 1 stream, with the following header data structure:
 
             header_len, RSYNC_DATA_STRUCT_VERSION, file_mode,
             os_stat.st_uid, os_stat.st_gid, os_stat.st_size,
@@ -150,15 +504,13 @@ class RsyncEngine(engine.BackupEngine):
         :param except_queue:
         :return:
         """
-        try:
-            metadata = backup.metadata()
-            if (not self.encrypt_pass_file and
-                    metadata.get("encryption", False)):
-                raise Exception("Cannot restore encrypted backup without key")
-
-            self.compression_algo = metadata.get('compression',
-                                                 self.compression_algo)
+        if self.inodes is None:
+            # A level restored on its own, not by restore_levels
+            self.restore_levels(restore_resource, [read_pipe], [backup],
+                                except_queue)
+            return
 
+        try:
             if not os.path.exists(restore_resource):
                 raise ValueError(
                     'Provided restore path does not exist: {0}'.format(
@@ -167,16 +519,16 @@ class RsyncEngine(engine.BackupEngine):
             if self.dry_run:
                 restore_resource = '/dev/null'
 
-            raw_data_chunk = read_pipe.recv_bytes()
+            metadata, data_chunk = self.start_restore_stream(read_pipe,
+                                                             backup)
 
-            self.compressor = compress.Decompressor(self.compression_algo)
-
-            if self.encrypt_pass_file:
-                self.cipher = crypt.AESDecrypt(self.encrypt_pass_file,
-                                               raw_data_chunk[:16])
-                raw_data_chunk = raw_data_chunk[16:]
-
-            data_chunk = self.process_restore_data(raw_data_chunk)
+            if metadata.get('rsync_stream_version', 1) > 1:
+                reader = stream.StreamReader(
+                    functools.partial(
+                        next, self.gen_restore_data(read_pipe), b''),
+                    data_chunk)
+                self.restore_records(reader, restore_resource, backup.level)
+                return
 
             header_str = r'^(\d{1,})\00'
             flushed = False
@@ -184,8 +536,7 @@ class RsyncEngine(engine.BackupEngine):
                 header_match = re.search(header_str, data_chunk)
                 if not header_match and not flushed:
                     try:
-                        data_chunk += self.process_restore_data(
-                            read_pipe.recv_bytes())
+                        data_chunk += self.recv_restore_data(read_pipe)
                         continue
                     except EOFError:
                         LOG.info("EOFError: Pipe closed. Flushing buffer...")
@@ -196,8 +547,7 @@ class RsyncEngine(engine.BackupEngine):
                     header_len = int(header_match.group(1))
                     if header_len > len(data_chunk) and not flushed:
                         try:
-                            data_chunk += self.process_restore_data(
-                                read_pipe.recv_bytes())
+                            data_chunk += self.recv_restore_data(read_pipe)
                         except EOFError:
                             LOG.info("[*] End of File: Pipe closed. "
                                      "Flushing the buffer.")
@@ -218,79 +568,399 @@ class RsyncEngine(engine.BackupEngine):
             except_queue.put(e)
             raise
 
+    def restore_levels(self, restore_resource, read_pipes, backups,
+                       except_queue):
+        """Restore the levels one after the other, see
+        BackupEngine.restore_levels. The inode fields of the restored
+        files are set once the last level is restored.
+        """
+
+        self.inodes = writers.InodeSetter()
+        try:
+            super(RsyncEngine, self).restore_levels(
+                restore_resource, read_pipes, backups, except_queue)
+            self.inodes.apply_deferred()
+        finally:
+            self.inodes = None
+
+    def start_restore_stream(self, read_pipe, backup):
+        """Set up the decompression and decryption of a backup stream.
+
+        :param read_pipe: pipe to receive the backup stream from
+        :param backup: restored backup
+        :return: the backup metadata and the first chunk of data
+        """
+
+        metadata = backup.metadata()
+        if (not self.encrypt_pass_file and
+                metadata.get("encryption", False)):
+            raise Exception("Cannot restore encrypted backup without key")
+
+        self.compression_algo = metadata.get('compression',
+                                             self.compression_algo)
+
+        raw_data_chunk = read_pipe.recv_bytes()
+
+        self.cipher = None
+        dictionary = self.restore_dictionary(metadata, backup)
+        if metadata.get('frame_version'):
+            # The frames are decoded on compress_workers threads
+            self.compressor = frames.FrameDecoder(
+                self.compression_algo, self.compress_workers,
+                self.encrypt_pass_file, dictionary)
+            return metadata, self.process_restore_data(raw_data_chunk)
+
+        if self.encrypt_pass_file:
+            self.cipher = crypt.AESDecrypt(self.encrypt_pass_file,
+                                           raw_data_chunk[:16])
+            raw_data_chunk = self.cipher.decrypt(raw_data_chunk[16:])
+
+        if 'compression' not in metadata:
+            # Metadata written before the compression was recorded
+            self.compression_algo = compress.detect_compression_algo(
+                raw_data_chunk, self.compression_algo)
+        self.compressor = compress.Decompressor(self.compression_algo,
+                                                dictionary)
+        return metadata, self.compressor.decompress(raw_data_chunk)
+
+    def restore_backups(self, restore_resource, backups):
+        """Restore the levels of a backup in a single pass when they all
+        have a version 2 stream, see collapse.CollapsedRestore.
+
+        :param restore_resource: restore path
+        :param backups: backups sorted by level
+        """
+
+        if (self.dry_run or len(backups) < 2 or
+                any(backup.metadata().get('rsync_stream_version', 1) < 2
+                    for backup in backups)):
+            super(RsyncEngine, self).restore_backups(restore_resource,
+                                                     backups)
+            return
+
+        LOG.info("Restoring levels {0} to 0 in a single pass".format(
+            backups[-1].level))
+        self.stream_backups(restore_resource, list(reversed(backups)),
+                            self.restore_collapsed)
+
+    def restore_collapsed(self, restore_resource, read_pipes, backups,
+                          except_queue):
+        """Restore the version 2 streams of the levels of a backup, from
+        the newest level to level 0.
+
+        :param restore_resource: restore path
+        :param read_pipes: pipes to receive the backup streams from
+        :param backups: backups sorted from the newest level
+        :param except_queue:
+        """
+
+        try:
+            if not os.path.exists(restore_resource):
+                raise ValueError(
+                    'Provided restore path does not exist: {0}'.format(
+                        restore_resource))
+
+            collapsed = collapse.CollapsedRestore(
+                self, restore_resource, RSYNC_BLOCK_SIZE, self.rsync_workers)
+            try:
+                for read_pipe, backup in zip(read_pipes, backups):
+                    LOG.info("Restoring from level {0}".format(backup.level))
+                    _, data_chunk = self.start_restore_stream(read_pipe,
+                                                              backup)
+                    reader = stream.StreamReader(
+                        functools.partial(
+                            next, self.gen_restore_data(read_pipe), b''),
+                        data_chunk)
+                    collapsed.restore(reader, backup.level)
+            finally:
+                collapsed.close()
+        except Exception as e:
+            LOG.exception(e)
+            except_queue.put(e)
+            raise
+
+    def gen_restore_data(self, read_pipe):
+        """Generate the decrypted and decompressed data received from the
+        pipe, up to the end of the stream.
+
+        :param read_pipe: pipe to receive the backup stream from
+        :return: generator of binary strings
+        """
+
+        while True:
+            try:
+                data = self.recv_restore_data(read_pipe)
+            except EOFError:
+                LOG.info("[*] EOF from pipe. Flushing buffer.")
+                break
+            if data:
+                yield data
+        data = self.compressor.flush()
+        if data:
+            yield data
+
+    def restore_records(self, reader, restore_abs_path,
+                        current_backup_level):
+        """Restore the records of a version 2 stream.
+
+        With more than one rsync worker, the regular files are written
+        by a pool of threads. The inode fields of the files are deferred
+        to the end of the restore, see restore_levels.
+
+        :param reader: stream.StreamReader on the backup stream
+        :param restore_abs_path: restore path
+        :param current_backup_level: level of the restored backup
+        """
+
+        file_writers = None
+        if self.rsync_workers > 1:
+            file_writers = writers.FileWriters(self.rsync_workers)
+
+        try:
+            for header in iter(reader.next_header, None):
+                file_abs_path = '{0}/{1}'.format(restore_abs_path,
+                                                 header.path)
+                if self.remove_file(file_abs_path, current_backup_level,
+                                    header.deleted):
+                    self.inodes.discard(file_abs_path)
+                    continue
+
+                if header.ftype in REG_FILE:
+                    writes = self.gen_record_writes(header, reader)
+                    if file_writers:
+                        file_writers.write(file_abs_path, header.incremental,
+                                           header.size, writes)
+                    else:
+                        writers.write_file(file_abs_path, header.incremental,
+                                           header.size, writes)
+                else:
+                    self.make_special_file(
+                        header.ftype, file_abs_path, header.mode,
+                        header.lname, header.devmajor, header.devminor)
+
+                if header.ftype == 'l':
+                    self.inodes.discard(file_abs_path)
+                else:
+                    self.inodes.defer(file_abs_path, header.uname,
+                                      header.gname, header.mode,
+                                      header.mtime)
+        finally:
+            if file_writers:
+                file_writers.close()
+
+    @staticmethod
+    def gen_record_writes(header, reader):
+        """Generate the writes of the data of a file record.
+
+        :param header: stream.Header of the record
+        :param reader: stream.StreamReader positioned on the record data
+        :return: generator of (offset, data), offset is None when the
+                 data follows the previous one
+        """
+
+        if not header.incremental:
+            for data in reader.iter_data():
+                yield None, data
+            return
+
+        position = None
+        for block_index in reader.read_block_indexes():
+            offset = block_index * RSYNC_BLOCK_SIZE
+            block_len = max(0, min(RSYNC_BLOCK_SIZE, header.size - offset))
+            for data in reader.iter_data(block_len):
+                yield (offset if offset != position else None), data
+                position = offset = offset + len(data)
+
     def process_backup_data(self, data, do_compress=True):
         """Compresses and encrypts provided data according to args"""
 
         if do_compress:
             data = self.compressor.compress(data)
 
-        if self.encrypt_pass_file:
+        if self.cipher:
             data = self.cipher.encrypt(data)
+        self.stream_size += len(data)
         return data
 
     def process_restore_data(self, data):
         """Decrypts and decompresses provided data according to args"""
 
-        if self.encrypt_pass_file:
+        if self.cipher:
             data = self.cipher.decrypt(data)
 
         data = self.compressor.decompress(data)
         return data
 
+    def recv_restore_data(self, read_pipe):
+        """Receive the next chunk of the backup stream, decrypted and
+        decompressed.
+
+        A compressed stream is decompressed from the ring buffer slot in
+        place. The chunks of encrypted and framed streams are copied out
+        of the ring: the ciphers do not read the views of Python 2, and
+        the frames decoder keeps the end of a chunk until its frame is
+        complete.
+
+        :param read_pipe: ring buffer to receive the backup stream from
+        :return: the data of the chunk
+        """
+
+        if self.cipher or isinstance(self.compressor, frames.FrameDecoder):
+            return self.process_restore_data(read_pipe.recv_bytes())
+        return self.process_restore_data(read_pipe.recv_view())
+
     @staticmethod
-    def rsync_gen_delta(file_path_fd, old_file_meta):
+    def rsync_gen_delta(file_path_fd, old_file_meta, file_size):
         """Get rsync delta for file descriptor provided as arg.
 
         :param file_path_fd:
         :param old_file_meta:
+        :param file_size: size of the file recorded in its header
         :return:
         """
 
         if not old_file_meta:
             raise StopIteration
 
+        modified_blocks = RsyncEngine.rsync_changed_blocks(
+            file_path_fd, old_file_meta, file_size)
+        for data_block in RsyncEngine.gen_changed_blocks(
+                file_path_fd, modified_blocks, file_size):
+            yield data_block
+
+    @staticmethod
+    def rsync_changed_blocks(file_path_fd, old_file_meta, file_size):
+        """Get the indexes of the changed blocks of a file with the
+        rolling search.
+
+        The rolling search output is mapped back to the blocks of the
+        new file: a block is unchanged only if it matched the old block
+        with the same content at the same offset, as the restore writes
+        the changed blocks in place.
+
+        :param file_path_fd:
+        :param old_file_meta:
+        :param file_size: size of the file recorded in its header
+        :return: the sorted list of changed block indexes
+        """
+
         # If the ctime or mtime has changed, the delta is computed
         # data block is returned
 
-        len_deltas = 0
         old_signature = old_file_meta['signature']
+        old_size = old_file_meta['inode']['size']
         # Get changed blocks index only
-        all_changed_indexes = cStringIO()
         file_path_fd.seek(0)
-        previous_index = -1
-        modified_blocks = []
-        for block_index in pyrsync.rsyncdelta(
-                file_path_fd,
-                (old_signature[0], old_signature[1]),
-                RSYNC_BLOCK_SIZE):
+        modified_blocks = set()
+        offset = 0
+        for block_index in fastrsync.rsyncdelta(
+                file_path_fd, old_signature, RSYNC_BLOCK_SIZE):
+
+            if isinstance(block_index, int):
+                data_len = min(RSYNC_BLOCK_SIZE,
+                               old_size - block_index * RSYNC_BLOCK_SIZE)
+                new_index, position = divmod(offset, RSYNC_BLOCK_SIZE)
+                if (not position and new_index < old_signature.count and
+                        old_signature.record(new_index) ==
+                        old_signature.record(block_index)):
+                    offset += data_len
+                    continue
+            else:
+                data_len = len(block_index)
+            if data_len:
+                modified_blocks.update(range(
+                    offset // RSYNC_BLOCK_SIZE,
+                    (offset + data_len - 1) // RSYNC_BLOCK_SIZE + 1))
+            offset += data_len
+
+        # The data left pending at the end of the rolling search is
+        # not part of the delta: consider the remaining blocks changed
+        blocks_count = -(-file_size // RSYNC_BLOCK_SIZE)
+        modified_blocks.update(range(
+            min(offset, file_size) // RSYNC_BLOCK_SIZE, blocks_count))
+        return sorted(block_index for block_index in modified_blocks
+                      if block_index < blocks_count)
 
-            previous_index += 1
+    @staticmethod
+    def aligned_changed_blocks(old_file_meta, file_meta):
+        """Compare the signature of each block with the one of the
+        block at the same offset in the previous backup.
 
-            if not isinstance(block_index, int):
-                len_deltas += len(block_index)
-                all_changed_indexes.write(b'\00{}'.format(previous_index))
-                modified_blocks.append(previous_index)
+        In place overwrites (database files, disk images) are detected
+        without the rolling search. When the size changed or too many
+        blocks differ, data was probably inserted or removed and None is
+        returned so the rolling search is used instead.
 
-        # Yield the total length data changed blocks
+        :param old_file_meta: meta data of the previous backup execution
+        :param file_meta: meta data of the current backup execution,
+                          including the new signature
+        :return: the sorted list of changed block indexes or None
+        """
 
-        yield b'\00' + str(len_deltas)
-        previous_index_str = all_changed_indexes.getvalue() + b'\00'
-        len_previous_index_str = len(previous_index_str) + 1
-        # Yield the length of the string that contain all the indexes
+        if old_file_meta['inode']['size'] != file_meta['inode']['size']:
+            return None
 
-        yield b'\00' + str(len_previous_index_str) + b'\00'
-        # Yield string containing all the indexes separated by \00
+        old_signature = old_file_meta['signature']
+        new_signature = file_meta['signature']
+        if old_signature.count != new_signature.count:
+            return None
 
-        yield previous_index_str
+        modified_blocks = new_signature.changed_blocks(old_signature)
+        if (len(modified_blocks) >
+                new_signature.count * RSYNC_ALIGNED_MAX_CHANGED_RATIO):
+            return None
 
-        # Get blocks of changed data
-        file_path_fd.seek(0)
-        for block_index in modified_blocks:
-            offset = block_index * RSYNC_BLOCK_SIZE
-            file_path_fd.seek(offset)
-            data_block = file_path_fd.read(RSYNC_BLOCK_SIZE)
+        return modified_blocks
 
-            yield data_block
+    @staticmethod
+    def gen_changed_blocks(file_path_fd, modified_blocks, file_size):
+        """Generate the incremental data of a file from the indexes of
+        its changed blocks.
+
+        The data holds the indexes of the changed blocks followed by
+        their content (see stream). The length of each block is deduced
+        from the file size on restore, so the data is padded or cut to
+        match file_size. Consecutive blocks are read together.
+
+        :param file_path_fd: file descriptor of the new file
+        :param modified_blocks: sorted list of changed block indexes
+        :param file_size: size of the file recorded in its header
+        :return: generator of binary strings
+        """
+
+        yield stream.pack_block_indexes(modified_blocks)
+
+        run_start = run_end = None
+        for block_index in modified_blocks + [None]:
+            if (block_index is not None and block_index == run_end and
+                    (run_end - run_start) * RSYNC_BLOCK_SIZE <
+                    RSYNC_BLOCK_BUFF_SIZE):
+                run_end += 1
+                continue
+            if run_start is not None:
+                offset = run_start * RSYNC_BLOCK_SIZE
+                run_len = max(0, min(run_end * RSYNC_BLOCK_SIZE,
+                                     file_size) - offset)
+                if run_len:
+                    file_path_fd.seek(offset)
+                    data_block = file_path_fd.read(run_len)
+                    yield data_block + b'\00' * (run_len - len(data_block))
+            if block_index is not None:
+                run_start, run_end = block_index, block_index + 1
+
+    @staticmethod
+    def changed_blocks_len(modified_blocks, file_size):
+        """Get the length of the incremental data of a file.
+
+        :param modified_blocks: sorted list of changed block indexes
+        :param file_size: size of the file recorded in its header
+        :return: the length of the data generated by gen_changed_blocks
+        """
+
+        return stream.block_indexes_size(len(modified_blocks)) + sum(
+            max(0, min(RSYNC_BLOCK_SIZE,
+                       file_size - block_index * RSYNC_BLOCK_SIZE))
+            for block_index in modified_blocks)
 
     @staticmethod
     def is_file_modified(old_file_meta, file_meta):
@@ -325,8 +995,7 @@ class RsyncEngine(engine.BackupEngine):
             size -= written_data
             if size > 0 and not flushed:
                 try:
-                    data_chunk += self.process_restore_data(
-                        read_pipe.recv_bytes())
+                    data_chunk += self.recv_restore_data(read_pipe)
                 except EOFError:
                     LOG.info(
                         "[*] EOF from pipe. Flushing buffer.")
@@ -337,7 +1006,28 @@ class RsyncEngine(engine.BackupEngine):
                 break
         return data_chunk
 
-    def write_changes_in_file(self, fd_curr_file, data_chunk, read_pipe):
+    def read_restore_chunk(self, data_chunk, read_pipe, size):
+        """Receive data from the pipe until data_chunk holds at least
+        size bytes or the stream ends.
+
+        :param data_chunk: data already received
+        :param read_pipe: pipe to receive the backup stream from
+        :param size: number of bytes needed
+        :return: data_chunk extended with the received data
+        """
+
+        while len(data_chunk) < size:
+            try:
+                data_chunk += self.recv_restore_data(read_pipe)
+            except EOFError:
+                LOG.info(
+                    "[*] EOF from pipe. Flushing buffer.")
+                data_chunk += self.compressor.flush()
+                break
+        return data_chunk
+
+    def write_changes_in_file(self, fd_curr_file, size, data_chunk,
+                              read_pipe):
         # Searching for:
         # - the block incremental header string
         # - len of all the changed blocks
@@ -346,36 +1036,27 @@ class RsyncEngine(engine.BackupEngine):
 
         if offset_match:
             offset_size = len(offset_match.group(1))
-            len_deltas = int(offset_match.group(2))
             len_offset_str = int(offset_match.group(3)) - 1
 
-            no_of_blocks, reminder = divmod(len_deltas, RSYNC_BLOCK_SIZE)
-            if len_deltas > 0:
-                block_indexes = (
-                    data_chunk[offset_size: offset_size + len_offset_str])
-                data_chunk = data_chunk[offset_size + len(block_indexes):]
-                blocks_offsets = filter(None, block_indexes.split('\00'))
-                # Get all the block index offset from
-                for block_index in blocks_offsets:
-                    while len(data_chunk) < RSYNC_BLOCK_SIZE:
-                        try:
-                            data_chunk += self.process_restore_data(
-                                read_pipe.recv_bytes())
-                        except EOFError:
-                            LOG.info(
-                                "[*] EOF from pipe. Flushing buffer.")
-                            data_chunk += self.compressor.flush()
-                            break
-
-                    offset = int(block_index) * RSYNC_BLOCK_SIZE
-                    fd_curr_file.seek(offset)
-                    fd_curr_file.write(data_chunk[:RSYNC_BLOCK_SIZE])
-                    data_chunk = data_chunk[RSYNC_BLOCK_SIZE:]
-
-                if reminder:
-                    fd_curr_file.write(data_chunk[:reminder])
-                    data_chunk = data_chunk[reminder:]
-
+            data_chunk = self.read_restore_chunk(
+                data_chunk, read_pipe, offset_size + len_offset_str)
+            block_indexes = (
+                data_chunk[offset_size: offset_size + len_offset_str])
+            data_chunk = data_chunk[offset_size + len(block_indexes):]
+            blocks_offsets = filter(None, block_indexes.split('\00'))
+            # Each changed block is stored with its length in the new
+            # file, only the last block of the file can be shorter
+            for block_index in blocks_offsets:
+                offset = int(block_index) * RSYNC_BLOCK_SIZE
+                block_len = max(0, min(RSYNC_BLOCK_SIZE, size - offset))
+                data_chunk = self.read_restore_chunk(
+                    data_chunk, read_pipe, block_len)
+
+                fd_curr_file.seek(offset)
+                fd_curr_file.write(data_chunk[:block_len])
+                data_chunk = data_chunk[block_len:]
+
+        fd_curr_file.truncate(size)
         return data_chunk
 
     def make_reg_file(
@@ -401,35 +1082,11 @@ class RsyncEngine(engine.BackupEngine):
                                          read_pipe, flushed)
         elif level_id == '1111':
             fd_curr_file = open(file_path, 'rb+')
-            data_chunk = self.write_changes_in_file(fd_curr_file,
+            data_chunk = self.write_changes_in_file(fd_curr_file, size,
                                                     data_chunk, read_pipe)
         fd_curr_file.close()
         return data_chunk
 
-    def set_inode(self, uname, gname, mtime, name):
-        """Set the file inode fields according to the provided args.
-
-        :param uname:
-        :param gname:
-        :param mtime:
-        :param name:
-        :return:
-        """
-
-        try:
-            current_uid = pwd.getpwnam(uname).pw_uid
-            current_gid = grp.getgrnam(gname).gr_gid
-            os.chown(name, current_uid, current_gid)
-            os.utime(name, (mtime, mtime))
-        except (IOError, OSError):
-            try:
-                current_uid = pwd.getpwnam(getpass.getuser()).pw_uid
-                current_gid = grp.getgrnam(getpass.getuser()).gr_gid
-                os.chown(name, current_uid, current_gid)
-                os.utime(name, (mtime, mtime))
-            except (OSError, IOError) as err:
-                raise Exception(err)
-
     @staticmethod
     def get_file_type(file_mode, fs_path):
         """Extract file type from the the file mode retrieved
@@ -457,29 +1114,6 @@ class RsyncEngine(engine.BackupEngine):
 
         return 'u', ''
 
-    @staticmethod
-    def gen_file_header(file_path, inode_str_struct):
-        """Generate file header for rsync binary data file
-
-        :param file_path: file path
-        :param inode_str_struct: file binary string including inode data
-        :return: chunk of binary data to be processed on the next iteration
-        """
-
-        start_of_block = b'\00{}\00'.format(file_path)
-        header_size = len(start_of_block) + len(inode_str_struct)
-        header_size += len(str(header_size))
-        file_header = b'{}{}{}'.format(
-            header_size, start_of_block, inode_str_struct)
-        len_file_header = len(file_header)
-
-        if header_size != len_file_header:
-            file_header_list = file_header.split('\00')
-            file_header_list = file_header_list[1:]
-            file_header_list.insert(0, str(len_file_header))
-            file_header = '\00'.join(file_header_list)
-        return file_header
-
     def make_files(
             self, header_list, restore_abs_path, read_pipe,
             data_chunk, flushed,
@@ -527,25 +1161,72 @@ class RsyncEngine(engine.BackupEngine):
         file_mode = int(file_mode)
         size = int(size)
         mtime = int(mtime)
+        devmajor = int(devmajor)
+        devminor = int(devminor)
         file_abs_path = '{0}/{1}'.format(restore_abs_path, file_path)
 
-        if not os.path.isdir(file_abs_path) and os.path.exists(
-                file_abs_path) and current_backup_level == 0:
-            os.unlink(file_abs_path)
-
-        if not os.path.isdir(file_abs_path) and os.path.exists(
-                file_abs_path) and current_backup_level != 0 and rm == '1111':
-            os.unlink(file_abs_path)
+        if self.remove_file(file_abs_path, current_backup_level,
+                            rm == '1111'):
+            self.inodes.discard(file_abs_path)
             return data_chunk
 
         if file_type in REG_FILE:
             data_chunk = self.make_reg_file(
                 size, file_abs_path, read_pipe, data_chunk,
                 flushed, level_id)
+        else:
+            self.make_special_file(file_type, file_abs_path, file_mode,
+                                   link_name, devmajor, devminor)
+
+        if file_type == 'l':
+            self.inodes.discard(file_abs_path)
+        else:
+            self.inodes.defer(file_abs_path, uname, gname, file_mode, mtime)
+
+        return data_chunk
+
+    @staticmethod
+    def remove_file(file_abs_path, current_backup_level, deleted):
+        """Remove the file replaced by a level 0 backup or deleted since
+        the previous level.
+
+        :param file_abs_path: path of the restored file
+        :param current_backup_level: level of the restored backup
+        :param deleted: True if the file was deleted
+        :return: True if the file was deleted
+        """
+
+        if not os.path.isdir(file_abs_path) and os.path.exists(
+                file_abs_path) and current_backup_level == 0:
+            os.unlink(file_abs_path)
 
-        elif file_type == 'd':
+        if current_backup_level != 0 and deleted:
+            # Deleted files are listed again by every following level
+            if not os.path.isdir(file_abs_path) and os.path.lexists(
+                    file_abs_path):
+                os.unlink(file_abs_path)
+            return True
+        return False
+
+    @staticmethod
+    def make_special_file(file_type, file_abs_path, file_mode, link_name,
+                          devmajor, devminor):
+        """Create a directory, a device, a FIFO or a symbolic link.
+
+        :param file_type:
+        :param file_abs_path:
+        :param file_mode:
+        :param link_name:
+        :param devmajor:
+        :param devminor:
+        """
+
+        if file_type == 'd':
             try:
-                os.makedirs(file_abs_path, file_mode)
+                # Kept writable until its mode is set, once its files are
+                # restored
+                os.makedirs(file_abs_path,
+                            stat.S_IMODE(file_mode) | stat.S_IRWXU)
             except (OSError, IOError) as error:
                 if error.errno != 17:  # E_EXIST
                     LOG.warning(
@@ -555,8 +1236,6 @@ class RsyncEngine(engine.BackupEngine):
         elif file_type == 'b':
             file_mode |= stat.S_IFBLK
             try:
-                devmajor = int(devmajor)
-                devminor = int(devminor)
                 new_dev = os.makedev(devmajor, devminor)
                 os.mknod(file_abs_path, file_mode, new_dev)
             except (OSError, IOError) as error:
@@ -567,8 +1246,6 @@ class RsyncEngine(engine.BackupEngine):
         elif file_type == 'c':
             file_mode |= stat.S_IFCHR
             try:
-                devmajor = int(devmajor)
-                devminor = int(devminor)
                 new_dev = os.makedev(devmajor, devminor)
                 os.mknod(file_abs_path, file_mode, new_dev)
             except (OSError, IOError) as error:
@@ -591,15 +1268,11 @@ class RsyncEngine(engine.BackupEngine):
                 LOG.warning('Link file {0} creation error: {1}'.format(
                     file_abs_path, error))
 
-        if file_type != 'l':
-            self.set_inode(uname, gname, mtime, file_abs_path)
-
-        return data_chunk
-
-    def get_file_struct(self, fs_path, new_level=False):
+    @staticmethod
+    def get_file_struct(fs_path, new_level=False):
         """Generate file meta data from file abs path.
 
-        Return the meta data as a dict structure and a binary string
+        Return the meta data as a dict structure
 
         :param fs_path: file abs path
         :param new_level
@@ -616,11 +1289,11 @@ class RsyncEngine(engine.BackupEngine):
         file_mode = os_stat.st_mode
         # Get file type. If file type is a link it returns also the
         # file pointed by the link
-        file_type, lname = self.get_file_type(file_mode, fs_path)
+        file_type, lname = RsyncEngine.get_file_type(file_mode, fs_path)
 
         # If file_type is a socket return False
         if file_type == 's':
-            return False, False
+            return False
 
         ctime = int(os_stat.st_ctime)
         mtime = int(os_stat.st_mtime)
@@ -663,87 +1336,61 @@ class RsyncEngine(engine.BackupEngine):
             }
         }
 
-        # build file meta data as binary string
-        inode_bin_str = (
-            b'{}\00{}\00{}\00{}\00{}'
-            b'\00{}\00{}\00{}\00{}\00{}'
-            b'\00{}\00{}\00{}\00{}\00{}\00{}\00{}\00{}').format(
-            RSYNC_DATA_STRUCT_VERSION, file_mode,
-            uid, gid, size, mtime, ctime, uname, gname,
-            file_type, lname, inumber, nlink, devminor, devmajor,
-            RSYNC_BLOCK_SIZE, level_id, '0000')
-
-        return inode_dict, inode_bin_str
+        return inode_dict
 
     def gen_struct_for_deleted_files(self, files_meta, old_fs_meta_struct,
                                      rel_path, write_queue):
         files_meta['files'][rel_path] = old_fs_meta_struct['files'][rel_path]
         files_meta['files'][rel_path]['inode']['deleted'] = '1111'
-        file_mode = files_meta['files'][rel_path]['inode']['mode']
-        uid = files_meta['files'][rel_path]['inode']['uid']
-        gid = files_meta['files'][rel_path]['inode']['gid']
-        size = files_meta['files'][rel_path]['inode']['size']
-        mtime = files_meta['files'][rel_path]['inode']['mtime']
-        ctime = files_meta['files'][rel_path]['inode']['ctime']
-        uname = files_meta['files'][rel_path]['inode']['uname']
-        gname = files_meta['files'][rel_path]['inode']['gname']
-        file_type = files_meta['files'][rel_path]['inode']['ftype']
-        lname = files_meta['files'][rel_path]['inode']['lname']
-        inumber = files_meta['files'][rel_path]['inode']['inumber']
-        nlink = files_meta['files'][rel_path]['inode']['nlink']
-        devminor = files_meta['files'][rel_path]['inode']['devminor']
-        devmajor = files_meta['files'][rel_path]['inode']['devmajor']
-        level_id = files_meta['files'][rel_path]['inode']['level_id']
-
-        inode_bin_str = (
-            b'{}\00{}\00{}\00{}\00{}'
-            b'\00{}\00{}\00{}\00{}\00{}'
-            b'\00{}\00{}\00{}\00{}\00{}\00{}\00{}\00{}').format(
-            RSYNC_DATA_STRUCT_VERSION, file_mode,
-            uid, gid, size, mtime, ctime, uname, gname,
-            file_type, lname, inumber, nlink, devminor, devmajor,
-            RSYNC_BLOCK_SIZE, level_id, '1111')
-        file_header = self.gen_file_header(rel_path, inode_bin_str)
+        file_header = stream.pack_header(
+            rel_path, files_meta['files'][rel_path]['inode'], 0)
         compr_block = self.process_backup_data(file_header)
         write_queue.put(compr_block)
 
-    def process_file(self, file_path, fs_path, files_meta,
-                     old_fs_meta_struct, write_queue):
-        rel_path = os.path.relpath(file_path, fs_path)
-
-        new_level = True if self.get_old_file_meta(
-            old_fs_meta_struct, rel_path) else False
+    def process_file(self, rel_path, kind, scan, old_file_meta,
+                     files_meta, write_queue):
+        """Write a scanned file or directory to the backup stream.
 
-        inode_dict_struct, inode_str_struct = self.get_file_struct(
-            rel_path, new_level)
-
-        if not inode_dict_struct:
-            return
-
-        if os.path.isdir(file_path):
-            files_meta['directories'][file_path] = inode_dict_struct
-            files_meta['meta']['backup_size_on_disk'] += os.path.getsize(
-                rel_path)
-            file_header = self.gen_file_header(rel_path, inode_str_struct)
+        :param rel_path: path relative to the backup root
+        :param kind: manifest.DIRECTORY or manifest.FILE
+        :param scan: result of get_file_struct for a directory, of
+                     scan_file for a file
+        :param old_file_meta: meta data of the previous backup execution
+        :param files_meta: meta data of the backup in progress
+        :param write_queue: queue of the backup stream
+        """
+        if kind == manifest.DIRECTORY:
+            inode_dict_struct = scan
+            if not inode_dict_struct:
+                return
+            files_meta['directories'][rel_path] = inode_dict_struct
+            files_meta['meta']['backup_size_on_disk'] += (
+                inode_dict_struct['inode']['size'])
+            file_header = stream.pack_header(
+                rel_path, inode_dict_struct['inode'], 0)
 
             compressed_block = self.process_backup_data(file_header)
             files_meta['meta']['backup_size_compressed'] += len(
                 compressed_block)
             write_queue.put(compressed_block)
-        else:
-            file_metadata = self.compute_incrementals(
-                rel_path, inode_str_struct,
-                inode_dict_struct, files_meta,
-                old_fs_meta_struct, write_queue)
+        elif scan:
+            files_meta = self.compute_incrementals(
+                rel_path, scan, old_file_meta, files_meta, write_queue)
 
-            files_meta.update(file_metadata)
-
-    def get_sign_delta(self, fs_path, manifest_path, write_queue):
+    def get_sign_delta(self, fs_path, manifest_path, write_queue,
+                       manifest_writer=None):
         """Compute the file or fs tree path signatures.
 
+        With more than one rsync worker, the files are scanned by the
+        process pool of backup ahead of the walk. The stream and the
+        manifest are still written in walk order by this thread, which
+        also compresses and encrypts the data.
+
         :param fs_path:
         :param manifest_path
         :param write_queue:
+        :param manifest_writer: manifest.ManifestWriter continuing the
+                                manifest of a resumed backup
         :return:
         """
 
@@ -763,19 +1410,41 @@ class RsyncEngine(engine.BackupEngine):
             'broken_links': [],
             'rsync_struct_ver': RSYNC_DATA_STRUCT_VERSION,
             'rsync_block_size': RSYNC_BLOCK_SIZE}
-
-        # Get old file meta structure or an empty dict if not available
-        old_fs_meta_struct = self.get_fs_meta_struct(manifest_path)
+        if self.dictionary_record:
+            files_meta['compression_dictionary'] = {
+                'id': self.dictionary_record['id'],
+                'data': self.dictionary_record['data']}
+
+        # The previous manifest is read in step with the walk, the new
+        # one is written as files are processed
+        old_manifest = self.get_fs_meta_struct(manifest_path)
+        if manifest_writer is None:
+            manifest_writer = manifest.ManifestWriter(
+                '{0}.new'.format(manifest_path), self.compression_algo,
+                RSYNC_BLOCK_SIZE)
+        old_entries = manifest.ManifestJoin(old_manifest or [])
+        self.resumed_key = manifest_writer.last_key
+        if manifest_writer.last_entry:
+            # The entries up to the checkpoint are in the stream already
+            resumed = self.journal.resumed_state
+            files_meta['meta'] = resumed['meta']
+            files_meta['broken_links'] = resumed['broken_links']
+            old_entries.pop(*manifest_writer.last_entry)
+        # Entries walked and not written yet, in walk order
+        pending = collections.deque()
 
         if os.path.isdir(fs_path):
             # If given path is a directory, change cwd to path to backup
             os.chdir(fs_path)
             for root, dirs, files in os.walk(fs_path):
-                self.process_file(root, fs_path, files_meta,
-                                  old_fs_meta_struct, write_queue)
-
-                # Check if exclude is in filename. If it is, log the file
-                # exclusion and continue to the next iteration.
+                # Walk in the order of the manifest
+                dirs.sort()
+                self.process_entry(root, fs_path, files_meta,
+                                   old_entries, pending,
+                                   manifest_writer, write_queue)
+
+                # Check if exclude is in filename. If it is, log the
+                # file exclusion and continue to the next iteration.
                 if self.exclude:
                     files = [name for name in files if
                              self.exclude not in name]
@@ -784,19 +1453,21 @@ class RsyncEngine(engine.BackupEngine):
                             ('Excluding file names matching with: '
                              '{}'.format(self.exclude)))
 
-                for name in files:
+                for name in sorted(files):
                     file_path = os.path.join(root, name)
-                    self.process_file(file_path, fs_path,
-                                      files_meta, old_fs_meta_struct,
-                                      write_queue)
+                    self.process_entry(file_path, fs_path, files_meta,
+                                       old_entries, pending,
+                                       manifest_writer, write_queue)
         else:
-            self.process_file(fs_path, os.getcwd(), files_meta,
-                              old_fs_meta_struct, write_queue)
-        if old_fs_meta_struct:
-            for rel_path in old_fs_meta_struct['files']:
-                if not files_meta['files'].get(rel_path):
-                    self.gen_struct_for_deleted_files(
-                        files_meta, old_fs_meta_struct, rel_path, write_queue)
+            self.process_entry(fs_path, os.getcwd(), files_meta,
+                               old_entries, pending, manifest_writer,
+                               write_queue)
+        self.write_entries(pending, files_meta, manifest_writer,
+                           write_queue)
+
+        # Files of the previous backup placed after the last walked one
+        self.process_deleted_files(old_entries.pop_before(), files_meta,
+                                   manifest_writer, write_queue)
 
         # Flush any compressed buffered data
         flushed_data = self.compressor.flush()
@@ -809,33 +1480,167 @@ class RsyncEngine(engine.BackupEngine):
         # General metrics to be uploaded to the API and/or media storage
         files_meta['meta']['broken_links_tot'] = len(
             files_meta['broken_links'])
-        files_meta['meta']['total_files'] = len(files_meta['files'])
-        files_meta['meta']['total_directories'] = len(
-            files_meta['directories'])
+        files_meta['meta']['total_files'] = manifest_writer.files_count
+        files_meta['meta']['total_directories'] = (
+            manifest_writer.directories_count)
         files_meta['meta']['rsync_data_struct_ver'] = RSYNC_DATA_STRUCT_VERSION
         LOG.info("Backup session metrics: {0}".format(
             files_meta['meta']))
 
-        # Compress meta data file
-        # Write meta data to disk as JSON
-        compressed_json_meta = compress.one_shot_compress(
-            self.compression_algo, json.dumps(files_meta))
-        with open(manifest_path, 'wb') as manifest_file:
-            manifest_file.write(compressed_json_meta)
+        # Write the index of the manifest and replace the previous one
+        del files_meta['files']
+        del files_meta['directories']
+        manifest_writer.close(files_meta)
+        if old_manifest:
+            old_manifest.close()
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        os.rename(manifest_writer.path, manifest_path)
 
         # Put False on the queue so it will be terminated on the other side:
         write_queue.put(False)
 
     def get_fs_meta_struct(self, fs_meta_path):
-        fs_meta_struct = {}
+        """Open the manifest of the previous backup.
 
+        :param fs_meta_path: path of the manifest
+        :return: a manifest.ManifestReader or None if there is no
+                 previous manifest
+        """
         if os.path.isfile(fs_meta_path):
-            with open(fs_meta_path) as meta_file:
-                fs_meta_struct = json.loads(
-                    compress.one_shot_decompress(self.compression_algo,
-                                                 meta_file.read()))
+            return manifest.ManifestReader(fs_meta_path,
+                                           self.compression_algo)
+        return None
+
+    def process_entry(self, file_path, fs_path, files_meta, old_entries,
+                      pending, manifest_writer, write_queue):
+        """Scan a walked file or directory, then write the entries
+        scanned far enough behind the walk.
+
+        The entries of the previous manifest placed before it belong
+        to deleted files or directories.
+
+        :param file_path: path of the file or directory
+        :param fs_path: root path of the backup
+        :param files_meta: meta data of the backup in progress
+        :param old_entries: manifest.ManifestJoin on the previous manifest
+        :param pending: deque of the entries not written yet
+        :param manifest_writer: manifest.ManifestWriter of the backup
+        :param write_queue: queue of the backup stream
+        """
+        rel_path = os.path.relpath(file_path, fs_path)
+        if os.path.isdir(file_path):
+            kind = manifest.DIRECTORY
+        else:
+            kind = manifest.FILE
+        if (self.resumed_key is not None and
+                manifest.sort_key(kind, rel_path) <= self.resumed_key):
+            return
+        deleted_entries = list(
+            old_entries.pop_before(manifest.sort_key(kind, rel_path)))
+
+        old_file_meta = old_entries.pop(kind, rel_path)
+        if old_file_meta and old_file_meta['inode']['deleted'] == '1111':
+            # A file recreated after its deletion is backed up in full
+            old_file_meta = None
+        if kind == manifest.DIRECTORY:
+            old_file_meta = None
+            scan = functools.partial(self.get_file_struct, rel_path)
+        elif self.scan_pool:
+            scan = self.scan_pool.apply_async(
+                scan_file, ((rel_path, old_file_meta),)).get
+        else:
+            scan = functools.partial(self.scan_file, rel_path, old_file_meta)
+        pending.append((deleted_entries, kind, rel_path, old_file_meta, scan))
+
+        scan_ahead = 0
+        if self.scan_pool:
+            scan_ahead = self.rsync_workers * RSYNC_SCAN_AHEAD
+        self.write_entries(pending, files_meta, manifest_writer, write_queue,
+                           scan_ahead)
+
+    def write_entries(self, pending, files_meta, manifest_writer,
+                      write_queue, scan_ahead=0):
+        """Write the scanned entries to the backup stream and to the
+        manifest, in walk order.
+
+        :param pending: deque of the entries not written yet
+        :param files_meta: meta data of the backup in progress
+        :param manifest_writer: manifest.ManifestWriter of the backup
+        :param write_queue: queue of the backup stream
+        :param scan_ahead: number of entries left pending
+        """
+        while len(pending) > scan_ahead:
+            (deleted_entries, kind, rel_path, old_file_meta,
+             scan) = pending.popleft()
+            self.process_deleted_files(deleted_entries, files_meta,
+                                       manifest_writer, write_queue)
+            self.process_file(rel_path, kind, scan(), old_file_meta,
+                              files_meta, write_queue)
+            self.flush_files_meta(files_meta, manifest_writer)
+            if self.journal and self.stream_size >= (
+                    self.max_segment_size * RSYNC_CHECKPOINT_SEGMENTS):
+                self.checkpoint(files_meta, manifest_writer, write_queue)
+
+    def checkpoint(self, files_meta, manifest_writer, write_queue):
+        """Put a checkpoint on the backup stream, after the written
+        entries. The compressed stream or the current frame ends and the
+        next data starts a new one.
+
+        :param files_meta: meta data of the backup in progress
+        :param manifest_writer: manifest.ManifestWriter of the backup
+        :param write_queue: queue of the backup stream
+        """
+        if self.frame_size:
+            flushed_data = self.compressor.end_frame()
+        else:
+            flushed_data = self.compressor.flush()
+            self.compressor = self.new_compressor()
+        if flushed_data:
+            flushed_data = self.process_backup_data(flushed_data,
+                                                    do_compress=False)
+            files_meta['meta']['backup_size_compressed'] += len(flushed_data)
+            write_queue.put(flushed_data)
+        self.stream_size = 0
+        write_queue.put({
+            'manifest': manifest_writer.checkpoint(),
+            'meta': dict(files_meta['meta']),
+            'broken_links': list(files_meta['broken_links']),
+            'cipher': self.cipher.state() if self.cipher else None,
+            'frames': self.compressor.state() if self.frame_size else None})
+
+    def process_deleted_files(self, old_entries, files_meta,
+                              manifest_writer, write_queue):
+        """Record the files of the previous backup that do not exist
+        anymore.
+
+        :param old_entries: entries of the previous manifest missing from
+                            the walk
+        :param files_meta: meta data of the backup in progress
+        :param manifest_writer: manifest.ManifestWriter of the backup
+        :param write_queue: queue of the backup stream
+        """
+        for kind, rel_path, old_meta in old_entries:
+            if kind != manifest.FILE:
+                continue
+            self.gen_struct_for_deleted_files(
+                files_meta, {'files': {rel_path: old_meta}}, rel_path,
+                write_queue)
+            self.flush_files_meta(files_meta, manifest_writer)
+
+    @staticmethod
+    def flush_files_meta(files_meta, manifest_writer):
+        """Move the meta data of the processed entries to the manifest.
 
-        return fs_meta_struct
+        :param files_meta: meta data of the backup in progress
+        :param manifest_writer: manifest.ManifestWriter of the backup
+        """
+        for rel_path, meta in files_meta['directories'].items():
+            manifest_writer.add(manifest.DIRECTORY, rel_path, meta)
+        for rel_path, meta in files_meta['files'].items():
+            manifest_writer.add(manifest.FILE, rel_path, meta)
+        files_meta['directories'].clear()
+        files_meta['files'].clear()
 
     @staticmethod
     def is_reg_file(file_type):
@@ -855,7 +1660,7 @@ class RsyncEngine(engine.BackupEngine):
         if reg_file:
             with open(rel_path, 'rb') as file_path_fd:
                 files_meta['files'][rel_path].update(
-                    {'signature': pyrsync.blockchecksums(
+                    {'signature': signature.Signature.from_stream(
                         file_path_fd, RSYNC_BLOCK_SIZE)})
         else:
             # Stat the file to be sure it's not a broken link
@@ -864,74 +1669,131 @@ class RsyncEngine(engine.BackupEngine):
                     raise IOError
 
             files_meta['files'][rel_path].update(
-                {'signature': [[], []]})
+                {'signature': signature.Signature(b'')})
 
         return files_meta
 
-    def compute_incrementals(
-            self, rel_path, inode_str_struct,
-            inode_dict_struct, files_meta,
-            old_fs_meta_struct, write_queue, deleted=False):
+    @staticmethod
+    def scan_file(rel_path, old_file_meta=None):
+        """Stat a file, compute its signature and the changed blocks of
+        its data.
 
-        file_header = self.gen_file_header(
-            rel_path, inode_str_struct)
+        This is the CPU bound part of the backup of a file, run by the
+        scan workers: it doesn't use the engine state and returns
+        picklable data only.
 
-        # File size is header size + null bytes + file size
-        file_size = len(file_header)
-        reg_file_type = self.is_reg_file(inode_dict_struct['inode']['ftype'])
+        :param rel_path: path of the file relative to the backup root
+        :param old_file_meta: meta data of the previous backup execution
+        :return: None if the file is not backed up (socket), otherwise a
+                 dict holding the file meta data ('meta'), whether the
+                 file changed since the previous backup ('modified'), the
+                 sorted list of changed block indexes of an incremental
+                 backup ('blocks') and the error met reading the file
+                 ('error')
+        """
+
+        inode_dict_struct = RsyncEngine.get_file_struct(
+            rel_path, bool(old_file_meta))
+        if not inode_dict_struct:
+            return None
+
+        scan = {'meta': inode_dict_struct, 'modified': True,
+                'blocks': None, 'error': None}
+        if old_file_meta and not RsyncEngine.is_file_modified(
+                old_file_meta, inode_dict_struct):
+            scan['modified'] = False
+            return scan
+
+        reg_file_type = RsyncEngine.is_reg_file(
+            inode_dict_struct['inode']['ftype'])
         try:
-            files_meta['files'][rel_path] = inode_dict_struct
-
-            # As pyrsync functions run thorough the file descriptor
-            # we need to set the set the pointer to the fd to 0.
-            # Backup file data content only if the file type is
-            # regular or unknown
-            old_file_meta = self.get_old_file_meta(old_fs_meta_struct,
-                                                   rel_path)
-            if old_file_meta:
-                if self.is_file_modified(old_file_meta,
-                                         files_meta['files'][rel_path]):
-                    # If old_fs_path is provided, it checks
-                    # if old file mtime or ctime are different then
-                    # the new ones
-                    files_meta = self.compute_checksums(rel_path, files_meta,
-                                                        reg_file=reg_file_type)
+            RsyncEngine.compute_checksums(
+                rel_path, {'files': {rel_path: inode_dict_struct}},
+                reg_file=reg_file_type)
+            if reg_file_type and old_file_meta:
+                scan['blocks'] = RsyncEngine.aligned_changed_blocks(
+                    old_file_meta, inode_dict_struct)
+                if scan['blocks'] is None:
+                    with open(rel_path, 'rb') as file_path_fd:
+                        scan['blocks'] = RsyncEngine.rsync_changed_blocks(
+                            file_path_fd, old_file_meta,
+                            inode_dict_struct['inode']['size'])
+        except (IOError, OSError) as error:
+            scan['error'] = str(error)
+        return scan
 
-                    compressed_block = self.process_backup_data(file_header)
-                    write_queue.put(compressed_block)
+    @staticmethod
+    def gen_file_data(file_path_fd, file_size):
+        """Generate the data of a file for a level 0 backup.
 
-                    if reg_file_type:
-                        file_path_fd = open(rel_path)
-                        for data_block in self.rsync_gen_delta(
-                                file_path_fd, old_file_meta):
+        The data is padded or cut to file_size, the size recorded in
+        the header, as the file may change after it was scanned.
 
-                            compressed_block = self.process_backup_data(
-                                data_block)
-                            write_queue.put(compressed_block)
-                        file_path_fd.close()
-                else:
-                    files_meta['files'][rel_path].update(
-                        {'signature': old_file_meta['signature']})
+        :param file_path_fd: file descriptor of the file
+        :param file_size: size of the file recorded in its header
+        :return: generator of binary strings
+        """
 
+        while file_size > 0:
+            data_block = file_path_fd.read(
+                min(RSYNC_BLOCK_BUFF_SIZE, file_size))
+            if not data_block:
+                data_block = b'\00' * min(RSYNC_BLOCK_BUFF_SIZE, file_size)
+            file_size -= len(data_block)
+            yield data_block
+
+    def compute_incrementals(self, rel_path, scan, old_file_meta,
+                             files_meta, write_queue):
+        """Write the header and the data of a scanned file to the
+        backup stream.
+
+        :param rel_path: path of the file relative to the backup root
+        :param scan: result of scan_file
+        :param old_file_meta: meta data of the previous backup execution
+        :param files_meta: meta data of the backup in progress
+        :param write_queue: queue of the backup stream
+        :return: files_meta
+        """
+
+        file_meta = scan['meta']
+        files_meta['files'][rel_path] = file_meta
+        file_size = file_meta['inode']['size']
+        # Backup file data content only if the file type is
+        # regular or unknown
+        reg_file_type = self.is_reg_file(file_meta['inode']['ftype'])
+        try:
+            if scan['error']:
+                raise IOError(scan['error'])
+
+            if not scan['modified']:
+                file_meta.update({'signature': old_file_meta['signature']})
+                file_header = stream.pack_header(
+                    rel_path, file_meta['inode'], 0)
+            elif not reg_file_type:
+                file_header = stream.pack_header(
+                    rel_path, file_meta['inode'], 0)
+                write_queue.put(self.process_backup_data(file_header))
             else:
-                files_meta = self.compute_checksums(
-                    rel_path, files_meta,
-                    reg_file=reg_file_type)
-
-                compressed_block = self.process_backup_data(file_header)
-                write_queue.put(compressed_block)
-                if reg_file_type:
-                    file_path_fd = open(rel_path)
-                    data_block = file_path_fd.read(
-                        RSYNC_BLOCK_BUFF_SIZE)
-                    while data_block:
-                        compressed_block = self.process_backup_data(data_block)
+                if old_file_meta:
+                    data_len = self.changed_blocks_len(
+                        scan['blocks'], file_size)
+                else:
+                    data_len = file_size
+                file_header = stream.pack_header(
+                    rel_path, file_meta['inode'], data_len)
+                with open(rel_path, 'rb') as file_path_fd:
+                    compressed_block = self.process_backup_data(file_header)
+                    write_queue.put(compressed_block)
+                    if old_file_meta:
+                        data = self.gen_changed_blocks(
+                            file_path_fd, scan['blocks'], file_size)
+                    else:
+                        data = self.gen_file_data(file_path_fd, file_size)
+                    for data_block in data:
+                        compressed_block = self.process_backup_data(
+                            data_block)
                         write_queue.put(compressed_block)
-                        data_block = file_path_fd.read(
-                            RSYNC_BLOCK_BUFF_SIZE)
-
-                    file_path_fd.close()
-            files_meta['files'][rel_path]['file_data_len'] = file_size
+            file_meta['file_data_len'] = len(file_header)
         except (IOError, OSError) as error:
             LOG.warning('IO or OS Error: {}'.format(error))
             if os.path.lexists(rel_path):
@@ -0,0 +1,255 @@
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Binary store for the block signatures of the rsync engine.
+
+The signature of each block is a fixed size record: the weak checksum
+packed as a little-endian unsigned 64 bits integer followed by the raw
+SHA-1 digest of the block. The weak checksum computed by pyrsync is not
+reduced modulo 2^16 and takes up to 47 bits, so it doesn't fit in 32
+bits.
+
+The records of all the files are appended to a single store, kept in
+the engine manifest (see freezer.engine.rsync.manifest), which holds for
+each file the index of its first record and the number of records.
+
+Signatures read from a manifest are pickled as a reference to the
+records, so that they can be given to a process pool without copying
+them: the worker maps the manifest itself.
+"""
+
+import binascii
+import mmap
+import os
+import struct
+
+from freezer.engine.rsync import fastrsync
+
+WEAK_FORMAT = '<Q'
+WEAK_SIZE = struct.calcsize(WEAK_FORMAT)
+DIGEST_SIZE = 20
+RECORD_SIZE = WEAK_SIZE + DIGEST_SIZE
+# Number of records compared or copied at once
+CHUNK_RECORDS = 4096
+
+# Manifests mapped by the processes which unpickled signatures
+_MAPPED_FILES = {}
+
+
+def _mapped_signature(path, offset, count):
+    """
+    Returns the signature of count records at offset in the file at
+    path, mapping the file once per process.
+    """
+    data = _MAPPED_FILES.get(path)
+    if data is None:
+        with open(path, 'rb') as fd:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        _MAPPED_FILES[path] = data
+    return Signature(data, offset, count, path)
+
+
+class _ChecksumView(object):
+    """
+    Read only sequence over one of the checksums of a signature.
+    """
+
+    def __init__(self, signature, getter):
+        self.signature = signature
+        self.getter = getter
+
+    def __len__(self):
+        return self.signature.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.signature.count:
+            raise IndexError(index)
+        return self.getter(index)
+
+    def __iter__(self):
+        for index in range(self.signature.count):
+            yield self.getter(index)
+
+
+class Signature(object):
+    """
+    Signature of the blocks of a file, backed by a buffer of records
+    (a string or a memory map of the manifest).
+
+    It unpacks like the (weak, strong) pair of lists returned by
+    pyrsync.blockchecksums, without building those lists, so it can be
+    given as is to rsyncdelta.
+
+    :param source: path of the file mapped in data, if any
+    """
+
+    def __init__(self, data, offset=0, count=None, source=None):
+        self.data = data
+        self.offset = offset
+        if count is None:
+            count = (len(data) - offset) // RECORD_SIZE
+        self.count = count
+        self.source = source
+
+    def __reduce__(self):
+        if self.source is not None:
+            return _mapped_signature, (self.source, self.offset, self.count)
+        return Signature, (b''.join(self.chunks()), 0, self.count)
+
+    @classmethod
+    def from_checksums(cls, weakhashes, stronghashes):
+        """
+        Builds a signature from the lists returned by blockchecksums.
+        """
+        records = b''.join(
+            struct.pack(WEAK_FORMAT, weak) + binascii.unhexlify(strong)
+            for weak, strong in zip(weakhashes, stronghashes))
+        return cls(records, 0, len(weakhashes))
+
+    @classmethod
+    def from_stream(cls, instream, blocksize=4096):
+        """
+        Computes the signature of the given data stream.
+        """
+        records = b''.join(
+            struct.pack(WEAK_FORMAT, weak) + digest
+            for weak, digest in fastrsync.iterblockchecksums(
+                instream, blocksize))
+        return cls(records)
+
+    def __iter__(self):
+        return iter((self.weak, self.strong))
+
+    @property
+    def weak(self):
+        return _ChecksumView(self, self.weakchecksum)
+
+    @property
+    def strong(self):
+        return _ChecksumView(self, self.stronghash)
+
+    def weakchecksum(self, index):
+        return struct.unpack_from(
+            WEAK_FORMAT, self.data, self.offset + index * RECORD_SIZE)[0]
+
+    def stronghash(self, index):
+        start = self.offset + index * RECORD_SIZE + WEAK_SIZE
+        return binascii.hexlify(
+            self.data[start:start + DIGEST_SIZE]).decode('ascii')
+
+    def record(self, index):
+        start = self.offset + index * RECORD_SIZE
+        return self.data[start:start + RECORD_SIZE]
+
+    def chunks(self):
+        """
+        Yields the records of the signature in strings of at most
+        CHUNK_RECORDS records.
+        """
+        end = self.offset + self.count * RECORD_SIZE
+        for start in range(self.offset, end, CHUNK_RECORDS * RECORD_SIZE):
+            yield self.data[start:min(end, start +
+                                      CHUNK_RECORDS * RECORD_SIZE)]
+
+    def changed_blocks(self, other):
+        """
+        Returns the indexes of the blocks whose record differs from the
+        one at the same index in other. Both signatures must have the
+        same number of blocks.
+        """
+        if self.count != other.count:
+            raise ValueError('Signatures have different lengths')
+        changed = []
+        for chunk_index, (chunk, other_chunk) in enumerate(
+                zip(self.chunks(), other.chunks())):
+            if chunk == other_chunk:
+                continue
+            first = chunk_index * CHUNK_RECORDS
+            for offset in range(0, len(chunk), RECORD_SIZE):
+                if (chunk[offset:offset + RECORD_SIZE] !=
+                        other_chunk[offset:offset + RECORD_SIZE]):
+                    changed.append(first + offset // RECORD_SIZE)
+        return changed
+
+
+class SignatureWriter(object):
+    """
+    Appends signatures to a record file.
+
+    :param count: number of records to keep from an existing file
+    """
+
+    def __init__(self, path, count=0):
+        self.path = path
+        self.count = count
+        if not count:
+            self.fd = open(path, 'wb')
+            return
+        self.fd = open(path, 'r+b')
+        self.fd.seek(0, os.SEEK_END)
+        if self.fd.tell() < count * RECORD_SIZE:
+            self.fd.close()
+            raise ValueError('Truncated signature records in {0}'.format(
+                path))
+        self.fd.truncate(count * RECORD_SIZE)
+        self.fd.seek(count * RECORD_SIZE)
+
+    def add(self, signature):
+        """
+        Writes the records of signature and returns the reference
+        [first record, number of records] to store in the manifest.
+        """
+        first = self.count
+        for chunk in signature.chunks():
+            self.fd.write(chunk)
+        self.count += signature.count
+        return [first, signature.count]
+
+    def flush(self):
+        self.fd.flush()
+
+    def close(self):
+        if not self.fd.closed:
+            self.fd.close()
+
+
+class SignatureStore(object):
+    """
+    Records of a manifest, memory-mapped.
+    """
+
+    def __init__(self, path, offset, count, blocksize):
+        self.path = os.path.abspath(path)
+        self.offset = offset
+        self.count = count
+        self.blocksize = blocksize
+        self.fd = open(path, 'rb')
+        self.data = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < offset + count * RECORD_SIZE:
+            self.close()
+            raise ValueError('Truncated signature records in {0}'.format(
+                path))
+
+    def get(self, first, count):
+        """
+        Returns the signature of count records starting at first.
+        """
+        if first < 0 or count < 0 or first + count > self.count:
+            raise ValueError(
+                'Signature records {0}+{1} out of range'.format(first, count))
+        return Signature(self.data, self.offset + first * RECORD_SIZE,
+                         count, self.path)
+
+    def close(self):
+        self.data.close()
+        self.fd.close()
@@ -0,0 +1,234 @@
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Data stream of the rsync engine backups.
+
+A version 2 stream is a sequence of records, one for each directory,
+file or deleted file of the backup:
+
+    header | path | uname | gname | link name | data
+
+- header: inode fields packed as HEADER_FORMAT, with the length of the
+  four strings and the length of the data
+- data: for a full backup of a regular file, its content. For an
+  incremental backup, the number of changed blocks (COUNT_FORMAT),
+  their indexes (INDEX_FORMAT) and their content. The length of each
+  block is deduced from the file size.
+
+The records are compressed, then encrypted. A checkpointed backup
+compresses the records of each checkpoint as a separate compressed
+stream, the encrypted stream is continuous.
+
+Version 1 streams, made of text headers separated by \\00, are read by
+RsyncEngine.restore_level.
+"""
+
+import collections
+import struct
+
+import six
+
+STREAM_VERSION = 2
+
+# file type, flags, mode, uid, gid, size, mtime, ctime, inode number,
+# number of links, device major and minor numbers, length of the path,
+# user name, group name and link name, length of the data
+HEADER_FORMAT = '<1sBIIIQqqQQIIIHHIQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+COUNT_FORMAT = '<I'
+COUNT_SIZE = struct.calcsize(COUNT_FORMAT)
+INDEX_FORMAT = 'Q'
+INDEX_SIZE = struct.calcsize('<' + INDEX_FORMAT)
+
+FLAG_INCREMENTAL = 1
+FLAG_DELETED = 2
+
+Header = collections.namedtuple('Header', [
+    'ftype', 'incremental', 'deleted', 'mode', 'uid', 'gid', 'size',
+    'mtime', 'ctime', 'inumber', 'nlink', 'devmajor', 'devminor',
+    'path', 'uname', 'gname', 'lname', 'data_len'])
+
+
+def _to_bytes(value):
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def _to_str(value):
+    if six.PY2:
+        return value
+    return value.decode('utf-8')
+
+
+def pack_header(rel_path, inode, data_len):
+    """
+    Returns the header of a record.
+
+    :param rel_path: path relative to the backup root
+    :param inode: inode meta data of the file, as in the manifest
+    :param data_len: length of the data following the header
+    """
+    flags = 0
+    if inode['level_id'] == '1111':
+        flags |= FLAG_INCREMENTAL
+    if inode['deleted'] == '1111':
+        flags |= FLAG_DELETED
+    strings = [_to_bytes(value) for value in (
+        rel_path, inode['uname'], inode['gname'], inode['lname'])]
+    return struct.pack(
+        HEADER_FORMAT, _to_bytes(inode['ftype']), flags, inode['mode'],
+        inode['uid'], inode['gid'], inode['size'], inode['mtime'],
+        inode['ctime'], inode['inumber'], inode['nlink'],
+        inode['devmajor'], inode['devminor'],
+        *([len(value) for value in strings] + [data_len])) + b''.join(
+        strings)
+
+
+def block_indexes_size(count):
+    """
+    Returns the length of the indexes of count changed blocks.
+    """
+    return COUNT_SIZE + count * INDEX_SIZE
+
+
+def pack_block_indexes(block_indexes):
+    """
+    Returns the indexes of the changed blocks of an incremental record.
+    """
+    return struct.pack(
+        '{0}{1}{2}'.format(COUNT_FORMAT, len(block_indexes), INDEX_FORMAT),
+        len(block_indexes), *block_indexes)
+
+
+class StreamReader(object):
+    """
+    Parses the records of a stream received in chunks.
+
+    The chunks are kept as received: the headers are unpacked and the
+    data yielded as memoryviews from them. Only a header or an index
+    list split between chunks is copied to be joined.
+
+    :param read: callable returning the next chunk of the stream, an
+                 empty string at the end of the stream
+    :param data: beginning of the stream already received
+    """
+
+    def __init__(self, read, data=b''):
+        self.read = read
+        self.buffer = data
+        self.position = 0
+        # Data of the current record not consumed yet
+        self.remaining = 0
+
+    def _fill(self, size):
+        """
+        Receives chunks until size bytes are buffered. Returns False if
+        the stream ends before.
+        """
+        available = len(self.buffer) - self.position
+        if available >= size:
+            return True
+        chunks = [self.buffer[self.position:]] if available else []
+        while available < size:
+            data = self.read()
+            if not data:
+                break
+            chunks.append(data)
+            available += len(data)
+        if len(chunks) == 1:
+            self.buffer = chunks[0]
+        else:
+            self.buffer = b''.join(chunks)
+        self.position = 0
+        return available >= size
+
+    def _read(self, size):
+        """
+        Consumes size bytes and returns their offset in the buffer,
+        which may be replaced.
+        """
+        if not self._fill(size):
+            raise ValueError('Truncated rsync stream')
+        start = self.position
+        self.position += size
+        return start
+
+    def next_header(self):
+        """
+        Returns the Header of the next record, skipping the data of the
+        current one not consumed, or None at the end of the stream.
+        """
+        self.skip()
+        if not self._fill(HEADER_SIZE):
+            if len(self.buffer) > self.position:
+                raise ValueError('Truncated rsync stream')
+            return None
+        (ftype, flags, mode, uid, gid, size, mtime, ctime, inumber, nlink,
+         devmajor, devminor, path_len, uname_len, gname_len, lname_len,
+         data_len) = struct.unpack_from(
+            HEADER_FORMAT, self.buffer, self.position)
+        self.position += HEADER_SIZE
+
+        strings = []
+        start = self._read(path_len + uname_len + gname_len + lname_len)
+        for length in (path_len, uname_len, gname_len, lname_len):
+            strings.append(_to_str(self.buffer[start:start + length]))
+            start += length
+        self.remaining = data_len
+        return Header(_to_str(ftype), bool(flags & FLAG_INCREMENTAL),
+                      bool(flags & FLAG_DELETED), mode, uid, gid, size,
+                      mtime, ctime, inumber, nlink, devmajor, devminor,
+                      *(strings + [data_len]))
+
+    def iter_data(self, size=None):
+        """
+        Yields the next size bytes of data of the current record, all
+        of it if size is None, as memoryviews on the received chunks.
+        """
+        if size is None:
+            size = self.remaining
+        if size > self.remaining:
+            raise ValueError('Read beyond the rsync record data')
+        while size:
+            if self.position == len(self.buffer) and not self._fill(1):
+                raise ValueError('Truncated rsync stream')
+            end = min(len(self.buffer), self.position + size)
+            data = memoryview(self.buffer)[self.position:end]
+            size -= end - self.position
+            self.remaining -= end - self.position
+            self.position = end
+            yield data
+
+    def read_block_indexes(self):
+        """
+        Returns the indexes of the changed blocks of an incremental
+        record, before their data.
+        """
+        if self.remaining < COUNT_SIZE:
+            raise ValueError('Read beyond the rsync record data')
+        start = self._read(COUNT_SIZE)
+        count, = struct.unpack_from(COUNT_FORMAT, self.buffer, start)
+        if self.remaining < block_indexes_size(count):
+            raise ValueError('Read beyond the rsync record data')
+        self.remaining -= block_indexes_size(count)
+        start = self._read(count * INDEX_SIZE)
+        return struct.unpack_from(
+            '<{0}{1}'.format(count, INDEX_FORMAT), self.buffer, start)
+
+    def skip(self):
+        """
+        Skips the data of the current record not consumed.
+        """
+        for _ in self.iter_data():
+            pass
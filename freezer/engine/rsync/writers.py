@@ -0,0 +1,205 @@
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Writers of the files restored by the rsync engine.
+
+Restoring many small files is bound by the latency of the system calls,
+so the files can be written by a pool of threads while the stream is
+parsed. The ownership, mode and modification time of the files are set
+in a final pass, once all the levels of the backup are restored.
+"""
+
+import grp
+import os
+import pwd
+import stat
+import threading
+
+from six.moves import queue
+
+# Number of messages queued for each writer thread
+WRITE_QUEUE_SIZE = 64
+# Number of writes sent in a message
+WRITE_BATCH_SIZE = 16
+
+
+def write_file(file_abs_path, incremental, size, writes):
+    """
+    Writes the data of a file.
+
+    :param file_abs_path: path of the restored file
+    :param incremental: True to update the existing file in place
+    :param size: size of the file
+    :param writes: iterable of (offset, data), the data is written at
+                   offset or after the previous data if offset is None
+    """
+    with open(file_abs_path, 'rb+' if incremental else 'wb') as file_fd:
+        for offset, data in writes:
+            if offset is not None:
+                file_fd.seek(offset)
+            file_fd.write(data)
+        if incremental:
+            file_fd.truncate(size)
+
+
+class InodeSetter(object):
+    """
+    Sets the ownership, mode and modification time of restored files,
+    resolving each user and group name once.
+
+    The fields are deferred until all the levels are restored: a file
+    made read only by a level could not be updated by the next ones, and
+    writing the files of a directory changes its modification time.
+    """
+
+    def __init__(self):
+        self.uids = {}
+        self.gids = {}
+        # Inode fields deferred by path, the ones of the newest level
+        self.deferred = {}
+        self.lock = threading.Lock()
+
+    def _resolve(self, cache, get_id, name):
+        if name not in cache:
+            try:
+                cache[name] = get_id(name)
+            except KeyError:
+                cache[name] = None
+        return cache[name]
+
+    def apply(self, file_abs_path, uname, gname, mode, mtime):
+        """
+        Sets the inode fields of a file. The file is given to the
+        current user if the owner cannot be set.
+        """
+        uid = self._resolve(self.uids, lambda name: pwd.getpwnam(
+            name).pw_uid, uname)
+        gid = self._resolve(self.gids, lambda name: grp.getgrnam(
+            name).gr_gid, gname)
+        try:
+            if uid is None or gid is None:
+                raise OSError('Unknown user or group {0}:{1}'.format(
+                    uname, gname))
+            os.chown(file_abs_path, uid, gid)
+        except (IOError, OSError):
+            try:
+                os.chown(file_abs_path, os.getuid(), os.getgid())
+            except (OSError, IOError) as err:
+                raise Exception(err)
+        try:
+            os.chmod(file_abs_path, stat.S_IMODE(mode))
+            os.utime(file_abs_path, (mtime, mtime))
+        except (OSError, IOError) as err:
+            raise Exception(err)
+
+    def defer(self, file_abs_path, uname, gname, mode, mtime):
+        """
+        Sets the inode fields of a file in apply_deferred, replacing the
+        ones deferred by an older level.
+        """
+        with self.lock:
+            self.deferred[file_abs_path] = (uname, gname, mode, mtime)
+
+    def discard(self, file_abs_path):
+        """
+        Forgets the inode fields deferred for a path deleted or replaced
+        by a symbolic link.
+        """
+        with self.lock:
+            self.deferred.pop(file_abs_path, None)
+
+    def apply_deferred(self):
+        """
+        Sets the deferred inode fields, the content of a directory before
+        the directory.
+        """
+        for file_abs_path in sorted(self.deferred, reverse=True):
+            self.apply(file_abs_path, *self.deferred[file_abs_path])
+        self.deferred = {}
+
+
+class FileWriters(object):
+    """
+    Pool of threads writing the restored files. The files are
+    distributed by path and written in the order they were given.
+
+    :param workers: number of threads
+    """
+
+    def __init__(self, workers):
+        self.errors = []
+        self.queues = [queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+                       for _ in range(workers)]
+        self.threads = [threading.Thread(target=self._run, args=(q,))
+                        for q in self.queues]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def _gen_writes(file_queue, batch, last):
+        while True:
+            for write in batch:
+                yield write
+            if last:
+                return
+            batch, last = file_queue.get()
+
+    def _run(self, file_queue):
+        while True:
+            item = file_queue.get()
+            if item is None:
+                return
+            file_abs_path, incremental, size, batch, last = item
+            writes = self._gen_writes(file_queue, batch, last)
+            try:
+                write_file(file_abs_path, incremental, size, writes)
+            except Exception as error:
+                self.errors.append(error)
+                for _ in writes:
+                    pass
+
+    def write(self, file_abs_path, incremental, size, writes):
+        """
+        Queues the data of a file.
+
+        :param file_abs_path: path of the restored file
+        :param incremental: True to update the existing file in place
+        :param size: size of the file
+        :param writes: iterable of (offset, data), see write_file
+        """
+        if self.errors:
+            raise self.errors[0]
+        file_queue = self.queues[hash(file_abs_path) % len(self.queues)]
+        # The first message holds the file, the writes are sent in
+        # batches so that a small file takes one message
+        message = (file_abs_path, incremental, size)
+        batch = []
+        for write in writes:
+            batch.append(write)
+            if len(batch) == WRITE_BATCH_SIZE:
+                file_queue.put(message + (batch, False))
+                message = ()
+                batch = []
+        file_queue.put(message + (batch, True))
+
+    def close(self):
+        """
+        Waits for the queued files to be written.
+        """
+        for file_queue in self.queues:
+            file_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
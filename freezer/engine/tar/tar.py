@@ -22,6 +22,7 @@ from oslo_log import log
 
 from freezer.engine import engine
 from freezer.engine.tar import tar_builders
+from freezer.utils import compress
 from freezer.utils import winutils
 
 LOG = log.getLogger(__name__)
@@ -32,12 +33,22 @@ class TarEngine(engine.BackupEngine):
     def __init__(
             self, compression, symlinks, exclude, storage,
             max_segment_size, encrypt_key=None,
-            dry_run=False):
+            dry_run=False, compression_level=None, compress_workers=1,
+            **kwargs):
         """
             :type storage: freezer.storage.base.Storage
+        :param compression_level: compression level of the backups, None
+                                  for the default level of the algorithm
+        :param compress_workers: number of threads of the zstd and xz
+                                 compression programs
         :return:
         """
         self.compression_algo = compression
+        self.compression_level = compression_level
+        if compression_level is not None:
+            self.compression_level = compress.get_compression_level(
+                compression, compression_level)
+        self.compress_workers = max(1, int(compress_workers or 1))
         self.encrypt_pass_file = encrypt_key
         self.dereference_symlink = symlinks
         self.exclude = exclude
@@ -45,12 +56,17 @@ class TarEngine(engine.BackupEngine):
         self.is_windows = winutils.is_windows()
         self.dry_run = dry_run
         self.max_segment_size = max_segment_size
-        super(TarEngine, self).__init__(storage=storage)
+        super(TarEngine, self).__init__(storage=storage, **kwargs)
 
     @property
     def name(self):
         return "tar"
 
+    @property
+    def replayable_stream(self):
+        # openssl encrypts each stream with a new salt
+        return not self.encrypt_pass_file
+
     def metadata(self):
         return {
             "engine_name": self.name,
@@ -63,7 +79,9 @@ class TarEngine(engine.BackupEngine):
     def backup_data(self, backup_resource, manifest_path):
         LOG.info("Starting Tar engine backup stream")
         tar_command = tar_builders.TarCommandBuilder(
-            backup_resource, self.compression_algo, self.is_windows)
+            backup_resource, self.compression_algo, self.is_windows,
+            compression_level=self.compression_level,
+            compress_workers=self.compress_workers)
         if self.encrypt_pass_file:
             tar_command.set_encryption(self.encrypt_pass_file)
         if self.dereference_symlink:
@@ -131,7 +149,7 @@ class TarEngine(engine.BackupEngine):
             # the std err will be checked for errors.
             try:
                 while True:
-                    tar_process.stdin.write(read_pipe.recv_bytes())
+                    tar_process.stdin.write(read_pipe.recv_view())
             except EOFError:
                 LOG.info('Pipe closed as EOF reached. '
                          'Data transmitted successfully')
@@ -39,7 +39,8 @@ class TarCommandBuilder(object):
                         'hard': '--hard-dereference',
                         'all': '--hard-dereference --dereference'}
 
-    def __init__(self, filepath, compression_algo, is_windows, tar_path=None):
+    def __init__(self, filepath, compression_algo, is_windows, tar_path=None,
+                 compression_level=None, compress_workers=1):
         self.tar_path = tar_path or utils.tar_path()
         self.dereference = ''
         self.listed_incremental = None
@@ -48,7 +49,8 @@ class TarCommandBuilder(object):
         self.encrypt_pass_file = None
         self.output_file = None
         self.filepath = filepath
-        self.compression_algo = get_tar_flag_from_algo(compression_algo)
+        self.compression_algo = get_tar_flag_from_algo(
+            compression_algo, compression_level, compress_workers)
         self.is_windows = is_windows
 
     def set_listed_incremental(self, absolute_path):
@@ -153,7 +155,15 @@ class TarCommandRestoreBuilder(object):
         return tar_command
 
 
-def get_tar_flag_from_algo(compression):
+def get_tar_flag_from_algo(compression, level=None, threads=1):
+    """
+    Returns the tar option compressing or decompressing with an algorithm.
+    The algorithms without a tar option, and the compression levels, go
+    through the compression program.
+
+    :param level: compression level, None for the default level
+    :param threads: number of threads of the zstd and xz programs
+    """
     algo = {
         'gzip': '-z',
         'bzip2': '-j',
@@ -163,4 +173,12 @@ def get_tar_flag_from_algo(compression):
     if not compression_exec:
         raise Exception("Critical Error: {0} executable not found ".
                         format(compression))
-    return algo.get(compression)
+    threaded = compression in ('zstd', 'xz') and threads > 1
+    if compression in algo and level is None and not threaded:
+        return algo.get(compression)
+    program = [compression]
+    if level is not None:
+        program.append('-{0}'.format(level))
+    if threaded:
+        program.append('-T{0}'.format(threads))
+    return "--use-compress-program='{0}'".format(' '.join(program))
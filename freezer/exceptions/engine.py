@@ -29,3 +29,12 @@ class EngineNotFound(EngineException):
 
     def __init__(self, message):
         super(EngineNotFound, self).__init__(message)
+
+
+class ResumeException(EngineException):
+    """
+    A failed backup cannot be resumed from its journal, and starts again.
+    """
+
+    def __init__(self, message):
+        super(ResumeException, self).__init__(message)
@@ -77,7 +77,18 @@ def freezer_main(backup_args):
         storage=storage,
         max_segment_size=backup_args.max_segment_size,
         encrypt_key=backup_args.encrypt_pass_file,
-        dry_run=backup_args.dry_run
+        dry_run=backup_args.dry_run,
+        rsync_workers=backup_args.rsync_workers,
+        compress_workers=backup_args.compress_workers,
+        frame_size=backup_args.frame_size,
+        compression_level=backup_args.compression_level,
+        min_compression_level=backup_args.min_compression_level,
+        adaptive_compression=backup_args.adaptive_compression,
+        compression_dictionary=backup_args.compression_dictionary,
+        restore_prefetch=backup_args.restore_prefetch,
+        restore_spool_size=backup_args.restore_spool_size,
+        metadata_cache_dir=backup_args.metadata_cache_dir,
+        journal_dir=backup_args.journal_dir
     )
 
     if hasattr(backup_args, 'trickle_command'):
@@ -170,23 +181,39 @@ def fail(exit_code, e, quiet, do_log=True):
 def storage_from_dict(backup_args, max_segment_size):
     storage_name = backup_args['storage']
     container = backup_args['container']
+    remove_workers = int(backup_args.get(
+        'remove_workers', freezer_config.DEFAULT_PARAMS['remove_workers']))
 
     if storage_name == "swift":
         client_manager = backup_args['client_manager']
 
         storage = swift.SwiftStorage(
-            client_manager, container, max_segment_size)
+            client_manager, container, max_segment_size,
+            upload_workers=int(backup_args.get(
+                'swift_upload_workers',
+                freezer_config.DEFAULT_PARAMS['swift_upload_workers'])),
+            download_workers=int(backup_args.get(
+                'swift_download_workers',
+                freezer_config.DEFAULT_PARAMS['swift_download_workers'])),
+            read_ahead=int(backup_args.get(
+                'swift_read_ahead',
+                freezer_config.DEFAULT_PARAMS['swift_read_ahead'])),
+            slo=backup_args.get('swift_slo',
+                                freezer_config.DEFAULT_PARAMS['swift_slo']),
+            remove_workers=remove_workers)
     elif storage_name == "local":
         storage = local.LocalStorage(
             storage_path=container,
-            max_segment_size=max_segment_size)
+            max_segment_size=max_segment_size,
+            remove_workers=remove_workers)
     elif storage_name == "ssh":
         storage = ssh.SshStorage(
             container,
             backup_args['ssh_key'], backup_args['ssh_username'],
             backup_args['ssh_host'],
             int(backup_args.get('ssh_port', freezer_config.DEFAULT_SSH_PORT)),
-            max_segment_size=max_segment_size)
+            max_segment_size=max_segment_size,
+            remove_workers=remove_workers)
     else:
         raise Exception("No storage found for name {0}".format(
             backup_args['storage']))
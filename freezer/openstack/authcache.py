@@ -0,0 +1,181 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Keystone token and service catalog cache shared by the freezer-agent
+processes.
+
+Each Keystone user and scope has its own file in the cache directory,
+named after a hash of the identity parameters, the secrets left out.
+The cache directory and files are only readable by their owner and the
+files are replaced atomically.
+"""
+
+import calendar
+import hashlib
+import json
+import os
+import stat
+import time
+import uuid
+
+from keystoneauth1 import session
+from oslo_log import log
+
+from freezer.utils import winutils
+
+LOG = log.getLogger(__name__)
+
+# Seconds before its expiry a cached token is not used anymore
+EXPIRY_MARGIN = 300
+
+# Authentication arguments naming the user and the scope of a token
+IDENTITY_OPTIONS = ('username', 'user_id', 'user_domain_name',
+                    'user_domain_id', 'project_name', 'project_id',
+                    'tenant_name', 'tenant_id', 'project_domain_name',
+                    'project_domain_id', 'domain_name', 'domain_id')
+
+
+def cache_key(auth_url, auth_method, options):
+    """
+    :param options: authentication arguments of OSClientManager
+    :return: name of the cache file of the arguments, None if they do not
+             name a user
+    """
+    params = dict((name, options[name]) for name in IDENTITY_OPTIONS
+                  if options.get(name))
+    if not params.get('username') and not params.get('user_id'):
+        return None
+    params.update(auth_url=auth_url, auth_method=auth_method)
+    return hashlib.sha256(json.dumps(
+        params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class CachedAuthSession(session.Session):
+    """
+    Keystone session saving its authentication state to an AuthCache
+    once it authenticates, on its first request.
+
+    :type auth_cache: AuthCache
+    """
+
+    def __init__(self, auth_cache, **kwargs):
+        super(CachedAuthSession, self).__init__(**kwargs)
+        self.auth_cache = auth_cache
+
+    def get_auth_headers(self, auth=None, **kwargs):
+        headers = super(CachedAuthSession, self).get_auth_headers(
+            auth, **kwargs)
+        self.auth_cache.update(auth or self.auth)
+        return headers
+
+
+class AuthCache(object):
+    """
+    :param cache_dir: directory of the cache files, created if needed
+    :param key: name of the cache file, from cache_key
+    """
+
+    def __init__(self, cache_dir, key):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.path = os.path.join(self.cache_dir, key)
+        # Authentication of the plugin last restored or saved
+        self.auth_ref = None
+
+    def check_dir(self):
+        """
+        Checks that the cache directory is only accessible by its owner,
+        the user running freezer.
+
+        :raise IOError: if the directory is not
+        """
+        if winutils.is_windows():
+            return
+        dir_stat = os.stat(self.cache_dir)
+        if (dir_stat.st_uid != os.getuid() or
+                stat.S_IMODE(dir_stat.st_mode) & 0o077):
+            raise IOError('{0} must be owned by the user and only '
+                          'accessible by them'.format(self.cache_dir))
+
+    def load(self):
+        """
+        :return: the cached authentication state, None if missing or
+                 about to expire
+        """
+        if not os.path.isdir(self.cache_dir):
+            return None
+        try:
+            self.check_dir()
+        except IOError as error:
+            LOG.warning('Not using the token cache: {0}'.format(error))
+            return None
+        try:
+            with open(self.path, 'r') as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('expires_at', 0) < time.time() + EXPIRY_MARGIN:
+            return None
+        return entry.get('auth_state')
+
+    def save(self, auth_state, expires_at):
+        """
+        :param auth_state: authentication state of a keystoneauth plugin
+        :param expires_at: expiry of the token, as a UTC datetime
+        """
+        entry = {'auth_state': auth_state,
+                 'expires_at': calendar.timegm(expires_at.utctimetuple())}
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, 0o700)
+        self.check_dir()
+        tmp_path = '{0}.{1}'.format(self.path, uuid.uuid4().hex)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(entry, cache_file)
+            if winutils.is_windows() and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def restore(self, auth):
+        """
+        Installs the cached authentication state, if any, in a
+        keystoneauth plugin. The plugin authenticates when its session
+        is first used, if the cached token is missing or expired.
+
+        :param auth: keystoneauth identity plugin
+        """
+        auth_state = self.load()
+        if auth_state:
+            LOG.debug('Using the cached token')
+            auth.set_auth_state(auth_state)
+            self.auth_ref = auth.auth_ref
+
+    def update(self, auth):
+        """
+        Caches the authentication state of a keystoneauth plugin, if it
+        authenticated since it was restored or saved.
+
+        :param auth: keystoneauth identity plugin
+        """
+        auth_ref = auth.auth_ref
+        if auth_ref is None or auth_ref is self.auth_ref:
+            return
+        self.auth_ref = auth_ref
+        try:
+            self.save(auth.get_auth_state(), auth_ref.expires)
+        except (IOError, OSError) as error:
+            LOG.warning('Cannot cache the token: {0}'.format(error))
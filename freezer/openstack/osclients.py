@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import os
+import threading
 import time
 
 from cinderclient import client as cinder_client
@@ -25,6 +26,7 @@ from oslo_config import cfg
 from oslo_log import log
 import swiftclient
 
+from freezer.openstack import authcache
 from freezer.utils import utils
 
 CONF = cfg.CONF
@@ -39,6 +41,7 @@ class OSClientManager(object):
         self.nova = None
         self.cinder = None
         self.dry_run = kwargs.pop('dry_run', None)
+        auth_cache_dir = kwargs.pop('auth_cache_dir', None)
         loader = loading.get_plugin_loader(auth_method)
         # copy the args for swift authentication !
         self.swift_args = kwargs.copy()
@@ -71,7 +74,19 @@ class OSClientManager(object):
         self.volume_version = kwargs.pop('volume_api_version', 2)
         self.auth = loader.load_from_options(auth_url=auth_url, **kwargs)
 
-        self.sess = session.Session(auth=self.auth, **session_kwargs)
+        self.swift_pool = SwiftConnectionPool(self._new_swift)
+        self.auth_cache = None
+        cache_key = authcache.cache_key(auth_url, auth_method,
+                                        self.swift_args)
+        if auth_cache_dir and cache_key:
+            # The session authenticates on its first request, if the
+            # cached token is missing or expired
+            self.auth_cache = authcache.AuthCache(auth_cache_dir, cache_key)
+            self.auth_cache.restore(self.auth)
+            self.sess = authcache.CachedAuthSession(
+                self.auth_cache, auth=self.auth, **session_kwargs)
+        else:
+            self.sess = session.Session(auth=self.auth, **session_kwargs)
 
     def create_nova(self):
         """
@@ -108,9 +123,23 @@ class OSClientManager(object):
         return self.cinder
 
     def create_swift(self):
+        """
+        Replaces the Swift connection returned by get_swift. The new
+        connection reuses the token of the previous ones: it authenticates
+        again only if the token expired.
+        :return: swiftclient instance
+        """
+        if self.swift:
+            self.swift_pool.remember(self.swift)
+        self.swift = self.swift_pool.create()
+        return self.swift
+
+    def _new_swift(self, preauthurl=None, preauthtoken=None):
         """
         Swift client needs to be treated differently so we need to copy the
         arguments and provide it to swiftclient the correct way !
+        :param preauthurl: storage URL of a previous authentication
+        :param preauthtoken: token of a previous authentication
         :return: swiftclient instance
         """
         os_options = {}
@@ -118,16 +147,16 @@ class OSClientManager(object):
         if 'region_name' in self.swift_args.keys():
             os_options['region_name'] = self.swift_args.get('region_name')
         if 'endpoint_type' in self.swift_args.keys():
-            os_options['endpoint_type'] = self.swift_args.pop('endpoint_type')
+            os_options['endpoint_type'] = self.swift_args.get('endpoint_type')
         if 'tenant_id' in self.swift_args.keys():
-            os_options['tenant_id'] = self.swift_args.pop('tenant_id')
+            os_options['tenant_id'] = self.swift_args.get('tenant_id')
         if 'identity_api_version' in self.swift_args.keys():
             os_options['identity_api_version'] = \
-                self.swift_args.pop('identity_api_version')
+                self.swift_args.get('identity_api_version')
             auth_version = os_options['identity_api_version']
 
         if 'token' in self.swift_args.keys():
-            os_options['auth_token'] = self.swift_args.pop('token')
+            os_options['auth_token'] = self.swift_args.get('token')
         if 'auth_version' in self.swift_args.keys():
             auth_version = self.swift_args.get('auth_version')
         os_options['project_domain_name'] = \
@@ -141,7 +170,10 @@ class OSClientManager(object):
 
         tenant_name = self.swift_args.get('project_name') or self.swift_args.\
             get('tenant_name')
-        self.swift = swiftclient.client.Connection(
+        # With the token cache, Swift uses the cached token and catalog of
+        # the Keystone session
+        sess = self.sess if self.auth_cache else None
+        swift = swiftclient.client.Connection(
             authurl=self.swift_args.get('auth_url'),
             user=self.swift_args.get('username'),
             key=self.swift_args.get('password'),
@@ -149,12 +181,15 @@ class OSClientManager(object):
             insecure=self.swift_args.get('insecure', False),
             cacert=self.swift_args.get('cacert', None),
             os_options=os_options,
-            auth_version=auth_version
+            auth_version=auth_version,
+            preauthurl=preauthurl,
+            preauthtoken=preauthtoken,
+            session=sess
         )
 
         if self.dry_run:
-            self.swift = DryRunSwiftclientConnectionWrapper(self.swift)
-        return self.swift
+            swift = DryRunSwiftclientConnectionWrapper(swift)
+        return swift
 
     def get_nova(self):
         """
@@ -493,13 +528,111 @@ class OpenstackOpts(object):
         )
 
 
+class SwiftConnectionPool(object):
+    """
+    Thread-safe pool of Swift connections. A connection returned to the
+    pool keeps its keep-alive HTTP session for the next thread, and the
+    connections share the storage URL and token of the last one used: a
+    connection authenticates with Keystone again only when swiftclient
+    gets a 401.
+
+    The connections are not shared with forked processes, which start
+    with an empty pool and the token.
+
+    :param factory: function creating a connection from a storage URL and
+                    a token, None to authenticate
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.idle = []
+        self.url = None
+        self.token = None
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            # The sockets belong to the parent process
+            self.pid = os.getpid()
+            self.lock = threading.Lock()
+            self.idle = []
+
+    def _lend(self, connection):
+        """
+        Gives the last token to a connection, remembering it to detect
+        when the connection authenticates again.
+        """
+        client = getattr(connection, 'sw_connector', connection)
+        if self.token:
+            client.url, client.token = self.url, self.token
+        client.pool_token = self.token
+        return connection
+
+    def remember(self, connection):
+        """
+        Keeps the token of a connection for the next ones, if the
+        connection authenticated again.
+        """
+        self._check_pid()
+        client = getattr(connection, 'sw_connector', connection)
+        if client.url and client.token and client.token != getattr(
+                client, 'pool_token', None):
+            with self.lock:
+                self.url, self.token = client.url, client.token
+            client.pool_token = client.token
+
+    def create(self):
+        """
+        Returns a new connection with the last token.
+        """
+        self._check_pid()
+        with self.lock:
+            url, token = self.url, self.token
+        connection = self.factory(url, token)
+        getattr(connection, 'sw_connector', connection).pool_token = token
+        return connection
+
+    def get(self):
+        """
+        Returns an idle connection, or a new one.
+        """
+        with self.lock:
+            if self.idle:
+                # Another connection may have renewed the token
+                return self._lend(self.idle.pop())
+        return self.create()
+
+    def put(self, connection):
+        """
+        Returns a connection to the pool.
+        """
+        self.remember(connection)
+        with self.lock:
+            self.idle.append(connection)
+
+    def discard(self, connection):
+        """
+        Closes a connection that failed instead of returning it.
+        """
+        self.remember(connection)
+        try:
+            getattr(connection, 'sw_connector', connection).close()
+        except Exception as error:
+            LOG.debug('Cannot close Swift connection: {0}'.format(error))
+
+
 class DryRunSwiftclientConnectionWrapper(object):
     def __init__(self, sw_connector):
         self.sw_connector = sw_connector
         self.get_object = sw_connector.get_object
         self.get_account = sw_connector.get_account
         self.get_container = sw_connector.get_container
+        self.head_container = sw_connector.head_container
         self.head_object = sw_connector.head_object
+        # Without the capabilities, no bulk delete is sent
+        self.get_capabilities = self.dummy
+        self.post_account = self.dummy
         self.put_object = self.dummy
         self.put_container = self.dummy
         self.delete_object = self.dummy
@@ -43,11 +43,14 @@ class Storage(object):
         pass
 
     @abc.abstractmethod
-    def write_backup(self, rich_queue, backup):
+    def write_backup(self, rich_queue, backup, journal=None):
         """
         :param rich_queue:
         :param backup:
         :type backup: freezer.storage.base.Backup
+        :type journal: freezer.engine.journal.BackupJournal
+        :param journal: journal of the backup in progress, physical storages
+                        record the stored messages in it
         :return:
         """
         pass
@@ -119,8 +122,13 @@ class Storage(object):
         """
         backups = self.get_level_zero(engine, hostname_backup_name,
                                       remove_older_timestamp)
+        storages = []
         for backup in backups:
-            backup.remove()
+            if backup.storage not in storages:
+                storages.append(backup.storage)
+        for storage in storages:
+            storage.remove_backups([backup for backup in backups
+                                    if backup.storage is storage])
 
     @abc.abstractmethod
     def info(self):
@@ -255,8 +263,7 @@ class Backup(object):
             storage=storage)
 
     def remove(self):
-        self.storage.rmtree(self.increments_metadata_path)
-        self.storage.rmtree(self.increments_data_path)
+        self.storage.remove_backups([self])
 
     def get_increments(self):
         """
@@ -265,18 +272,16 @@ class Backup(object):
         :rtype: dict[int, freezer.storage.base.Backup]
         :return: Dictionary[backup_level, backup]
         """
-        increments = self.storage.listdir(self.increments_metadata_path)
-        sorted(increments)
-        increments = [name.split('_') for name in increments]
+        increments = self.storage.list_increments(self)
 
-        return {int(increment[0]): Backup(
+        return {level: Backup(
             storage=self.storage,
             engine=self.engine,
             hostname_backup_name=self.hostname_backup_name,
-            timestamp=int(increment[1]),
+            timestamp=timestamp,
             level_zero_timestamp=self.level_zero_timestamp,
-            level=int(increment[0])
-        ) for increment in increments}
+            level=level
+        ) for level, timestamp in increments}
 
     def metadata(self):
         metadata_file = tempfile.NamedTemporaryFile('wb', delete=True)
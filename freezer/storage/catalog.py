@@ -0,0 +1,76 @@
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Catalog of the backups of a hostname_backup_name.
+
+The catalog is a single object of the storage listing the level zero
+backups and their increments, so that finding the previous backup or the
+backups to restore reads one object instead of listing the metadata of
+every backup. It is updated before the metadata of each backup is
+written, checked against the listing of the last level zero backup when
+read, and rebuilt from the listing when it does not match it, or is
+missing or unreadable.
+"""
+
+import json
+
+CATALOG_VERSION = 1
+
+
+class Catalog(object):
+    """
+    :param backups: dictionary of the increments by level zero timestamp,
+                    as dictionaries of the timestamps by level
+    """
+
+    def __init__(self, backups=None):
+        self.backups = backups or {}
+
+    @classmethod
+    def loads(cls, data):
+        """
+        :raises ValueError: on an unknown or damaged catalog
+        """
+        content = json.loads(data)
+        if content.get('version') != CATALOG_VERSION:
+            raise ValueError('Unknown catalog version {0}'.format(
+                content.get('version')))
+        return cls({int(level_zero_timestamp): {
+            int(level): int(timestamp)
+            for level, timestamp in increments.items()}
+            for level_zero_timestamp, increments
+            in content['backups'].items()})
+
+    def dumps(self):
+        return json.dumps({
+            'version': CATALOG_VERSION,
+            'backups': {str(level_zero_timestamp): {
+                str(level): timestamp
+                for level, timestamp in increments.items()}
+                for level_zero_timestamp, increments
+                in self.backups.items()}}, sort_keys=True)
+
+    def add(self, level_zero_timestamp, level, timestamp):
+        self.backups.setdefault(level_zero_timestamp, {})[level] = timestamp
+
+    def remove(self, level_zero_timestamp):
+        self.backups.pop(level_zero_timestamp, None)
+
+    def level_zero_timestamps(self):
+        return sorted(self.backups)
+
+    def increments(self, level_zero_timestamp):
+        """
+        :return: list of (level, timestamp) of the increments
+        """
+        return sorted(self.backups.get(level_zero_timestamp, {}).items())
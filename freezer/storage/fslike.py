@@ -13,10 +13,13 @@
 # limitations under the License.
 
 import abc
+import hashlib
 import json
+import os
 
 import six
 
+from freezer.exceptions import engine as engine_exceptions
 from freezer.storage import physical
 
 
@@ -25,11 +28,12 @@ class FsLikeStorage(physical.PhysicalStorage):
     _type = 'fslike'
 
     def __init__(self, storage_path,
-                 max_segment_size, skip_prepare=False):
+                 max_segment_size, skip_prepare=False, remove_workers=1):
         super(FsLikeStorage, self).__init__(
             storage_path=storage_path,
             max_segment_size=max_segment_size,
-            skip_prepare=skip_prepare)
+            skip_prepare=skip_prepare,
+            remove_workers=remove_workers)
 
     def prepare(self):
         self.create_dirs(self.storage_path)
@@ -37,20 +41,44 @@ class FsLikeStorage(physical.PhysicalStorage):
     def info(self):
         pass
 
-    def write_backup(self, rich_queue, backup):
+    def write_backup(self, rich_queue, backup, journal=None):
         """
         Stores backup in storage
         :type rich_queue: freezer.streaming.RichQueue
         :type backup: freezer.storage.base.Backup
+        :type journal: freezer.engine.journal.BackupJournal
+        :param journal: journal of the backup, recording the written
+                        messages. The data of a resumed backup is kept up
+                        to the end of its resumed segments.
         """
         backup = backup.copy(storage=self)
         path = backup.data_path
         self.create_dirs(path.rsplit('/', 1)[0])
 
-        with self.open(path, mode='wb') as \
-                b_file:
-            for message in rich_queue.get_messages():
+        first = len(journal.resumed_segments) if journal else 0
+        if first:
+            offset = journal.resumed_offset
+            try:
+                b_file = self.open(path, mode='r+b')
+                b_file.seek(0, os.SEEK_END)
+                if b_file.tell() < offset:
+                    raise IOError('{0} bytes stored'.format(b_file.tell()))
+            except (IOError, OSError) as e:
+                raise engine_exceptions.ResumeException(
+                    'Cannot continue {0}: {1}'.format(path, e))
+            b_file.seek(offset)
+            b_file.truncate(offset)
+        else:
+            b_file = self.open(path, mode='wb')
+
+        with b_file:
+            for index, message in enumerate(rich_queue.get_messages(),
+                                            first):
                 b_file.write(message)
+                if journal:
+                    b_file.flush()
+                    journal.commit(index, len(message),
+                                   hashlib.md5(message).hexdigest())
 
     def backup_blocks(self, backup):
         """
@@ -20,6 +20,7 @@ import os
 import shutil
 
 from freezer.storage import fslike
+from freezer.storage import physical
 from freezer.utils import utils
 
 
@@ -32,6 +33,10 @@ class LocalStorage(fslike.FsLikeStorage):
     def put_file(self, from_path, to_path):
         shutil.copyfile(from_path, to_path)
 
+    def file_signature(self, path):
+        stat = os.stat(path)
+        return '{0}:{1}'.format(stat.st_size, stat.st_mtime)
+
     def listdir(self, directory):
         try:
             return os.listdir(directory)
@@ -44,5 +49,19 @@ class LocalStorage(fslike.FsLikeStorage):
     def rmtree(self, path):
         shutil.rmtree(path)
 
+    def rmtrees(self, paths):
+        paths = [path for path in paths if os.path.exists(path)]
+        files = [os.path.join(root, name) for path in paths
+                 for root, dirs, names in os.walk(path) for name in names]
+
+        def remove(path):
+            os.remove(path)
+            return 1
+
+        physical.remove_in_parallel(remove, files, self.remove_workers,
+                                    len(files))
+        for path in paths:
+            shutil.rmtree(path)
+
     def open(self, filename, mode):
         return io.open(filename, mode)
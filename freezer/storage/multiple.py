@@ -30,7 +30,7 @@ class MultipleStorage(base.Storage):
         for s in self.storages:
             s.info()
 
-    def write_backup(self, rich_queue, backup):
+    def write_backup(self, rich_queue, backup, journal=None):
         output_queues = [streaming.RichQueue() for x in self.storages]
         except_queues = [queue.Queue() for x in self.storages]
         threads = ([streaming.QueuedThread(storage.write_backup, output_queue,
@@ -17,12 +17,71 @@ limitations under the License.
 
 import abc
 import os
+import shutil
+import tempfile
+import threading
 
+from oslo_log import log
 import six
+from six.moves import queue
 
 from freezer.storage import base
+from freezer.storage import catalog
 from freezer.utils import utils
 
+LOG = log.getLogger(__name__)
+
+
+def remove_in_parallel(remove, items, workers, total, kind='files'):
+    """
+    Calls remove on each item with a pool of threads, logging the progress,
+    and raises the first error met once the threads are done.
+
+    :param remove: function removing an item and returning the number of
+                   files removed
+    :param items: list of the items to remove
+    :param workers: number of items removed at the same time
+    :param total: number of files of the items
+    :param kind: name of the files in the progress messages
+    """
+    pending = queue.Queue()
+    for item in items:
+        pending.put(item)
+    lock = threading.Lock()
+    errors = []
+    # Files removed and files removed at the last progress message
+    progress = [0, 0]
+    step = max(1, total // 10)
+
+    def run():
+        while not errors:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                removed = remove(item)
+            except Exception as error:
+                LOG.error('Cannot remove {0}: {1}'.format(item, error))
+                errors.append(error)
+                return
+            with lock:
+                progress[0] += removed
+                if progress[0] - progress[1] >= step or progress[0] == total:
+                    progress[1] = progress[0]
+                    LOG.info('Removed {0}/{1} {2}'.format(
+                        progress[0], total, kind))
+
+    threads = [threading.Thread(target=run)
+               for _ in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
 
 @six.add_metaclass(abc.ABCMeta)
 class PhysicalStorage(base.Storage):
@@ -32,15 +91,174 @@ class PhysicalStorage(base.Storage):
     """
 
     def __init__(self, storage_path, max_segment_size,
-                 skip_prepare=False):
+                 skip_prepare=False, remove_workers=1):
+        """
+        :param remove_workers: number of files removed at the same time
+                               when removing backups
+        """
         self.storage_path = storage_path
         self.max_segment_size = max_segment_size
+        self.remove_workers = max(1, int(remove_workers or 1))
+        # Catalogs read or written by path
+        self.catalogs = {}
         super(PhysicalStorage, self).__init__(skip_prepare=skip_prepare)
 
     def metadata_path(self, engine, hostname_backup_name):
         return utils.path_join(self.storage_path, "metadata", engine.name,
                                hostname_backup_name)
 
+    def catalog_path(self, engine, hostname_backup_name):
+        return utils.path_join(self.storage_path, "catalog", engine.name,
+                               hostname_backup_name, "catalog")
+
+    def get_catalog(self, engine, hostname_backup_name):
+        """
+        Reads the catalog of a backup name, once per storage instance.
+
+        The catalog is checked against the listing of the level zero
+        backups and of the increments of the last one, where a backup
+        missing from the catalog or listed without its metadata would be,
+        and rebuilt from the listing if they differ.
+
+        :type engine: freezer.engine.engine.BackupEngine
+        :type hostname_backup_name: str
+        :rtype: freezer.storage.catalog.Catalog
+        :return: the catalog, None if missing or unreadable
+        """
+        path = self.catalog_path(engine, hostname_backup_name)
+        if path in self.catalogs:
+            return self.catalogs[path]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            catalog_file = os.path.join(tmpdir, "catalog")
+            self.get_file(path, catalog_file)
+            with open(catalog_file) as catalog_fd:
+                backups = catalog.Catalog.loads(catalog_fd.read())
+        except Exception as e:
+            LOG.info('No catalog of {0}, listing the backups: {1}'.format(
+                hostname_backup_name, e))
+            return None
+        finally:
+            shutil.rmtree(tmpdir)
+        if not self.catalog_matches(engine, hostname_backup_name, backups):
+            LOG.warning('The catalog of {0} does not match the backups, '
+                        'listing them'.format(hostname_backup_name))
+            backups = self.rebuild_catalog(engine, hostname_backup_name)
+        self.catalogs[path] = backups
+        return backups
+
+    def catalog_matches(self, engine, hostname_backup_name, backups):
+        """
+        Compares a catalog with the listing of the level zero backups and
+        of the increments of the last one.
+
+        :type backups: freezer.storage.catalog.Catalog
+        """
+        path = self.metadata_path(engine, hostname_backup_name)
+        timestamps = sorted(int(level_zero_timestamp) for level_zero_timestamp
+                            in self.listdir(path))
+        if timestamps != backups.level_zero_timestamps():
+            return False
+        if not timestamps:
+            return True
+        increments = self.listdir(utils.path_join(path, str(timestamps[-1])))
+        return sorted((int(level), int(timestamp)) for level, timestamp in
+                      (increment.split('_') for increment in increments)
+                      ) == backups.increments(timestamps[-1])
+
+    def rebuild_catalog(self, engine, hostname_backup_name):
+        """
+        Builds the catalog of a backup name from the listing of the
+        backups.
+
+        :rtype: freezer.storage.catalog.Catalog
+        """
+        backups = catalog.Catalog()
+        path = self.metadata_path(engine, hostname_backup_name)
+        for level_zero_timestamp in self.listdir(path):
+            increments = self.listdir(utils.path_join(
+                path, level_zero_timestamp))
+            for increment in increments:
+                level, timestamp = increment.split('_')
+                backups.add(int(level_zero_timestamp), int(level),
+                            int(timestamp))
+        return backups
+
+    def put_catalog(self, engine, hostname_backup_name, backups):
+        """
+        :type backups: freezer.storage.catalog.Catalog
+        """
+        path = self.catalog_path(engine, hostname_backup_name)
+        self.catalogs[path] = backups
+        tmpdir = tempfile.mkdtemp()
+        try:
+            catalog_file = os.path.join(tmpdir, "catalog")
+            with open(catalog_file, 'w') as catalog_fd:
+                catalog_fd.write(backups.dumps())
+            self.create_dirs(os.path.dirname(path))
+            self.put_file(catalog_file, path)
+        except Exception as e:
+            LOG.warning('Cannot update the catalog of {0}: {1}'.format(
+                hostname_backup_name, e))
+            self.remove_catalog(engine, hostname_backup_name)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def remove_catalog(self, engine, hostname_backup_name):
+        """
+        Removes the catalog of a backup name, out of date after a failed
+        update, so that the next run rebuilds it from the listing of the
+        backups.
+        """
+        path = self.catalog_path(engine, hostname_backup_name)
+        self.catalogs.pop(path, None)
+        try:
+            self.rmtrees([os.path.dirname(path)])
+        except Exception as e:
+            LOG.error('Cannot remove the out of date catalog {0}, remove '
+                      'it to list the backups: {1}'.format(path, e))
+
+    def update_catalog(self, backups, removed=False):
+        """
+        Adds backups to the catalogs of their backup names, or removes
+        their level zero backups and increments, each catalog written
+        once.
+
+        :type backups: list[freezer.storage.base.Backup]
+        """
+        names = []
+        for backup in backups:
+            if (backup.engine, backup.hostname_backup_name) not in names:
+                names.append((backup.engine, backup.hostname_backup_name))
+        for engine, hostname_backup_name in names:
+            entries = self.get_catalog(engine, hostname_backup_name)
+            if entries is None:
+                entries = self.rebuild_catalog(engine, hostname_backup_name)
+            for backup in backups:
+                if (backup.engine != engine or
+                        backup.hostname_backup_name != hostname_backup_name):
+                    continue
+                if removed:
+                    entries.remove(backup.level_zero_timestamp)
+                else:
+                    entries.add(backup.level_zero_timestamp, backup.level,
+                                backup.timestamp)
+            self.put_catalog(engine, hostname_backup_name, entries)
+
+    def list_increments(self, backup):
+        """
+        :type backup: freezer.storage.base.Backup
+        :return: list of (level, timestamp) of the increments of the level
+                 zero backup of backup
+        """
+        backups = self.get_catalog(backup.engine,
+                                   backup.hostname_backup_name)
+        if backups is not None:
+            return backups.increments(backup.level_zero_timestamp)
+        increments = self.listdir(backup.increments_metadata_path)
+        return [(int(level), int(timestamp)) for level, timestamp in
+                (increment.split('_') for increment in increments)]
+
     def get_level_zero(self,
                        engine,
                        hostname_backup_name,
@@ -58,9 +276,13 @@ class PhysicalStorage(base.Storage):
         :return: dictionary of level zero timestamps with attached storage
         """
 
-        path = self.metadata_path(
-            engine=engine,
-            hostname_backup_name=hostname_backup_name)
+        backups = self.get_catalog(engine, hostname_backup_name)
+        if backups is not None:
+            timestamps = backups.level_zero_timestamps()
+        else:
+            timestamps = self.listdir(self.metadata_path(
+                engine=engine,
+                hostname_backup_name=hostname_backup_name))
 
         zeros = [base.Backup(
             storage=self,
@@ -68,12 +290,20 @@ class PhysicalStorage(base.Storage):
             hostname_backup_name=hostname_backup_name,
             level_zero_timestamp=int(t),
             timestamp=int(t),
-            level=0) for t in self.listdir(path)]
+            level=0) for t in timestamps]
         if recent_to_date:
             zeros = [zero for zero in zeros
                      if zero.timestamp <= recent_to_date]
         return zeros
 
+    def file_signature(self, path):
+        """
+        :param path: path of a stored file
+        :return: string changing with the content of the file, without
+                 reading it, None if the storage cannot tell
+        """
+        return None
+
     @abc.abstractmethod
     def backup_blocks(self, backup):
         """
@@ -104,9 +334,43 @@ class PhysicalStorage(base.Storage):
         :return:
         """
         backup = backup.copy(self)
-        self.put_file(engine_metadata_path, backup.engine_metadata_path)
-        self.create_dirs(os.path.dirname(backup.metadata_path))
-        self.put_file(freezer_metadata_path, backup.metadata_path)
+        # Listed by the catalog first: a backup whose metadata is not
+        # written is then in the catalog only, which get_catalog detects
+        self.update_catalog([backup])
+        try:
+            self.put_file(engine_metadata_path, backup.engine_metadata_path)
+            self.create_dirs(os.path.dirname(backup.metadata_path))
+            self.put_file(freezer_metadata_path, backup.metadata_path)
+        except Exception:
+            # Read and checked again
+            self.catalogs.pop(self.catalog_path(
+                backup.engine, backup.hostname_backup_name), None)
+            raise
+
+    def remove_backups(self, backups):
+        """
+        Removes level zero backups with their increments, the files of all
+        the backups at once.
+
+        :type backups: list[freezer.storage.base.Backup]
+        """
+        LOG.info('Removing {0} level zero backups'.format(len(backups)))
+        paths = []
+        for backup in backups:
+            paths.append(backup.increments_metadata_path)
+            paths.append(backup.increments_data_path)
+        self.rmtrees(paths)
+        self.update_catalog(backups, removed=True)
+
+    def rmtrees(self, paths):
+        """
+        Removes several directories, one after the other unless the storage
+        removes their files in parallel.
+
+        :param paths: list of the paths of the directories
+        """
+        for path in paths:
+            self.rmtree(path)
 
     @abc.abstractmethod
     def rmtree(self, path):
@@ -18,10 +18,12 @@ limitations under the License.
 import errno
 import os
 import stat
+import threading
 
 import paramiko
 
 from freezer.storage import fslike
+from freezer.storage import physical
 from freezer.utils import utils
 
 CHUNK_SIZE = 32768
@@ -34,10 +36,13 @@ class SshStorage(fslike.FsLikeStorage):
     _type = 'ssh'
 
     def __init__(self, storage_path, ssh_key_path,
-                 remote_username, remote_ip, port, max_segment_size):
+                 remote_username, remote_ip, port, max_segment_size,
+                 remove_workers=1):
         """
             :param storage_path: directory of storage
             :type storage_path: str
+            :param remove_workers: number of files removed at the same
+                                   time, each one with its own SFTP channel
             :return:
             """
         self.ssh_key_path = ssh_key_path
@@ -50,7 +55,8 @@ class SshStorage(fslike.FsLikeStorage):
         self.init()
         super(SshStorage, self).__init__(
             storage_path=storage_path,
-            max_segment_size=max_segment_size)
+            max_segment_size=max_segment_size,
+            remove_workers=remove_workers)
 
     def _validate(self):
         """
@@ -77,18 +83,53 @@ class SshStorage(fslike.FsLikeStorage):
         self.ssh = ssh
         self.ftp = self.ssh.open_sftp()
 
-    def _is_dir(self, check_dir):
-        return stat.S_IFMT(self.ftp.stat(check_dir).st_mode) == stat.S_IFDIR
-
     def rmtree(self, path):
-        files = self.ftp.listdir(path=path)
-        for f in files:
-            filepath = utils.path_join(path, f)
-            if self._is_dir(filepath):
-                self.rmtree(filepath)
+        self.rmtrees([path])
+
+    def _walk(self, path, files, dirs):
+        """
+        Lists the files and the directories of a directory, the directories
+        before their content.
+        """
+        try:
+            attributes = self.ftp.listdir_attr(path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        dirs.append(path)
+        for attribute in attributes:
+            filepath = utils.path_join(path, attribute.filename)
+            if stat.S_ISDIR(attribute.st_mode):
+                self._walk(filepath, files, dirs)
             else:
-                self.ftp.remove(filepath)
-        self.ftp.rmdir(path)
+                files.append(filepath)
+
+    def rmtrees(self, paths):
+        if not self.ssh.get_transport().is_alive():
+            self.init()
+        files = []
+        dirs = []
+        for path in paths:
+            self._walk(path, files, dirs)
+        channels = threading.local()
+        opened = []
+
+        def remove(path):
+            if not hasattr(channels, 'ftp'):
+                channels.ftp = self.ssh.open_sftp()
+                opened.append(channels.ftp)
+            channels.ftp.remove(path)
+            return 1
+
+        try:
+            physical.remove_in_parallel(remove, files, self.remove_workers,
+                                        len(files))
+        finally:
+            for ftp in opened:
+                ftp.close()
+        for path in reversed(dirs):
+            self.ftp.rmdir(path)
 
     def create_dirs(self, path):
         """Change to this directory, recursively making new folders if needed.
@@ -117,6 +158,10 @@ class SshStorage(fslike.FsLikeStorage):
     def put_file(self, from_path, to_path):
         self.ftp.put(from_path, to_path)
 
+    def file_signature(self, path):
+        stat = self.ftp.stat(path)
+        return '{0}:{1}'.format(stat.st_size, stat.st_mtime)
+
     def listdir(self, directory):
         try:
             # paramiko SFTPClient.listdir_attr returns
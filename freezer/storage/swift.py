@@ -15,12 +15,19 @@ limitations under the License.
 
 """
 
+import hashlib
+import json
 import os
+import random
+import threading
 import time
 
 from oslo_log import log
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from six.moves import queue
+from six.moves.urllib import parse
+import swiftclient
 
 from freezer.storage import physical
 
@@ -28,6 +35,236 @@ LOG = log.getLogger(__name__)
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# Number of attempts to upload a segment
+UPLOAD_ATTEMPTS = 10
+# Number of attempts to download a segment
+DOWNLOAD_ATTEMPTS = 5
+# Number of attempts to delete an object or a batch of objects
+DELETE_ATTEMPTS = 5
+# Bounds of the exponential backoff between two attempts, in seconds
+UPLOAD_RETRY_DELAY = 1
+UPLOAD_RETRY_MAX_DELAY = 60
+# Default max_manifest_segments of the Swift Static Large Objects
+SLO_MAX_SEGMENTS = 1000
+
+
+def retry_delay(attempt):
+    """
+    Returns the time to wait after a failed attempt. Full jitter spreads
+    the retries of the threads of a pool.
+    """
+    return random.uniform(0, min(UPLOAD_RETRY_MAX_DELAY,
+                                 UPLOAD_RETRY_DELAY * 2 ** attempt))
+
+
+class SegmentUploader(object):
+    """
+    Uploads segments with a pool of threads, each one with its own Swift
+    connection. A segment is queued once a thread is available, so that
+    the producer of the segments waits for the uploads.
+
+    :type storage: SwiftStorage
+    :param workers: number of segments uploaded at the same time
+    :type journal: freezer.engine.journal.BackupJournal
+    :param journal: journal recording the uploaded segments
+    """
+
+    def __init__(self, storage, workers, journal=None):
+        self.storage = storage
+        self.journal = journal
+        self.errors = []
+        # Etags of the uploaded segments by path
+        self.etags = {}
+        self.segments = queue.Queue(maxsize=1)
+        self.threads = [threading.Thread(target=self._run)
+                        for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        pool = self.storage.client_manager.swift_pool
+        swift = None
+        while True:
+            segment = self.segments.get()
+            if segment is None:
+                if swift:
+                    pool.put(swift)
+                return
+            if self.errors:
+                continue
+            content, path, index = segment
+            try:
+                if not swift:
+                    swift = pool.get()
+                etag, swift = self.storage.upload_chunk(content, path, swift)
+            except Exception as error:
+                # upload_chunk discards the connection of a failed upload
+                swift = None
+                self.errors.append(error)
+                continue
+            self.etags[path] = etag
+            if self.journal:
+                try:
+                    self.journal.commit(index, len(content), etag)
+                except Exception as error:
+                    self.errors.append(error)
+
+    def upload(self, content, path, index=None):
+        """
+        Queues a segment, waiting for a thread to be available.
+
+        :param index: index of the segment in the stream
+        """
+        if self.errors:
+            raise self.errors[0]
+        self.segments.put((content, path, index))
+
+    def close(self, check=True):
+        """
+        Waits for the queued segments to be uploaded.
+
+        :param check: raise the first upload error, if any
+        """
+        for _ in self.threads:
+            self.segments.put(None)
+        for thread in self.threads:
+            thread.join()
+        if check and self.errors:
+            raise self.errors[0]
+
+
+class SegmentDownloader(object):
+    """
+    Downloads segments with a pool of threads, each one with its own Swift
+    connection, and yields them in order. The segments downloaded ahead
+    of the one yielded are kept in memory, up to read_ahead bytes.
+
+    :type storage: SwiftStorage
+    :param segments: list of (path, size, etag) of the segments, the
+                     downloaded segments are checked against their etag
+                     if known
+    :param workers: number of segments downloaded at the same time
+    :param read_ahead: number of bytes downloaded ahead of the segment
+                       yielded, a segment is downloaded at least
+    """
+
+    def __init__(self, storage, segments, workers, read_ahead):
+        self.storage = storage
+        self.segments = segments
+        self.read_ahead = read_ahead
+        self.workers = workers
+        self.condition = threading.Condition()
+        # Downloaded segments by index, or the error met
+        self.results = {}
+        # Error stopping a thread
+        self.failed = None
+        self.next_index = 0
+        self.yielded_index = 0
+        self.buffered = 0
+        self.closed = False
+
+    def _next_segment(self):
+        """
+        Returns the index of the next segment to download, waiting for
+        the read ahead memory, or None once closed or done.
+        """
+        with self.condition:
+            while True:
+                if self.closed or self.next_index == len(self.segments):
+                    return None
+                size = self.segments[self.next_index][1]
+                if (self.next_index == self.yielded_index or
+                        self.buffered + size <= self.read_ahead):
+                    index = self.next_index
+                    self.next_index += 1
+                    self.buffered += size
+                    return index
+                self.condition.wait()
+
+    def _download(self, swift, index):
+        """
+        Downloads a segment, retrying with a new connection after a
+        failure.
+
+        :param swift: connection to use, a new one of the pool if None
+        :return: the content of the segment or the last error met, and
+                 the connection to use next
+        """
+        pool = self.storage.client_manager.swift_pool
+        path, size, etag = self.segments[index]
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            try:
+                if swift is None:
+                    swift = pool.get()
+                split = path.split('/', 1)
+                result = swift.get_object(split[0], split[1])[1]
+                if len(result) != size:
+                    raise IOError('Segment {0} has {1} bytes instead of '
+                                  '{2}'.format(path, len(result), size))
+                if etag and hashlib.md5(result).hexdigest() != etag:
+                    raise IOError('Segment {0} does not match its etag '
+                                  '{1}'.format(path, etag))
+                return result, swift
+            except Exception as error:
+                result = error
+                if swift is not None:
+                    pool.discard(swift)
+                    swift = None
+                if attempt < DOWNLOAD_ATTEMPTS - 1:
+                    LOG.info('Retrying to download segment {0}: '
+                             '{1}'.format(path, error))
+                    time.sleep(retry_delay(attempt))
+        return result, swift
+
+    def _run(self):
+        pool = self.storage.client_manager.swift_pool
+        swift = None
+        try:
+            swift = pool.get()
+            while True:
+                index = self._next_segment()
+                if index is None:
+                    return
+                result, swift = self._download(swift, index)
+                with self.condition:
+                    self.results[index] = result
+                    self.condition.notify_all()
+        except Exception as error:
+            # The iterator would wait forever for the segments left to
+            # this thread
+            with self.condition:
+                self.failed = error
+                self.condition.notify_all()
+        finally:
+            if swift is not None:
+                pool.put(swift)
+
+    def __iter__(self):
+        threads = [threading.Thread(target=self._run)
+                   for _ in range(min(self.workers, len(self.segments)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for index, segment in enumerate(self.segments):
+                with self.condition:
+                    while (index not in self.results and
+                           self.failed is None):
+                        self.condition.wait()
+                    result = self.results.pop(index, self.failed)
+                    self.yielded_index = index + 1
+                    self.buffered -= segment[1]
+                    self.condition.notify_all()
+                if isinstance(result, Exception):
+                    LOG.critical('Error: get_object: {0}'.format(result))
+                    raise result
+                yield result
+        finally:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+
 
 class SwiftStorage(physical.PhysicalStorage):
     """
@@ -37,16 +274,135 @@ class SwiftStorage(physical.PhysicalStorage):
     _type = 'swift'
 
     def rmtree(self, path):
-        split = path.rsplit('/', 1)
-        for file in self.swift().get_container(split[0],
-                                               prefix=split[1])[1]:
+        self.rmtrees([path])
+
+    def rmtrees(self, paths):
+        """
+        Deletes the objects under several paths, with bulk delete requests
+        if the cluster supports them, one request per object otherwise,
+        remove_workers requests at the same time.
+        """
+        objects = []
+        for path in paths:
+            split = path.split('/', 1)
+            prefix = split[1].rstrip('/') + '/'
+            objects.extend((split[0], obj['name']) for obj in
+                           self.swift().get_container(
+                               split[0], prefix=prefix,
+                               full_listing=True)[1])
+        if not objects:
+            return
+        limit = self.bulk_delete_limit()
+        if limit:
+            LOG.info('Deleting {0} objects with bulk delete'.format(
+                len(objects)))
+            batches = [objects[index:index + limit]
+                       for index in range(0, len(objects), limit)]
+            physical.remove_in_parallel(self.bulk_delete, batches,
+                                        self.remove_workers, len(objects),
+                                        'objects')
+        else:
+            LOG.info('Deleting {0} objects'.format(len(objects)))
+            physical.remove_in_parallel(self.delete_object, objects,
+                                        self.remove_workers, len(objects),
+                                        'objects')
+
+    def capabilities(self):
+        """
+        :return: the capabilities of the Swift cluster, read once, empty if
+                 they cannot be read
+        """
+        if self._capabilities is None:
             try:
-                self.swift().delete_object(split[0], file['name'])
-            except Exception:
-                raise
+                self._capabilities = self.swift().get_capabilities() or {}
+            except Exception as e:
+                LOG.info('Cannot get the Swift capabilities: {0}'.format(e))
+                return {}
+        return self._capabilities
+
+    def bulk_delete_limit(self):
+        """
+        :return: maximum number of objects of a bulk delete request, 0 if
+                 the cluster does not support bulk delete
+        """
+        bulk_delete = self.capabilities().get('bulk_delete')
+        if not bulk_delete:
+            return 0
+        return int(bulk_delete.get('max_deletes_per_request', 10000))
+
+    def slo_max_segments(self):
+        """
+        :return: maximum number of segments of a Static Large Object
+                 manifest
+        """
+        slo = self.capabilities().get('slo') or {}
+        return int(slo.get('max_manifest_segments', SLO_MAX_SEGMENTS))
+
+    def _retry_delete(self, description, delete):
+        """
+        Calls delete with a connection of the pool, retrying with a new
+        connection after a failure.
+        """
+        pool = self.client_manager.swift_pool
+        for attempt in range(DELETE_ATTEMPTS):
+            swift = pool.get()
+            try:
+                result = delete(swift)
+            except Exception as error:
+                pool.discard(swift)
+                if attempt == DELETE_ATTEMPTS - 1:
+                    raise
+                LOG.info('Retrying to delete {0}: {1}'.format(
+                    description, error))
+                time.sleep(retry_delay(attempt))
+            else:
+                pool.put(swift)
+                return result
+
+    def bulk_delete(self, objects):
+        """
+        :param objects: list of (container, name) of the objects
+        :return: number of objects deleted or already missing
+        """
+        data = '\n'.join(parse.quote(u'/{0}/{1}'.format(
+            container, name).encode('utf-8')) for container, name in objects)
+
+        def delete(swift):
+            body = swift.post_account(
+                headers={'Accept': 'application/json',
+                         'Content-Type': 'text/plain'},
+                query_string='bulk-delete', data=data)[1]
+            if isinstance(body, bytes):
+                body = body.decode('utf-8')
+            result = json.loads(body)
+            if (result.get('Errors') or not result.get(
+                    'Response Status', '').startswith('200')):
+                raise IOError('Bulk delete failed: {0} {1}'.format(
+                    result.get('Response Status'),
+                    result.get('Errors', [])[:10]))
+            return len(objects)
+
+        return self._retry_delete('{0} objects'.format(len(objects)),
+                                  delete)
+
+    def delete_object(self, obj):
+        """
+        :param obj: (container, name) of the object
+        :return: 1
+        """
+        container, name = obj
+
+        def delete(swift):
+            try:
+                swift.delete_object(container, name)
+            except swiftclient.ClientException as e:
+                if e.http_status != 404:
+                    raise
+            return 1
+
+        return self._retry_delete('{0}/{1}'.format(container, name), delete)
 
     def put_file(self, from_path, to_path):
-        self.client_manager.create_swift()
         split = to_path.rsplit('/', 1)
         file_size = os.path.getsize(from_path)
         with open(from_path, 'r') as meta_fd:
@@ -54,16 +410,33 @@ class SwiftStorage(physical.PhysicalStorage):
                                     content_length=file_size)
 
     def __init__(self, client_manager, container, max_segment_size,
-                 skip_prepare=False):
+                 skip_prepare=False, upload_workers=1, download_workers=1,
+                 read_ahead=0, slo=False, remove_workers=1):
         """
         :type client_manager: freezer.osclients.OSClientManager
         :type container: str
+        :param upload_workers: number of segments uploaded at the same time
+        :param download_workers: number of segments downloaded at the same
+                                 time
+        :param read_ahead: number of bytes of segments downloaded ahead of
+                           the restore
+        :param slo: upload Static Large Object manifests, listing the
+                    segments with their etags, instead of Dynamic Large
+                    Object manifests
+        :param remove_workers: number of delete requests sent at the same
+                               time when removing backups
         """
         self.client_manager = client_manager
+        self.upload_workers = max(1, int(upload_workers or 1))
+        self.download_workers = max(1, int(download_workers or 1))
+        self.read_ahead = read_ahead
+        self.slo = slo
+        self._capabilities = None
         super(SwiftStorage, self).__init__(
             storage_path=container,
             max_segment_size=max_segment_size,
-            skip_prepare=skip_prepare)
+            skip_prepare=skip_prepare,
+            remove_workers=remove_workers)
         self.container = container
         self.segments = "{0}_segments".format(container)
 
@@ -74,65 +447,138 @@ class SwiftStorage(physical.PhysicalStorage):
         """
         return self.client_manager.get_swift()
 
-    def upload_chunk(self, content, path):
+    def upload_chunk(self, content, path, swift=None):
         """
+        Upload a segment, retrying with an exponential backoff.
+
+        If for some reason the swift client object is not available
+        anymore an exception is generated and a new client object is
+        initialized. If the upload fails UPLOAD_ATTEMPTS times, the
+        program will exit with an Exception.
+
+        :param swift: connection of the client manager pool to use, the
+                      one of the client manager if None. It is discarded
+                      if the upload fails.
+        :return: the etag of the segment, checked by Swift, and the
+                 connection used, a new one after a failed attempt
         """
-        # If for some reason the swift client object is not available anymore
-        # an exception is generated and a new client object is initialized/
-        # If the exception happens for 10 consecutive times for a total of
-        # 1 hour, then the program will exit with an Exception.
-
-        count = 0
-        success = False
         split = path.rsplit('/', 1)
-        while not success:
+        etag = hashlib.md5(content).hexdigest()
+        for attempt in range(UPLOAD_ATTEMPTS):
             try:
                 LOG.debug(
                     'Uploading file chunk index: {0}'.format(path))
-                self.swift().put_object(
+                (swift or self.swift()).put_object(
                     split[0], split[1], content,
                     content_type='application/octet-stream',
-                    content_length=len(content))
+                    content_length=len(content), etag=etag)
                 LOG.debug('Data successfully uploaded!')
-                success = True
+                return etag, swift
             except Exception as error:
-                LOG.info(
-                    'Retrying to upload file chunk index: {0}'.format(
-                        path))
-                time.sleep(60)
-                self.client_manager.create_swift()
-                count += 1
-                if count == 10:
+                if attempt == UPLOAD_ATTEMPTS - 1:
                     LOG.critical('Error: add_object: {0}'
                                  .format(error))
+                    if swift:
+                        self.client_manager.swift_pool.discard(swift)
                     raise Exception("cannot add object to storage")
-
-    def upload_manifest(self, backup):
+                LOG.info(
+                    'Retrying to upload file chunk index: {0}'.format(
+                        path))
+                time.sleep(retry_delay(attempt))
+                if swift:
+                    self.client_manager.swift_pool.discard(swift)
+                    swift = self.client_manager.swift_pool.get()
+                else:
+                    self.client_manager.create_swift()
+
+    def upload_manifest(self, backup, segments=()):
         """
         Upload Manifest to manage segments in Swift
 
         :param backup: Backup
         :type backup: freezer.storage.base.Backup
+        :param segments: list of (path, size, etag) of the segments in order
         """
         backup = backup.copy(storage=self)
-        self.client_manager.create_swift()
-        headers = {'x-object-manifest': backup.segments_path}
         LOG.info('[*] Uploading Swift Manifest: {0}'.format(backup))
-        split = backup.data_path.rsplit('/', 1)
+        self.put_manifest(backup.data_path, backup.segments_path, segments)
+        LOG.info('Manifest successfully uploaded!')
+
+    def put_manifest(self, path, prefix, segments, headers=None):
+        """
+        Uploads the manifest of a large object: a Static Large Object
+        manifest listing the segments with their etags if slo is set, a
+        Dynamic Large Object manifest on the prefix of the segments
+        otherwise.
+
+        The segments of a Static Large Object above the
+        max_manifest_segments of the cluster are listed by nested
+        manifests, uploaded next to the manifest.
+
+        :param path: path of the manifest
+        :param prefix: path prefix of the segments
+        :param segments: list of (path, size, etag) of the segments in order
+        :param headers: metadata of the large object
+        """
+        headers = dict(headers or {})
+        split = path.rsplit('/', 1)
+        if self.slo and segments:
+            max_segments = self.slo_max_segments()
+            depth = 0
+            while len(segments) > max_segments:
+                segments = [
+                    self.put_slo_manifest(
+                        '{0}_manifests/{1}_{2:08d}'.format(path, depth,
+                                                           index),
+                        segments[start:start + max_segments])
+                    for index, start in enumerate(
+                        range(0, len(segments), max_segments))]
+                depth += 1
+            if depth:
+                LOG.info('Segments listed by {0} nested manifests'.format(
+                    len(segments)))
+            self.put_slo_manifest(path, segments, headers)
+            return
+        headers['x-object-manifest'] = prefix
         self.swift().put_object(container=split[0], obj=split[1],
                                 contents=u'', headers=headers,
                                 content_length=len(u''))
-        LOG.info('Manifest successfully uploaded!')
+
+    def put_slo_manifest(self, path, segments, headers=None):
+        """
+        Uploads a Static Large Object manifest.
+
+        :param path: path of the manifest
+        :param segments: list of (path, size, etag) of the segments or
+                         nested manifests in order
+        :param headers: metadata of the large object
+        :return: (path, size, etag) of the large object, the etag of a
+                 Static Large Object being the md5 of the etags of its
+                 segments
+        """
+        split = path.rsplit('/', 1)
+        manifest = json.dumps([
+            {'path': '/' + segment_path, 'etag': etag,
+             'size_bytes': size}
+            for segment_path, size, etag in segments])
+        self.swift().put_object(container=split[0], obj=split[1],
+                                contents=manifest, headers=headers or {},
+                                content_length=len(manifest),
+                                query_string='multipart-manifest=put')
+        return (path, sum(size for _, size, _ in segments),
+                hashlib.md5(''.join(
+                    etag for _, _, etag in segments).encode()).hexdigest())
 
     def prepare(self):
         """
-        Check if the provided container is already available on Swift.
-        The verification is done by exact matching between the provided
-        container name and the whole list of container available for the swift
-        account.
+        Check if the provided container is already available on Swift,
+        with a HEAD request on the container, and create it otherwise.
         """
-        containers_list = [c['name'] for c in self.swift().get_account()[1]]
-        if self.storage_path not in containers_list:
+        try:
+            self.swift().head_container(self.storage_path)
+        except swiftclient.ClientException as error:
+            if error.http_status != 404:
+                raise
             self.swift().put_container(self.storage_path)
 
     def info(self):
@@ -161,26 +607,30 @@ class SwiftStorage(physical.PhysicalStorage):
             for obj_chunk in iterator:
                 obj_fd.write(obj_chunk)
 
+    def file_signature(self, path):
+        split = path.split('/', 1)
+        headers = self.swift().head_object(split[0], split[1])
+        return '{0}:{1}'.format(headers.get('content-length'),
+                                headers.get('etag'))
+
     def add_stream(self, stream, package_name, headers=None):
         i = 0
         backup_basepath = "{0}/{1}".format(self.container, self.segments)
+        segments = []
         for el in stream:
             upload_path = "{0}/{1}/segments/{2}".format(backup_basepath,
                                                         package_name,
                                                         "%08d" % i)
-            self.upload_chunk(el, upload_path)
+            etag = self.upload_chunk(el, upload_path)[0]
+            segments.append((upload_path, len(el), etag))
             i += 1
-        if not headers:
-            headers = {}
 
         full_path = "{0}/{1}".format(backup_basepath, package_name)
-        headers['x-object-manifest'] = full_path
-
         objname = package_name.rsplit('/', 1)[1]
         # This call sets the metadata on a file which will be used to download
         # the whole backup later. Do not remove it ! (szaher)
-        self.swift().put_object(container=full_path, obj=objname, contents=u'',
-                                content_length=len(u''), headers=headers)
+        self.put_manifest("{0}/{1}".format(full_path, objname), full_path,
+                          segments, headers)
 
     def backup_blocks(self, backup):
         """
@@ -189,32 +639,158 @@ class SwiftStorage(physical.PhysicalStorage):
         :type backup: freezer.storage.base.Backup
         :return:
         """
+        if self.download_workers > 1:
+            segments = self.list_segments(backup)
+            if segments:
+                for chunk in SegmentDownloader(
+                        self, segments, self.download_workers,
+                        self.read_ahead):
+                    yield chunk
+                return
+
         split = backup.data_path.split('/', 1)
+        pool = self.client_manager.swift_pool
+        swift = pool.get()
         try:
-            chunks = self.client_manager.create_swift().get_object(
+            chunks = swift.get_object(
                 split[0], split[1],
                 resp_chunk_size=self.max_segment_size)[1]
         except requests.exceptions.SSLError as e:
             LOG.warning(e)
-            chunks = self.client_manager.create_swift().get_object(
+            pool.discard(swift)
+            swift = pool.get()
+            chunks = swift.get_object(
                 split[0], split[1],
                 resp_chunk_size=self.max_segment_size)[1]
 
-        for chunk in chunks:
-            yield chunk
+        try:
+            for chunk in chunks:
+                yield chunk
+        except BaseException:
+            # The response is not read to the end
+            pool.discard(swift)
+            raise
+        pool.put(swift)
+
+    def list_segments(self, backup):
+        """
+        Lists the segments of a backup, from its manifest for a Static
+        Large Object, from the container otherwise.
+
+        :type backup: freezer.storage.base.Backup
+        :return: list of (path, size, etag) of the segments in order
+        """
+        backup = backup.copy(storage=self)
+        segments = self.manifest_segments(backup.data_path)
+        if segments is not None:
+            return segments
+        split = backup.segments_path.split('/', 1)
+        prefix = split[1] + '/'
+        objects = self.swift().get_container(split[0], prefix=prefix,
+                                             full_listing=True)[1]
+        return [('{0}/{1}'.format(split[0], obj['name']), obj['bytes'],
+                 obj.get('hash'))
+                for obj in sorted(objects, key=lambda obj: obj['name'])]
+
+    def discard_segments(self, backup, first):
+        """
+        Deletes the segments of a backup from index first, left by a
+        failed attempt.
+
+        :type backup: freezer.storage.base.Backup
+        :param first: index of the first segment to delete
+        """
+        split = backup.copy(storage=self).segments_path.split('/', 1)
+        prefix = split[1] + '/'
+        stale = [(split[0], obj['name']) for obj in self.swift().get_container(
+            split[0], prefix=prefix, full_listing=True)[1]
+            if obj['name'] >= '{0}{1:08d}'.format(prefix, first)]
+        if stale:
+            LOG.info('Deleting {0} segments of the failed attempt'.format(
+                len(stale)))
+            physical.remove_in_parallel(self.delete_object, stale,
+                                        self.remove_workers, len(stale),
+                                        'objects')
+
+    def manifest_segments(self, path):
+        """
+        Reads the segments of a Static Large Object from its manifest,
+        and from its nested manifests.
 
-    def write_backup(self, rich_queue, backup):
+        :param path: path of the large object
+        :return: list of (path, size, etag) of the segments in order, None
+                 if the object is not a Static Large Object
+        """
+        split = path.split('/', 1)
+        headers, manifest = self.swift().get_object(
+            split[0], split[1], query_string='multipart-manifest=get')
+        if headers.get('x-static-large-object', '').lower() != 'true':
+            return None
+        if isinstance(manifest, bytes):
+            manifest = manifest.decode('utf-8')
+        segments = []
+        for segment in json.loads(manifest):
+            if segment.get('sub_slo'):
+                segments.extend(self.manifest_segments(
+                    segment['name'].lstrip('/')))
+            else:
+                segments.append((segment['name'].lstrip('/'),
+                                 segment['bytes'], segment['hash']))
+        return segments
+
+    def write_backup(self, rich_queue, backup, journal=None):
         """
         Upload object on the remote swift server
         :type rich_queue: freezer.streaming.RichQueue
         :type backup: freezer.storage.base.Backup
+        :type journal: freezer.engine.journal.BackupJournal
+        :param journal: journal of the backup, recording the uploaded
+                        segments. The segments of a resumed backup are
+                        kept and the stream continues after them.
         """
         backup = backup.copy(storage=self)
-        for block_index, message in enumerate(rich_queue.get_messages()):
-            segment_package_name = u'{0}/{1}'.format(
-                backup.segments_path, "%08d" % block_index)
-            self.upload_chunk(message, segment_package_name)
-        self.upload_manifest(backup)
+        uploader = None
+        etags = {}
+        segments = []
+        first = 0
+        if journal:
+            first = len(journal.resumed_segments)
+            for block_index, (size, etag) in enumerate(
+                    journal.resumed_segments):
+                segment_package_name = u'{0}/{1}'.format(
+                    backup.segments_path, "%08d" % block_index)
+                segments.append((segment_package_name, size))
+                etags[segment_package_name] = etag
+            self.discard_segments(backup, first)
+        if self.upload_workers > 1:
+            uploader = SegmentUploader(self, self.upload_workers, journal)
+            uploader.etags.update(etags)
+            etags = uploader.etags
+        try:
+            for block_index, message in enumerate(
+                    rich_queue.get_messages(), first):
+                segment_package_name = u'{0}/{1}'.format(
+                    backup.segments_path, "%08d" % block_index)
+                segments.append((segment_package_name, len(message)))
+                if uploader:
+                    uploader.upload(message, segment_package_name,
+                                    block_index)
+                else:
+                    etags[segment_package_name] = self.upload_chunk(
+                        message, segment_package_name)[0]
+                    if journal:
+                        journal.commit(block_index, len(message),
+                                       etags[segment_package_name])
+        except BaseException:
+            if uploader:
+                # The error of the stream is raised rather than the ones
+                # of the uploads it may have caused
+                uploader.close(check=False)
+            raise
+        if uploader:
+            uploader.close()
+        self.upload_manifest(backup, [(path, size, etags[path])
+                                      for path, size in segments])
 
     def listdir(self, path):
         """
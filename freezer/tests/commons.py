@@ -227,6 +227,9 @@ class FakeSwiftClient(object):
             def put_container(self, container=True):
                 return True
 
+            def head_container(self, container=True):
+                return {}
+
             def delete_object(self, container_name='', object_name=''):
                 if self.num_try > 0:
                     self.num_try -= 1
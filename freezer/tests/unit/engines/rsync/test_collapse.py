@@ -0,0 +1,106 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import grp
+import os
+import pwd
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from freezer.engine.rsync import collapse
+from freezer.engine.rsync import stream
+
+BLOCK_SIZE = 4
+
+
+def gen_record_writes(header, reader):
+    if not header.incremental:
+        for data in reader.iter_data():
+            yield None, data
+        return
+    for block_index in reader.read_block_indexes():
+        offset = block_index * BLOCK_SIZE
+        for data in reader.iter_data(
+                max(0, min(BLOCK_SIZE, header.size - offset))):
+            yield offset, data
+            offset += len(data)
+
+
+class TestCollapsedRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.inode = {
+            'ftype': 'r', 'level_id': '0000', 'deleted': '0000',
+            'mode': 0o100644, 'uid': os.getuid(), 'gid': os.getgid(),
+            'size': 0, 'mtime': 1500000000, 'ctime': 1500000000,
+            'inumber': 1, 'nlink': 1, 'devmajor': 0, 'devminor': 0,
+            'uname': pwd.getpwuid(os.getuid()).pw_name,
+            'gname': grp.getgrgid(os.getgid()).gr_name, 'lname': ''}
+        self.engine = mock.Mock()
+        self.engine.is_reg_file.side_effect = lambda ftype: ftype == 'r'
+        self.engine.gen_record_writes.side_effect = gen_record_writes
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def record(self, path, data=b'', blocks=None, size=None, **inode):
+        inode = dict(self.inode, **inode)
+        inode['size'] = len(data) if size is None else size
+        if blocks is not None:
+            inode['level_id'] = '1111'
+            data = stream.pack_block_indexes(blocks) + data
+        return stream.pack_header(path, inode, len(data)) + data
+
+    def restore(self, levels, workers=1):
+        restore = collapse.CollapsedRestore(self.engine, self.tmpdir,
+                                            BLOCK_SIZE, workers)
+        for level in range(len(levels) - 1, -1, -1):
+            chunks = iter([levels[level]])
+            restore.restore(
+                stream.StreamReader(lambda: next(chunks, b'')), level)
+        restore.close()
+
+    def read(self, name):
+        with open(os.path.join(self.tmpdir, name), 'rb') as file_fd:
+            return file_fd.read()
+
+    def test_newest_blocks(self):
+        self.restore([
+            self.record('a', b'0123456789') + self.record('b', b'bbbb'),
+            self.record('a', b'xxxxyy', [1, 2], size=10, mtime=2),
+            self.record('a', b'zz', [2], size=10, mtime=3)])
+        self.assertEqual(b'0123xxxxzz', self.read('a'))
+        self.assertEqual(b'bbbb', self.read('b'))
+        self.assertEqual(3, os.stat(os.path.join(self.tmpdir, 'a')).st_mtime)
+
+    def test_resized(self):
+        self.restore([
+            self.record('a', b'0123456789') + self.record('b', b'01234567'),
+            self.record('a', b'xy', [1], size=6) +
+            self.record('b', b'xyz', [0], size=3),
+            self.record('a', b'XYZW', [1], size=8)], workers=2)
+        # The data truncated by level 1 is not brought back from level 0
+        self.assertEqual(b'0123XYZW', self.read('a'))
+        self.assertEqual(b'xyz', self.read('b'))
+
+    def test_deleted_and_recreated(self):
+        self.restore([
+            self.record('a', b'old!') + self.record('b', b'gone'),
+            self.record('a', deleted='1111') +
+            self.record('b', deleted='1111'),
+            self.record('a', b'new') + self.record('b', deleted='1111')])
+        self.assertEqual(b'new', self.read('a'))
+        self.assertFalse(os.path.lexists(os.path.join(self.tmpdir, 'b')))
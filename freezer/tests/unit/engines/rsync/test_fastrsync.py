@@ -0,0 +1,84 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import unittest
+
+import mock
+import six
+
+from freezer.engine.rsync import fastrsync
+from freezer.engine.rsync import pyrsync
+
+
+class TestFastrsync(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(42)
+        self.samples = []
+        for _ in range(150):
+            old = bytearray(rnd.choice(b'ab\x00\xff')
+                            for _ in range(rnd.randrange(0, 90)))
+            new = bytearray(old)
+            for _ in range(rnd.randrange(0, 4)):
+                pos = rnd.randrange(0, len(new) + 1)
+                size = rnd.randrange(1, 10)
+                if rnd.randrange(2):
+                    new[pos:pos] = bytearray(
+                        rnd.choice(b'abc') for _ in range(size))
+                else:
+                    del new[pos:pos + size]
+            self.samples.append((bytes(old), bytes(new),
+                                 rnd.choice([4, 8, 16])))
+
+    def _compare(self):
+        for old, new, blocksize in self.samples:
+            signature = pyrsync.blockchecksums(six.BytesIO(old), blocksize)
+            self.assertEqual(
+                signature,
+                fastrsync.blockchecksums(six.BytesIO(old), blocksize))
+            try:
+                expected = list(pyrsync.rsyncdelta(
+                    six.BytesIO(new), signature, blocksize))
+            except AttributeError:
+                # pyrsync cannot handle a match while the window shrinks
+                continue
+            self.assertEqual(
+                expected,
+                list(fastrsync.rsyncdelta(
+                    six.BytesIO(new), signature, blocksize)))
+
+    def test_same_output_as_pyrsync(self):
+        self._compare()
+
+    @mock.patch.object(fastrsync, 'SCAN_WINDOW', 5)
+    @mock.patch.object(fastrsync, 'READ_BUFFER_SIZE', 7)
+    def test_same_output_small_buffers(self):
+        self._compare()
+
+    @mock.patch.object(fastrsync, 'numpy', None)
+    def test_same_output_without_numpy(self):
+        self._compare()
+
+    def test_weakchecksums(self):
+        data = b'0123456789abcdefghij'
+        self.assertEqual(
+            [pyrsync.weakchecksum(bytearray(data[i:i + 8]))[0]
+             for i in range(0, len(data), 8)],
+            fastrsync.weakchecksums(data, 8))
+
+    def test_rsyncdelta_unchanged(self):
+        data = b'a1be5ab4d899b57085c9534c64d8d71c'
+        signature = fastrsync.blockchecksums(six.BytesIO(data), 8)
+        self.assertEqual(
+            [0, 1, 2, 3, b''],
+            list(fastrsync.rsyncdelta(six.BytesIO(data), signature, 8)))
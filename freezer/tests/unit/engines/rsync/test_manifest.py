@@ -0,0 +1,130 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from freezer.engine.rsync import manifest
+from freezer.engine.rsync import signature
+from freezer.utils import compress
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'manifest')
+        self.checksums = ([736756931, 616825970],
+                          ['0f923c37c14f648de4065d4666c2429231a923bc',
+                           '9f043572d40922cc45545bd6ec8a650ca095ab84'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sort_key_follows_walk(self):
+        root = os.path.join(self.tmpdir, 'tree')
+        for directory in ('b', 'a.b', os.path.join('a', 'z')):
+            os.makedirs(os.path.join(root, directory))
+        for name in ('f', os.path.join('a', 'x'), os.path.join('a.b', 'y'),
+                     os.path.join('a', 'z', 'w')):
+            open(os.path.join(root, name), 'w').close()
+
+        walked = []
+        for current, dirs, files in os.walk(root):
+            dirs.sort()
+            walked.append((manifest.DIRECTORY,
+                           os.path.relpath(current, root)))
+            for name in sorted(files):
+                walked.append((manifest.FILE, os.path.relpath(
+                    os.path.join(current, name), root)))
+        self.assertEqual(
+            walked, sorted(walked, key=lambda e: manifest.sort_key(*e)))
+
+    def _write(self, entries):
+        writer = manifest.ManifestWriter(self.path, 'gzip', 16)
+        for kind, rel_path in entries:
+            meta = {'inode': {'size': len(rel_path)}}
+            if kind == manifest.FILE:
+                meta['signature'] = signature.Signature.from_checksums(
+                    *self.checksums)
+            writer.add(kind, rel_path, meta)
+        writer.close({'broken_links': []})
+        return writer
+
+    @mock.patch.object(manifest, 'CHUNK_SIZE', 100)
+    def test_write_read(self):
+        entries = [(manifest.DIRECTORY, '.'), (manifest.FILE, 'a'),
+                   (manifest.FILE, 'b'), (manifest.DIRECTORY, 'd'),
+                   (manifest.FILE, os.path.join('d', 'c'))]
+        writer = self._write(entries)
+        self.assertEqual((3, 2),
+                         (writer.files_count, writer.directories_count))
+        self.assertFalse(os.path.exists(self.path + '.signatures'))
+
+        reader = manifest.ManifestReader(self.path, 'gzip')
+        try:
+            self.assertTrue(len(reader.chunks) > 1)
+            self.assertEqual({'broken_links': []}, reader.meta)
+            read = list(reader)
+            self.assertEqual(entries, [entry[:2] for entry in read])
+            self.assertEqual(self.checksums[1],
+                             list(read[-1][2]['signature'].strong))
+            meta = reader.lookup(manifest.FILE, 'b')
+            self.assertEqual(1, meta['inode']['size'])
+            self.assertEqual(self.checksums[0],
+                             list(meta['signature'].weak))
+            self.assertIsNone(reader.lookup(manifest.FILE, 'e'))
+        finally:
+            reader.close()
+
+    def test_entries_out_of_order(self):
+        writer = manifest.ManifestWriter(self.path, 'gzip', 16)
+        writer.add(manifest.FILE, 'b', {})
+        self.assertRaises(ValueError, writer.add, manifest.FILE, 'a', {})
+
+    def test_read_json_manifest(self):
+        fs_meta_struct = {
+            'files': {'b': {'signature': self.checksums},
+                      'a': {'signature': [[], []]}},
+            'directories': {'/abs/path': {}},
+            'broken_links': []}
+        with open(self.path, 'wb') as manifest_file:
+            manifest_file.write(compress.one_shot_compress(
+                'gzip', json.dumps(fs_meta_struct).encode('utf-8')))
+        reader = manifest.ManifestReader(self.path, 'gzip')
+        read = list(reader)
+        self.assertEqual(['a', 'b'], [entry[1] for entry in read])
+        self.assertEqual(self.checksums[0],
+                         list(read[1][2]['signature'].weak))
+        self.assertEqual({'broken_links': []}, reader.meta)
+
+    def test_join(self):
+        self._write([(manifest.FILE, 'a'), (manifest.FILE, 'b'),
+                     (manifest.FILE, 'c'), (manifest.FILE, 'e')])
+        reader = manifest.ManifestReader(self.path, 'gzip')
+        try:
+            join = manifest.ManifestJoin(reader)
+            self.assertIsNone(join.pop(manifest.FILE, '0'))
+            self.assertEqual(['a'], [entry[1] for entry in join.pop_before(
+                manifest.sort_key(manifest.FILE, 'b'))])
+            self.assertIsNotNone(join.pop(manifest.FILE, 'b'))
+            self.assertIsNone(join.pop(manifest.FILE, 'd'))
+            self.assertEqual(['e'],
+                             [entry[1] for entry in join.pop_before()])
+        finally:
+            reader.close()
+        self.assertEqual([], list(manifest.ManifestJoin([]).pop_before()))
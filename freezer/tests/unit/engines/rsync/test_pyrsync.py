@@ -54,3 +54,26 @@ class TestPyrsync(unittest.TestCase):
             cur_index += 1
         exp_changed_indexes = [0, 2]
         self.assertEqual(changed_indexes[:-1], exp_changed_indexes)
+
+    def test_signature_index(self):
+        index = pyrsync.SignatureIndex(([10, 20, 10, 30],
+                                        ['a', 'b', 'a', 'c']))
+        self.assertEqual(index.weak_index, {10: [0, 2], 20: [1], 30: [3]})
+        self.assertEqual(index.weak_match(10, 0), 0)
+        self.assertEqual(index.weak_match(10, 1), 2)
+        self.assertIsNone(index.weak_match(10, 3))
+        self.assertIsNone(index.weak_match(40, 0))
+        self.assertEqual(index.strong_match('a', 1), 2)
+        self.assertIsNone(index.strong_match('b', 2))
+
+    def test_rsyncdelta_repeated_blocks(self):
+        old_data = b'aaaabbbbaaaacccc'
+        signatures = pyrsync.blockchecksums(six.BytesIO(old_data), 4)
+        delta = list(pyrsync.rsyncdelta(six.BytesIO(b'aaaaaaaacccc'),
+                                        signatures, 4))
+        self.assertEqual(delta[:3], [0, 2, 3])
+
+        index = pyrsync.SignatureIndex(signatures)
+        self.assertEqual(
+            list(pyrsync.rsyncdelta(six.BytesIO(b'aaaaaaaacccc'), index, 4)),
+            delta)
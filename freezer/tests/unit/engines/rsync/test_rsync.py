@@ -0,0 +1,253 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import grp
+import os
+import pwd
+import shutil
+import tempfile
+import unittest
+
+import mock
+import six
+
+from freezer.engine.rsync import signature
+from freezer.engine.rsync import stream
+from freezer.engine.rsync import writers
+
+try:
+    from freezer.engine.rsync import rsync
+except ImportError:
+    # The rsync engine runs on Python 2 only
+    rsync = None
+
+BLOCK_SIZE = 16
+
+
+def gen_data(size, seed=0):
+    return b''.join(six.int2byte((index * 7 + seed) % 251)
+                    for index in range(size))
+
+
+def overwrite(data, block_indexes):
+    data = bytearray(data)
+    for block_index in block_indexes:
+        offset = block_index * BLOCK_SIZE
+        data[offset:offset + 4] = b'XXXX'
+    return bytes(data)
+
+
+@unittest.skipIf(rsync is None, "The rsync engine runs on Python 2 only")
+class TestChangedBlocks(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(rsync, 'RSYNC_BLOCK_SIZE', BLOCK_SIZE)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    @staticmethod
+    def meta(data):
+        return {'inode': {'size': len(data), 'mtime': 0, 'ctime': 0},
+                'signature': signature.Signature.from_stream(
+                    six.BytesIO(data), BLOCK_SIZE)}
+
+    def scan(self, old, new):
+        """Scans new against old as a backup does, returns the changed
+        blocks and whether the rolling search was used."""
+        path = os.path.join(self.tmpdir, 'file')
+        with open(path, 'wb') as file_fd:
+            file_fd.write(new)
+        with mock.patch.object(
+                rsync.RsyncEngine, 'rsync_changed_blocks',
+                wraps=rsync.RsyncEngine.rsync_changed_blocks) as rolling:
+            scan = rsync.RsyncEngine.scan_file(path, self.meta(old))
+        return scan['blocks'], rolling.called
+
+    def delta(self, old, new):
+        blocks, _ = self.scan(old, new)
+        chunks = list(rsync.RsyncEngine.gen_changed_blocks(
+            six.BytesIO(new), blocks, len(new)))
+        self.assertEqual(stream.pack_block_indexes(blocks), chunks[0])
+        self.assertEqual(rsync.RsyncEngine.changed_blocks_len(
+            blocks, len(new)), len(b''.join(chunks)))
+        return blocks, b''.join(chunks[1:])
+
+    def restore_legacy(self, old, new, trailer=b'next header'):
+        """Applies the delta with write_changes_in_file, from a stream
+        in the index string format of the version 1 backups."""
+        blocks, data = self.delta(old, new)
+        indexes = b''.join(b'\00' + str(block_index).encode()
+                           for block_index in blocks) + b'\00'
+        data_chunk = (b'\00' + str(len(data)).encode() + b'\00' +
+                      str(len(indexes) + 1).encode() + b'\00' + indexes +
+                      data + trailer)
+        engine = rsync.RsyncEngine.__new__(rsync.RsyncEngine)
+        file_fd = six.BytesIO(old)
+        read_pipe = mock.Mock()
+        read_pipe.recv_bytes.side_effect = EOFError
+        self.assertEqual(trailer, engine.write_changes_in_file(
+            file_fd, len(new), data_chunk, read_pipe))
+        self.assertFalse(read_pipe.recv_bytes.called)
+        return file_fd.getvalue()
+
+    def restore(self, old, new):
+        """Applies the delta as a record of the backup stream."""
+        blocks, data = self.delta(old, new)
+        inode = {'ftype': 'r', 'level_id': '1111', 'deleted': '0000',
+                 'mode': 0o100644, 'uid': 0, 'gid': 0, 'size': len(new),
+                 'mtime': 0, 'ctime': 0, 'inumber': 1, 'nlink': 1,
+                 'devmajor': 0, 'devminor': 0, 'uname': 'root',
+                 'gname': 'root', 'lname': ''}
+        data = stream.pack_block_indexes(blocks) + data
+        chunks = iter([stream.pack_header('file', inode, len(data)) + data])
+        reader = stream.StreamReader(lambda: next(chunks, b''))
+        header = reader.next_header()
+        path = os.path.join(self.tmpdir, 'restored')
+        with open(path, 'wb') as file_fd:
+            file_fd.write(old)
+        writers.write_file(path, True, header.size, (
+            (offset, data.tobytes()) for offset, data in
+            rsync.RsyncEngine.gen_record_writes(header, reader)))
+        with open(path, 'rb') as file_fd:
+            return file_fd.read()
+
+    def test_aligned(self):
+        old = gen_data(BLOCK_SIZE * 8)
+        new = overwrite(old, [1, 5])
+        self.assertEqual([1, 5], rsync.RsyncEngine.aligned_changed_blocks(
+            self.meta(old), self.meta(new)))
+        self.assertEqual(([1, 5], False), self.scan(old, new))
+        self.assertEqual(new, self.restore_legacy(old, new))
+        self.assertEqual(new, self.restore(old, new))
+
+    def test_aligned_max_changed_ratio(self):
+        old = gen_data(BLOCK_SIZE * 8)
+        # Half of the blocks changed: the aligned comparison is kept
+        new = overwrite(old, [0, 2, 4, 6])
+        self.assertEqual(([0, 2, 4, 6], False), self.scan(old, new))
+        # More than half: the rolling search is used
+        new = overwrite(old, [0, 2, 4, 6, 7])
+        self.assertIsNone(rsync.RsyncEngine.aligned_changed_blocks(
+            self.meta(old), self.meta(new)))
+        self.assertEqual(([0, 2, 4, 6, 7], True), self.scan(old, new))
+        self.assertEqual(new, self.restore_legacy(old, new))
+        self.assertEqual(new, self.restore(old, new))
+
+    def test_size_changed(self):
+        old = gen_data(BLOCK_SIZE * 8)
+        # Data inserted in the middle of the file
+        new = old[:BLOCK_SIZE * 3 + 5] + b'inserted' + old[BLOCK_SIZE * 3 + 5:]
+        self.assertIsNone(rsync.RsyncEngine.aligned_changed_blocks(
+            self.meta(old), self.meta(new)))
+        blocks, rolling = self.scan(old, new)
+        self.assertTrue(rolling)
+        self.assertEqual([0, 1, 2], sorted(set(range(9)) - set(blocks)))
+        self.assertEqual(new, self.restore_legacy(old, new))
+        self.assertEqual(new, self.restore(old, new))
+        # Truncated file: no data but the size in the header
+        new = old[:BLOCK_SIZE * 5]
+        self.assertEqual(([], True), self.scan(old, new))
+        self.assertEqual(new, self.restore_legacy(old, new))
+        self.assertEqual(new, self.restore(old, new))
+
+    def test_short_last_block(self):
+        old = gen_data(BLOCK_SIZE * 4 + 5)
+        new = old[:-2] + b'YY'
+        self.assertEqual(([4], False), self.scan(old, new))
+        blocks, data = self.delta(old, new)
+        self.assertEqual(new[BLOCK_SIZE * 4:], data)
+        self.assertEqual(new, self.restore_legacy(old, new))
+        self.assertEqual(new, self.restore(old, new))
+        # Appended data: the last block grows and a new one follows
+        new = old + gen_data(BLOCK_SIZE, 3)
+        blocks, data = self.delta(old, new)
+        self.assertEqual([4, 5], blocks)
+        self.assertEqual(new[BLOCK_SIZE * 4:], data)
+        self.assertEqual(new, self.restore_legacy(old, new))
+        self.assertEqual(new, self.restore(old, new))
+
+    def test_changed_blocks_padding(self):
+        # The file shrank after its scan: the missing data is padded
+        blocks = [0, 2]
+        data = b''.join(rsync.RsyncEngine.gen_changed_blocks(
+            six.BytesIO(gen_data(BLOCK_SIZE * 2 + 3)), blocks,
+            BLOCK_SIZE * 2 + 10))
+        self.assertEqual(rsync.RsyncEngine.changed_blocks_len(
+            blocks, BLOCK_SIZE * 2 + 10), len(data))
+        self.assertTrue(data.endswith(b'\00' * 7))
+
+
+@unittest.skipIf(rsync is None, "The rsync engine runs on Python 2 only")
+class TestRestoreLevels(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.inode = {
+            'ftype': 'r', 'level_id': '0000', 'deleted': '0000',
+            'mode': 0o100644, 'uid': os.getuid(), 'gid': os.getgid(),
+            'size': 0, 'mtime': 1500000000, 'ctime': 1500000000,
+            'inumber': 1, 'nlink': 1, 'devmajor': 0, 'devminor': 0,
+            'uname': pwd.getpwuid(os.getuid()).pw_name,
+            'gname': grp.getgrgid(os.getgid()).gr_name, 'lname': ''}
+
+    def record(self, path, data=b'', blocks=None, size=None, **inode):
+        inode = dict(self.inode, **inode)
+        inode['size'] = len(data) if size is None else size
+        if blocks is not None:
+            inode['level_id'] = '1111'
+            data = stream.pack_block_indexes(blocks) + data
+        return stream.pack_header(path, inode, len(data)) + data
+
+    def mode(self, name):
+        return os.stat(os.path.join(self.tmpdir, name)).st_mode & 0o777
+
+    def test_inodes_set_after_last_level(self):
+        levels = [
+            self.record('d', ftype='d', mode=0o40500) +
+            self.record('d/a', b'old data', mode=0o100400, mtime=1) +
+            self.record('d/l', ftype='l', lname='a'),
+            self.record('d/a', b'NEW', [0], size=3, mode=0o100400,
+                        mtime=2) +
+            self.record('d/b', b'file', mode=0o100600)]
+        engine = rsync.RsyncEngine.__new__(rsync.RsyncEngine)
+        engine.rsync_workers = 2
+        engine.inodes = None
+
+        def restore_level(restore_resource, read_pipe, backup,
+                          except_queue):
+            chunks = iter([read_pipe])
+            engine.restore_records(
+                stream.StreamReader(lambda: next(chunks, b'')),
+                restore_resource, backup.level)
+            # The read only file and directory are kept writable until
+            # the last level is restored
+            self.assertEqual(0o700, self.mode('d') & 0o700)
+            self.assertEqual(0o600, self.mode('d/a') & 0o600)
+
+        with mock.patch.object(engine, 'restore_level',
+                               side_effect=restore_level):
+            engine.restore_levels(
+                self.tmpdir, levels,
+                [mock.Mock(level=level) for level in range(len(levels))],
+                None)
+        self.assertIsNone(engine.inodes)
+        self.assertEqual(0o500, self.mode('d'))
+        self.assertEqual(0o400, self.mode('d/a'))
+        self.assertEqual(2, os.stat(os.path.join(self.tmpdir,
+                                                 'd/a')).st_mtime)
+        self.assertEqual(0o600, self.mode('d/b'))
+        self.assertEqual('a', os.readlink(os.path.join(self.tmpdir, 'd/l')))
+        with open(os.path.join(self.tmpdir, 'd/a'), 'rb') as file_fd:
+            self.assertEqual(b'NEW', file_fd.read())
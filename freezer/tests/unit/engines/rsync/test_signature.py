@@ -0,0 +1,79 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import six
+
+from freezer.engine.rsync import fastrsync
+from freezer.engine.rsync import pyrsync
+from freezer.engine.rsync import signature
+
+
+class TestSignature(unittest.TestCase):
+
+    def setUp(self):
+        self.data = b''.join(six.int2byte(i % 251) for i in range(100))
+        self.checksums = pyrsync.blockchecksums(six.BytesIO(self.data), 16)
+
+    def test_from_stream(self):
+        sig = signature.Signature.from_stream(six.BytesIO(self.data), 16)
+        self.assertEqual(7, sig.count)
+        weak, strong = sig
+        self.assertEqual(self.checksums, (list(weak), list(strong)))
+        self.assertEqual(
+            next(sig.chunks()),
+            signature.Signature.from_checksums(*self.checksums).data)
+
+    def test_rsyncdelta(self):
+        sig = signature.Signature.from_checksums(*self.checksums)
+        new_data = b'xyz' + self.data
+        self.assertEqual(
+            list(pyrsync.rsyncdelta(six.BytesIO(new_data),
+                                    self.checksums, 16)),
+            list(fastrsync.rsyncdelta(six.BytesIO(new_data), sig, 16)))
+
+    def test_changed_blocks(self):
+        old = signature.Signature.from_checksums(*self.checksums)
+        data = bytearray(self.data)
+        data[20] = 0
+        data[99] = 0
+        new = signature.Signature.from_stream(six.BytesIO(bytes(data)), 16)
+        self.assertEqual([1, 6], new.changed_blocks(old))
+        self.assertEqual([], old.changed_blocks(old))
+
+    def test_pickle(self):
+        sig = signature.Signature.from_checksums(*self.checksums)
+        copy = pickle.loads(pickle.dumps(sig))
+        self.assertEqual(self.checksums, (list(copy.weak), list(copy.strong)))
+
+    def test_pickle_mapped(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'records')
+        with open(path, 'wb') as records:
+            records.write(b'header')
+            records.write(signature.Signature.from_checksums(
+                *self.checksums).data)
+        store = signature.SignatureStore(path, 6, 7, 16)
+        self.addCleanup(store.close)
+        copy = pickle.loads(pickle.dumps(store.get(2, 3)))
+        self.addCleanup(signature._MAPPED_FILES.pop(path).close)
+        # The records are read from the mapped file, not copied
+        self.assertIsInstance(copy.data, mmap.mmap)
+        self.assertEqual(path, copy.source)
+        self.assertEqual(self.checksums[0][2:5], list(copy.weak))
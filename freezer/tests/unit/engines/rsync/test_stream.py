@@ -0,0 +1,80 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from freezer.engine.rsync import stream
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.inode = {
+            'ftype': 'r', 'level_id': '0000', 'deleted': '0000',
+            'mode': 33188, 'uid': 1000, 'gid': 1000, 'size': 10,
+            'mtime': 1500000000, 'ctime': 1500000001, 'inumber': 42,
+            'nlink': 1, 'devmajor': 8, 'devminor': 1,
+            'uname': 'user', 'gname': 'group', 'lname': ''}
+
+    def reader(self, data, chunk_size):
+        chunks = iter([data[i:i + chunk_size]
+                       for i in range(0, len(data), chunk_size)])
+        return stream.StreamReader(lambda: next(chunks, b''))
+
+    def test_records(self):
+        data = (stream.pack_header('dir/file', self.inode, 10) +
+                b'0123456789')
+        self.inode.update({'ftype': 'l', 'lname': 'file', 'size': 4,
+                           'level_id': '1111', 'deleted': '1111'})
+        data += stream.pack_header('dir/link', self.inode, 0)
+        for chunk_size in (1, 7, len(data)):
+            reader = self.reader(data, chunk_size)
+            header = reader.next_header()
+            self.assertEqual(('r', False, False, 'dir/file', 'user', 10),
+                             (header.ftype, header.incremental,
+                              header.deleted, header.path, header.uname,
+                              header.data_len))
+            self.assertEqual(b'0123456789', b''.join(
+                data.tobytes() for data in reader.iter_data()))
+            header = reader.next_header()
+            self.assertEqual(('l', True, True, 'file', 4),
+                             (header.ftype, header.incremental,
+                              header.deleted, header.lname, header.size))
+            self.assertIsNone(reader.next_header())
+
+    def test_skip_data(self):
+        data = (stream.pack_header('a', self.inode, 10) + b'0123456789' +
+                stream.pack_header('b', self.inode, 10) + b'9876543210')
+        reader = self.reader(data, 3)
+        reader.next_header()
+        self.assertEqual(b'01', b''.join(
+            data.tobytes() for data in reader.iter_data(2)))
+        self.assertEqual('b', reader.next_header().path)
+
+    def test_block_indexes(self):
+        indexes = stream.pack_block_indexes([1, 5, 2 ** 40])
+        self.assertEqual(stream.block_indexes_size(3), len(indexes))
+        data = (stream.pack_header('a', self.inode, len(indexes) + 3) +
+                indexes + b'xyz')
+        reader = self.reader(data, 5)
+        reader.next_header()
+        self.assertEqual((1, 5, 2 ** 40), reader.read_block_indexes())
+        self.assertEqual(b'xyz', b''.join(
+            data.tobytes() for data in reader.iter_data()))
+
+    def test_truncated(self):
+        data = stream.pack_header('a', self.inode, 10) + b'0123'
+        reader = self.reader(data, 4)
+        reader.next_header()
+        self.assertRaises(ValueError, list, reader.iter_data())
+        reader = self.reader(data[:stream.HEADER_SIZE - 1], 4)
+        self.assertRaises(ValueError, reader.next_header)
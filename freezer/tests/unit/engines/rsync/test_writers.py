@@ -0,0 +1,86 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import grp
+import os
+import pwd
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from freezer.engine.rsync import writers
+
+
+class TestWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.uname = pwd.getpwuid(os.getuid()).pw_name
+        self.gname = grp.getgrgid(os.getgid()).gr_name
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, name):
+        with open(os.path.join(self.tmpdir, name), 'rb') as file_fd:
+            return file_fd.read()
+
+    def test_write_file(self):
+        path = os.path.join(self.tmpdir, 'file')
+        writers.write_file(path, False, 6, [(None, b'abc'), (None, b'def')])
+        self.assertEqual(b'abcdef', self.read('file'))
+        writers.write_file(path, True, 5, [(1, b'X'), (None, b'Y')])
+        self.assertEqual(b'aXYde', self.read('file'))
+
+    def test_inode_setter(self):
+        inodes = writers.InodeSetter()
+        directory = os.path.join(self.tmpdir, 'dir')
+        os.mkdir(directory)
+        path = os.path.join(directory, 'file')
+        link = os.path.join(directory, 'link')
+        inodes.defer(directory, self.uname, self.gname, 0o40700, 1000)
+        inodes.defer(link, self.uname, self.gname, 0o100600, 2000)
+        with mock.patch('pwd.getpwnam', wraps=pwd.getpwnam) as getpwnam:
+            for mtime in range(3):
+                # A read only file is still updated by the next levels
+                with open(path, 'ab') as file_fd:
+                    file_fd.write(b'x')
+                inodes.defer(path, self.uname, self.gname, 0o100400, mtime)
+                self.assertNotEqual(0o400, os.stat(path).st_mode & 0o777)
+            os.symlink('file', link)
+            inodes.discard(link)
+            inodes.apply_deferred()
+            self.assertEqual(1, getpwnam.call_count)
+        self.assertEqual(1000, os.stat(directory).st_mtime)
+        self.assertEqual(0o700, os.stat(directory).st_mode & 0o777)
+        self.assertEqual(2, os.stat(path).st_mtime)
+        self.assertEqual(0o400, os.stat(path).st_mode & 0o777)
+        self.assertEqual({}, inodes.deferred)
+
+    def test_file_writers(self):
+        file_writers = writers.FileWriters(3)
+        for index in range(20):
+            file_writers.write(
+                os.path.join(self.tmpdir, str(index)), False, 2,
+                iter([(None, b'x'), (None, str(index % 10).encode())]))
+        file_writers.close()
+        for index in range(20):
+            self.assertEqual(b'x' + str(index % 10).encode(),
+                             self.read(str(index)))
+
+    def test_file_writers_error(self):
+        file_writers = writers.FileWriters(2)
+        file_writers.write(os.path.join(self.tmpdir, 'missing', 'file'),
+                           False, 1, [(None, b'x')])
+        self.assertRaises(IOError, file_writers.close)
@@ -109,3 +109,10 @@ class TestTarCommandRestoreBuilder(unittest.TestCase):
         assert tar_builders.get_tar_flag_from_algo('bzip2') == '-j'
         if not utils.is_bsd():
             assert tar_builders.get_tar_flag_from_algo('xz') == '-J'
+
+    def test_get_tar_flag_from_algo_level(self):
+        self.assertEqual(
+            "--use-compress-program='gzip -1'",
+            tar_builders.get_tar_flag_from_algo('gzip', 1))
+        self.assertEqual(
+            '-j', tar_builders.get_tar_flag_from_algo('bzip2', threads=4))
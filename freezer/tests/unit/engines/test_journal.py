@@ -0,0 +1,86 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from freezer.engine import engine
+from freezer.engine import journal
+from freezer.exceptions import engine as engine_exceptions
+from freezer.storage import base
+from freezer.storage import local
+
+
+class TestBackupJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.storage = local.LocalStorage(
+            os.path.join(self.tmpdir, 'storage'), 1000)
+        self.engine = mock.Mock()
+        self.engine.name = 'rsync'
+        self.engine.metadata.return_value = {'compression': 'gzip'}
+        self.backup = base.Backup(self.engine, 'host_backup', 1000, 1000, 0,
+                                  self.storage)
+        self.storage.create_dirs(self.backup.data_prefix_path)
+
+    def journal(self):
+        return journal.BackupJournal(os.path.join(self.tmpdir, 'journal'),
+                                     self.storage, self.engine,
+                                     'host_backup')
+
+    def start(self):
+        backup_journal = self.journal()
+        backup_journal.start(self.backup)
+        backup_journal.add_checkpoint(2, {'files': 10})
+        backup_journal.commit(1, 4, 'md5-1')
+        self.assertIsNone(backup_journal.load()['checkpoint'])
+        backup_journal.commit(0, 3, 'md5-0')
+        backup_journal.commit(2, 5, 'md5-2')
+        return backup_journal
+
+    def test_resume(self):
+        self.start()
+        backup_journal = self.journal()
+        backup = backup_journal.resume(None)
+        self.assertEqual((1000, 0), (backup.timestamp, backup.level))
+        self.assertEqual([(3, 'md5-0'), (4, 'md5-1')],
+                         backup_journal.resumed_segments)
+        self.assertEqual(7, backup_journal.resumed_offset)
+        self.assertEqual({'files': 10}, backup_journal.resumed_state)
+        self.assertTrue(os.path.isdir(self.backup.data_prefix_path))
+
+    def test_abandon(self):
+        self.start()
+        self.engine.metadata.return_value = {'compression': 'bzip2'}
+        backup_journal = self.journal()
+        self.assertIsNone(backup_journal.resume(None))
+        self.assertFalse(os.path.exists(self.backup.data_prefix_path))
+        self.assertFalse(os.path.exists(backup_journal.path))
+
+    def test_replay_stream(self):
+        backup_journal = mock.Mock(resumed_segments=[
+            (4, hashlib.md5(b'abcd').hexdigest()),
+            (2, hashlib.md5(b'ef').hexdigest())])
+        messages = engine.BackupEngine.replay_stream(
+            iter([b'abc', b'defg', b'hi']), backup_journal)
+        self.assertEqual([b'g', b'hi'], list(messages))
+        backup_journal.add_checkpoint.assert_called_with(4, {})
+        messages = engine.BackupEngine.replay_stream(
+            iter([b'abcd', b'eX']), backup_journal)
+        self.assertRaises(engine_exceptions.ResumeException, list, messages)
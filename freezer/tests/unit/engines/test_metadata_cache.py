@@ -0,0 +1,95 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import mock
+
+from freezer.engine import metadata_cache
+from freezer.storage import base
+from freezer.storage import local
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.cache = metadata_cache.MetadataCache(self.cache_dir)
+        self.storage = local.LocalStorage(
+            os.path.join(self.tmpdir, 'storage'), 1000)
+        self.storage.get_file = mock.Mock(wraps=self.storage.get_file)
+        engine = mock.Mock()
+        engine.name = 'rsync'
+        self.backup = self.put(engine, 1000, 0, 'manifest')
+
+    def put(self, engine, timestamp, level, content):
+        backup = base.Backup(engine, 'host_backup', 1000, timestamp, level,
+                             self.storage)
+        self.storage.create_dirs(backup.data_prefix_path)
+        with open(backup.engine_metadata_path, 'w') as metadata:
+            metadata.write(content)
+        self.cache.put_file(backup, backup.engine_metadata_path)
+        return backup
+
+    def get(self, backup):
+        path = os.path.join(self.tmpdir, 'engine_meta')
+        self.cache.get_file(backup, path)
+        with open(path) as metadata:
+            return metadata.read()
+
+    def entries(self):
+        entry_dir = os.path.join(self.cache_dir,
+                                 os.listdir(self.cache_dir)[0])
+        return sorted(os.listdir(entry_dir)), entry_dir
+
+    def test_hit(self):
+        self.assertEqual('manifest', self.get(self.backup))
+        self.assertFalse(self.storage.get_file.called)
+        names, entry_dir = self.entries()
+        self.assertEqual(['1000_0_1000', '1000_0_1000.json'], names)
+        self.assertEqual(0o600, stat.S_IMODE(
+            os.stat(os.path.join(entry_dir, names[0])).st_mode))
+
+    def test_changed(self):
+        with open(self.backup.engine_metadata_path, 'w') as metadata:
+            metadata.write('other manifest')
+        self.assertEqual('other manifest', self.get(self.backup))
+        self.assertTrue(self.storage.get_file.called)
+        self.storage.get_file.reset_mock()
+        self.assertEqual('other manifest', self.get(self.backup))
+        self.assertFalse(self.storage.get_file.called)
+
+    def test_damaged(self):
+        names, entry_dir = self.entries()
+        with open(os.path.join(entry_dir, names[0]), 'w') as cached:
+            cached.write('manifesX')
+        self.assertEqual('manifest', self.get(self.backup))
+        self.assertTrue(self.storage.get_file.called)
+
+    def test_level_zero(self):
+        increment = self.put(self.backup.engine, 1001, 1, 'increment')
+        self.assertEqual(4, len(self.entries()[0]))
+        new_level_zero = base.Backup(increment.engine, 'host_backup', 2000,
+                                     2000, 0, self.storage)
+        self.storage.create_dirs(new_level_zero.data_prefix_path)
+        with open(new_level_zero.engine_metadata_path, 'w') as metadata:
+            metadata.write('level zero')
+        self.cache.put_file(new_level_zero,
+                            new_level_zero.engine_metadata_path)
+        self.assertEqual(['2000_0_2000', '2000_0_2000.json'],
+                         self.entries()[0])
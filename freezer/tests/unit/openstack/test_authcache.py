@@ -0,0 +1,111 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import mock
+
+from freezer.openstack import authcache
+
+
+class FakeAuth(object):
+    """
+    Identity plugin authenticating with a new token on each session.
+    """
+
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self.tokens = 0
+        self.state = None
+        self.auth_ref = None
+
+    def get_headers(self, session, **kwargs):
+        if not self.state:
+            self.tokens += 1
+            self.state = 'token{0}'.format(self.tokens)
+            expires = datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=self.lifetime)
+            self.auth_ref = mock.Mock(expires=expires)
+        return {'X-Auth-Token': self.state}
+
+    def get_auth_state(self):
+        return self.state
+
+    def set_auth_state(self, state):
+        self.state = state
+        self.auth_ref = mock.Mock()
+
+
+class TestAuthCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.key = authcache.cache_key('http://keystone/v3', 'password',
+                                       {'username': 'u', 'password': 'p'})
+
+    def restore(self, lifetime=3600, key=None):
+        auth = FakeAuth(lifetime)
+        cache = authcache.AuthCache(self.cache_dir, key or self.key)
+        cache.restore(auth)
+        # The session authenticates on its first request only
+        self.assertEqual(0, auth.tokens)
+        authcache.CachedAuthSession(cache, auth=auth).get_token()
+        return auth
+
+    def test_reuse(self):
+        self.assertEqual('token1', self.restore().state)
+        path = os.path.join(self.cache_dir, self.key)
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+        self.assertEqual(0o700, stat.S_IMODE(os.stat(self.cache_dir).st_mode))
+        auth = self.restore()
+        self.assertEqual('token1', auth.state)
+        self.assertEqual(0, auth.tokens)
+        self.assertEqual([self.key], os.listdir(self.cache_dir))
+
+    def test_expired(self):
+        self.restore(lifetime=authcache.EXPIRY_MARGIN - 10)
+        auth = self.restore()
+        self.assertEqual(1, auth.tokens)
+
+    def test_key(self):
+        self.restore()
+        # The secrets are not part of the key
+        self.assertEqual(self.key, authcache.cache_key(
+            'http://keystone/v3', 'password',
+            {'username': 'u', 'password': 'q'}))
+        other_key = authcache.cache_key('http://keystone/v3', 'password',
+                                        {'username': 'u', 'password': 'p',
+                                         'project_name': 'admin'})
+        self.assertNotEqual(self.key, other_key)
+        self.assertEqual(1, self.restore(key=other_key).tokens)
+        self.assertNotIn(b'"p"', open(os.path.join(
+            self.cache_dir, self.key), 'rb').read())
+        # A token names no user to cache it for
+        self.assertIsNone(authcache.cache_key(
+            'http://keystone/v3', 'token', {'token': 't'}))
+
+    def test_unsafe_dir(self):
+        self.restore()
+        os.chmod(self.cache_dir, 0o755)
+        auth = self.restore()
+        self.assertEqual(1, auth.tokens)
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(os.path.join(
+            self.cache_dir, self.key)).st_mode))
+        with open(os.path.join(self.cache_dir, self.key)) as cache_file:
+            self.assertIn('token1', cache_file.read())
@@ -13,10 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import mock
 
+from freezer.openstack import authcache
 from freezer.openstack import osclients
 
 
@@ -44,6 +48,22 @@ class TestOsClients(unittest.TestCase):
     def test_create_nova(self):
         self.client_manager.create_nova()
 
+    def test_auth_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        opts = osclients.OpenstackOpts(
+            username="user", project_name="project", auth_url="url/v3",
+            password="password", identity_api_version="3",
+            user_domain_name='Default',
+            project_domain_name='Default').get_opts_dicts()
+        # Keystone is not reached until the session is used
+        client_manager = osclients.OSClientManager(
+            auth_method=opts.pop('auth_method'),
+            auth_url=opts.pop('auth_url'), auth_cache_dir=cache_dir, **opts)
+        self.assertIsInstance(client_manager.sess,
+                              authcache.CachedAuthSession)
+        self.assertEqual([], os.listdir(cache_dir))
+
     def test_dry_run(self):
         osclients.DryRunSwiftclientConnectionWrapper(mock.Mock())
 
@@ -58,3 +78,44 @@ class TestOsClients(unittest.TestCase):
 
     def get_nova(self):
         self.client_manager.get_nova()
+
+
+class TestSwiftConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = osclients.SwiftConnectionPool(self.connect)
+
+    @staticmethod
+    def connect(url, token):
+        return mock.Mock(spec=['url', 'token', 'close'], url=url,
+                         token=token)
+
+    def authenticate(self, connection, token):
+        connection.url, connection.token = 'url', token
+
+    def test_reuse(self):
+        connection = self.pool.get()
+        self.authenticate(connection, 'token')
+        self.pool.put(connection)
+        self.assertIs(connection, self.pool.get())
+        other = self.pool.get()
+        self.assertEqual(('url', 'token'), (other.url, other.token))
+
+    def test_renewed_token(self):
+        connection = self.pool.create()
+        self.authenticate(connection, 'old')
+        self.pool.remember(connection)
+        first = self.pool.get()
+        second = self.pool.get()
+        # The token of the first connection expired
+        self.authenticate(first, 'new')
+        self.pool.put(first)
+        self.pool.put(second)
+        self.assertEqual('new', self.pool.token)
+        self.assertEqual('new', self.pool.get().token)
+        self.assertEqual('new', self.pool.get().token)
+
+    def test_discard(self):
+        connection = self.pool.get()
+        self.pool.discard(connection)
+        connection.close.assert_called_once_with()
+        self.assertIsNot(connection, self.pool.get())
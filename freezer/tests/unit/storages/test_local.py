@@ -12,10 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import shutil
 import tempfile
 import unittest
 
+import mock
+
+from freezer.storage import base
 from freezer.storage import local
 from freezer.utils import utils
 
@@ -71,3 +75,121 @@ class TestLocalStorage(unittest.TestCase):
         backup_dir, files_dir, work_dir = self.create_dirs()
         storage = local.LocalStorage(backup_dir, work_dir, 10000)
         storage.info()
+
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.engine = mock.Mock()
+        self.engine.name = 'tar'
+        self.metadata = os.path.join(self.tmpdir, 'metadata')
+        with open(self.metadata, 'w') as metadata_file:
+            metadata_file.write('{}')
+
+    def storage(self, remove_workers=1):
+        return local.LocalStorage(os.path.join(self.tmpdir, 'storage'), 1000,
+                                  remove_workers=remove_workers)
+
+    def put(self, storage, level_zero_timestamp, level, timestamp):
+        backup = base.Backup(self.engine, 'host_backup',
+                             level_zero_timestamp, timestamp, level, storage)
+        storage.create_dirs(backup.data_prefix_path)
+        storage.put_metadata(self.metadata, self.metadata, backup)
+        return backup
+
+    def backups(self, storage):
+        return {zero.timestamp: sorted(
+            (level, backup.timestamp)
+            for level, backup in zero.get_increments().items())
+            for zero in storage.get_level_zero(self.engine, 'host_backup')}
+
+    def test_catalog(self):
+        storage = self.storage()
+        self.put(storage, 1000, 0, 1000)
+        self.put(storage, 1000, 1, 1001)
+        self.put(storage, 2000, 0, 2000)
+        storage = self.storage()
+        with mock.patch.object(storage, 'listdir',
+                               wraps=storage.listdir) as listdir:
+            self.assertEqual({1000: [(0, 1000), (1, 1001)],
+                              2000: [(0, 2000)]}, self.backups(storage))
+        # Only the level zero backups and the last one are listed
+        path = storage.metadata_path(self.engine, 'host_backup')
+        self.assertEqual([mock.call(path), mock.call(path + '/2000')],
+                         listdir.call_args_list)
+
+    def test_backup_missing_from_catalog(self):
+        storage = self.storage()
+        self.put(storage, 1000, 0, 1000)
+        self.put(storage, 1000, 1, 1001)
+        # Backups whose catalog update was lost, by an agent stopped
+        # before it or overwritten by another one
+        storage = self.storage()
+        with mock.patch.object(storage, 'update_catalog'):
+            self.put(storage, 1000, 2, 1002)
+        self.assertEqual({1000: [(0, 1000), (1, 1001), (2, 1002)]},
+                         self.backups(self.storage()))
+        storage = self.storage()
+        with mock.patch.object(storage, 'update_catalog'):
+            self.put(storage, 3000, 0, 3000)
+        storage = self.storage()
+        self.put(storage, 3000, 1, 3001)
+        self.assertEqual({1000: [(0, 1000), (1, 1001), (2, 1002)],
+                          3000: [(0, 3000), (1, 3001)]},
+                         self.backups(self.storage()))
+
+    def test_metadata_failed(self):
+        storage = self.storage()
+        self.put(storage, 1000, 0, 1000)
+        with mock.patch.object(storage, 'put_file',
+                               side_effect=IOError('Disk full')):
+            self.assertRaises(IOError, self.put, storage, 1000, 1, 1001)
+        # Listed by the catalog, but not by the storage
+        self.assertEqual({1000: [(0, 1000)]}, self.backups(storage))
+        self.assertEqual({1000: [(0, 1000)]}, self.backups(self.storage()))
+
+    def test_rebuild(self):
+        storage = self.storage()
+        self.put(storage, 1000, 0, 1000)
+        os.remove(storage.catalog_path(self.engine, 'host_backup'))
+        storage = self.storage()
+        self.put(storage, 1000, 1, 1001)
+        self.assertEqual({1000: [(0, 1000), (1, 1001)]},
+                         self.backups(self.storage()))
+
+    def test_update_failed(self):
+        storage = self.storage()
+        self.put(storage, 1000, 0, 1000)
+        storage = self.storage()
+        catalog_path = storage.catalog_path(self.engine, 'host_backup')
+        put_file = storage.put_file
+
+        def fail_catalog(from_path, to_path):
+            if to_path == catalog_path:
+                raise IOError('No space left on device')
+            put_file(from_path, to_path)
+
+        with mock.patch.object(storage, 'put_file',
+                               side_effect=fail_catalog):
+            self.put(storage, 1000, 1, 1001)
+        # The out of date catalog is removed, not trusted by the next run
+        self.assertFalse(os.path.exists(catalog_path))
+        self.assertEqual({1000: [(0, 1000), (1, 1001)]},
+                         self.backups(self.storage()))
+
+    def test_remove(self):
+        storage = self.storage(remove_workers=4)
+        backup = self.put(storage, 1000, 0, 1000)
+        self.put(storage, 1000, 1, 1001)
+        self.put(storage, 2000, 0, 2000)
+        self.put(storage, 3000, 0, 3000)
+        with mock.patch.object(storage, 'put_catalog',
+                               wraps=storage.put_catalog) as put_catalog:
+            storage.remove_older_than(self.engine, 2500, 'host_backup')
+        # A single catalog update for the removed backups
+        self.assertEqual(1, put_catalog.call_count)
+        self.assertEqual({3000: [(0, 3000)]}, self.backups(self.storage()))
+        self.assertFalse(os.path.exists(backup.increments_data_path))
+        self.assertFalse(os.path.exists(backup.increments_metadata_path))
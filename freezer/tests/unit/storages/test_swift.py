@@ -0,0 +1,469 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+import six
+import swiftclient
+
+from freezer.openstack import osclients
+from freezer.storage import base
+from freezer.storage import swift
+from freezer.utils import streaming
+
+# Not patched by the tests of the retries
+sleep = time.sleep
+
+
+class FakeSwift(object):
+    """
+    In memory Swift cluster, shared by its connections. The objects are
+    stored by full path, as swiftclient joins the container and the
+    object names.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.headers = {}
+        self.containers = set()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.put_delay = 0
+        self.put_failures = 0
+        self.get_delay = 0
+        self.get_failures = 0
+        self.listings = 0
+        self.connections = 0
+        # max_deletes_per_request of the bulk delete, 0 if not supported
+        self.bulk_delete = 0
+        self.bulk_requests = 0
+        self.deletes = 0
+        self.slo_max_segments = 1000
+
+    def slo_data(self, path):
+        """Data of an object, the concatenated segments of a Static Large
+        Object."""
+        if not self.headers[path].get('x-static-large-object'):
+            return self.objects[path]
+        return b''.join(
+            self.slo_data(segment['name'][1:]) for segment in
+            json.loads(self.objects[path].decode('utf-8')))
+
+    def etag(self, path):
+        """Etag of an object, the md5 of the etags of the segments of a
+        Static Large Object."""
+        if not self.headers[path].get('x-static-large-object'):
+            return hashlib.md5(self.objects[path]).hexdigest()
+        return hashlib.md5(b''.join(
+            segment['hash'].encode() for segment in
+            json.loads(self.objects[path].decode('utf-8')))).hexdigest()
+
+    def connection(self):
+        return FakeSwiftConnection(self)
+
+
+class FakeSwiftConnection(object):
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.url = None
+        self.token = None
+        self.cluster.connections += 1
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _path(container, obj=None):
+        return container if obj is None else '{0}/{1}'.format(container, obj)
+
+    def put_container(self, container):
+        self.cluster.containers.add(container)
+
+    def head_container(self, container):
+        if container not in self.cluster.containers:
+            raise swiftclient.ClientException('Not found', http_status=404)
+        return {}
+
+    def get_account(self):
+        return {}, [{'name': name, 'bytes': 0, 'count': 0}
+                    for name in sorted(self.cluster.containers)]
+
+    def put_object(self, container, obj, contents, content_length=None,
+                   etag=None, content_type=None, headers=None,
+                   query_string=None):
+        with self.cluster.lock:
+            if self.cluster.put_failures:
+                self.cluster.put_failures -= 1
+                raise IOError('PUT failed')
+            self.cluster.in_flight += 1
+            self.cluster.max_in_flight = max(self.cluster.max_in_flight,
+                                             self.cluster.in_flight)
+        sleep(self.cluster.put_delay)
+        if hasattr(contents, 'read'):
+            contents = contents.read()
+        if isinstance(contents, six.text_type):
+            contents = contents.encode('utf-8')
+        path = self._path(container, obj)
+        headers = dict(headers or {})
+        with self.cluster.lock:
+            self.cluster.in_flight -= 1
+        if etag and hashlib.md5(contents).hexdigest() != etag:
+            raise IOError('Unprocessable entity')
+        if query_string == 'multipart-manifest=put':
+            # Swift stores the manifest with the checked segments
+            segments = json.loads(contents.decode('utf-8'))
+            if len(segments) > self.cluster.slo_max_segments:
+                raise IOError('Too many segments')
+            for segment in segments:
+                segment_path = segment['path'][1:]
+                if (self.cluster.etag(segment_path) != segment['etag'] or
+                        len(self.cluster.slo_data(segment_path)) !=
+                        segment['size_bytes']):
+                    raise IOError('Bad segment {0}'.format(segment['path']))
+            contents = json.dumps([
+                dict({'name': segment['path'],
+                      'bytes': segment['size_bytes'],
+                      'hash': segment['etag']},
+                     **({'sub_slo': True} if self.cluster.headers[
+                         segment['path'][1:]].get('x-static-large-object')
+                        else {}))
+                for segment in segments]).encode('utf-8')
+            headers['x-static-large-object'] = 'True'
+        with self.cluster.lock:
+            self.cluster.objects[path] = bytes(contents)
+            self.cluster.headers[path] = headers
+        return hashlib.md5(bytes(contents)).hexdigest()
+
+    def get_capabilities(self):
+        capabilities = {'swift': {}, 'slo': {
+            'max_manifest_segments': self.cluster.slo_max_segments}}
+        if self.cluster.bulk_delete:
+            capabilities['bulk_delete'] = {
+                'max_deletes_per_request': self.cluster.bulk_delete}
+        return capabilities
+
+    def post_account(self, headers, response_dict=None, query_string=None,
+                     data=None):
+        assert query_string == 'bulk-delete'
+        paths = [six.moves.urllib.parse.unquote(line)[1:]
+                 for line in data.splitlines()]
+        assert len(paths) <= self.cluster.bulk_delete
+        with self.cluster.lock:
+            self.cluster.bulk_requests += 1
+            for path in paths:
+                self.cluster.objects.pop(path, None)
+                self.cluster.headers.pop(path, None)
+        return {}, json.dumps({'Response Status': '200 OK', 'Errors': [],
+                               'Number Deleted': len(paths)}).encode()
+
+    def delete_object(self, container, obj):
+        path = self._path(container, obj)
+        with self.cluster.lock:
+            self.cluster.deletes += 1
+            if path not in self.cluster.objects:
+                raise swiftclient.ClientException('Not found',
+                                                  http_status=404)
+            del self.cluster.objects[path]
+            del self.cluster.headers[path]
+
+    def get_container(self, container, prefix='', full_listing=False):
+        self.cluster.listings += 1
+        start = self._path(container, prefix)
+        return {}, [{'name': name[len(container) + 1:],
+                     'bytes': len(self.cluster.objects[name]),
+                     'hash': hashlib.md5(self.cluster.objects[name])
+                     .hexdigest()}
+                    for name in sorted(self.cluster.objects)
+                    if name.startswith(start)]
+
+    def get_object(self, container, obj, resp_chunk_size=None,
+                   query_string=None, headers=None):
+        path = self._path(container, obj)
+        headers = self.cluster.headers[path]
+        if query_string == 'multipart-manifest=get':
+            return headers, self.cluster.objects[path]
+        with self.cluster.lock:
+            if self.cluster.get_failures:
+                self.cluster.get_failures -= 1
+                raise IOError('GET failed')
+            self.cluster.in_flight += 1
+            self.cluster.max_in_flight = max(self.cluster.max_in_flight,
+                                             self.cluster.in_flight)
+        sleep(self.cluster.get_delay)
+        with self.cluster.lock:
+            self.cluster.in_flight -= 1
+        manifest = headers.get('x-object-manifest')
+        if headers.get('x-static-large-object'):
+            data = self.cluster.slo_data(path)
+        elif manifest:
+            data = b''.join(self.cluster.objects[name] for name in sorted(
+                self.cluster.objects) if name.startswith(manifest))
+        else:
+            data = self.cluster.objects[path]
+        if not resp_chunk_size:
+            return {}, data
+        return {}, iter([data[i:i + resp_chunk_size]
+                         for i in range(0, len(data), resp_chunk_size)])
+
+
+class TestSwiftStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = FakeSwift()
+        self.client_manager = mock.Mock()
+        self.client_manager.get_swift.return_value = self.cluster.connection()
+        self.client_manager.create_swift.side_effect = self.cluster.connection
+        self.client_manager.swift_pool = osclients.SwiftConnectionPool(
+            lambda url, token: self.cluster.connection())
+        engine = mock.Mock()
+        engine.name = 'tar'
+        self.backup = base.Backup(engine, 'host_backup', 1000, 1000, 0)
+
+    def storage(self, **kwargs):
+        return swift.SwiftStorage(self.client_manager, 'freezer', 4,
+                                  **kwargs)
+
+    def write_backup(self, storage, blocks, journal=None):
+        rich_queue = streaming.RichQueue(2)
+        thread = threading.Thread(target=rich_queue.put_messages,
+                                  args=(blocks,))
+        thread.start()
+        storage.write_backup(rich_queue, self.backup, journal)
+        thread.join()
+        return self.backup.copy(storage)
+
+    def test_write_backup_parallel(self):
+        self.cluster.put_delay = 0.05
+        blocks = [str(index).encode() * 4 for index in range(12)]
+        backup = self.write_backup(self.storage(upload_workers=3), blocks)
+        self.assertEqual(3, self.cluster.max_in_flight)
+        self.assertEqual(b''.join(blocks), b''.join(
+            self.storage().backup_blocks(backup)))
+        self.assertIn(backup.segments_path + '/00000011',
+                      self.cluster.objects)
+
+    @mock.patch('time.sleep')
+    def test_upload_retry(self, sleep):
+        self.cluster.put_failures = 3
+        self.write_backup(self.storage(upload_workers=2), [b'abcd'])
+        delays = [call[0][0] for call in sleep.call_args_list]
+        self.assertEqual(3, len(delays))
+        for attempt, delay in enumerate(delays):
+            self.assertTrue(0 <= delay <= swift.UPLOAD_RETRY_DELAY *
+                            2 ** attempt)
+
+    @mock.patch('time.sleep')
+    def test_upload_error(self, sleep):
+        self.cluster.put_failures = swift.UPLOAD_ATTEMPTS
+        storage = self.storage(upload_workers=2)
+        self.assertRaises(Exception, self.write_backup, storage,
+                          [b'abcd', b'efgh'])
+
+    @mock.patch('time.sleep')
+    def test_upload_error_discards_connection(self, sleep):
+        self.cluster.put_failures = swift.UPLOAD_ATTEMPTS
+        pool = self.client_manager.swift_pool
+        storage = self.storage(upload_workers=2)
+        with mock.patch.object(pool, 'discard',
+                               wraps=pool.discard) as discard:
+            self.assertRaises(Exception, self.write_backup, storage,
+                              [b'abcd'])
+        self.assertEqual(swift.UPLOAD_ATTEMPTS, discard.call_count)
+        discarded = set(call[0][0] for call in discard.call_args_list)
+        self.assertFalse(discarded & set(pool.idle))
+
+    @mock.patch('time.sleep')
+    def test_stream_error_not_masked(self, sleep):
+        self.cluster.put_failures = swift.UPLOAD_ATTEMPTS
+
+        def get_messages():
+            yield b'abcd'
+            raise ValueError('Stream stopped')
+
+        rich_queue = mock.Mock(get_messages=get_messages)
+        self.assertRaises(ValueError, self.storage(upload_workers=2)
+                          .write_backup, rich_queue, self.backup)
+
+    def test_backup_blocks_parallel(self):
+        blocks = [str(index).encode() * 4 for index in range(12)]
+        backup = self.write_backup(self.storage(), blocks)
+        self.cluster.get_delay = 0.05
+        self.cluster.max_in_flight = 0
+        storage = self.storage(download_workers=4, read_ahead=8)
+        self.assertEqual(blocks, list(storage.backup_blocks(backup)))
+        # The read ahead memory holds two segments
+        self.assertEqual(2, self.cluster.max_in_flight)
+
+    @mock.patch('time.sleep')
+    def test_download_retry(self, sleep):
+        blocks = [b'abcd', b'efgh', b'ij']
+        backup = self.write_backup(self.storage(), blocks)
+        self.cluster.get_failures = 2
+        storage = self.storage(download_workers=2, read_ahead=100)
+        self.assertEqual(blocks, list(storage.backup_blocks(backup)))
+        self.assertEqual(2, sleep.call_count)
+
+    @mock.patch('time.sleep')
+    def test_download_connection_error(self, sleep):
+        blocks = [b'abcd', b'efgh', b'ij']
+        backup = self.write_backup(self.storage(), blocks)
+        storage = self.storage(download_workers=2, read_ahead=100)
+        pool = self.client_manager.swift_pool
+        connection = self.cluster.connection()
+        # No connection for the threads, then no new connection after a
+        # failed download
+        for side_effect, get_failures in (IOError('No connection'), 0), (
+                [connection] + [IOError('No connection')] * 10, 1):
+            self.cluster.get_failures = get_failures
+            errors = []
+
+            def restore():
+                try:
+                    list(storage.backup_blocks(backup))
+                except IOError as error:
+                    errors.append(error)
+
+            with mock.patch.object(pool, 'get', side_effect=side_effect):
+                thread = threading.Thread(target=restore)
+                thread.daemon = True
+                thread.start()
+                thread.join(10)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(1, len(errors))
+
+    def test_slo(self):
+        blocks = [b'abcd', b'efgh', b'ij']
+        backup = self.write_backup(self.storage(upload_workers=2, slo=True),
+                                   blocks)
+        self.assertEqual('True', self.cluster.headers[
+            backup.data_path]['x-static-large-object'])
+        self.assertEqual(blocks, list(self.storage(
+            download_workers=2, read_ahead=100).backup_blocks(backup)))
+        # The segments are read from the manifest
+        self.assertEqual(0, self.cluster.listings)
+        self.assertEqual(b''.join(blocks), b''.join(
+            self.storage().backup_blocks(backup)))
+
+    def test_slo_nested_manifests(self):
+        self.cluster.slo_max_segments = 2
+        blocks = [b'ab', b'cd', b'ef', b'gh', b'ij']
+        backup = self.write_backup(self.storage(upload_workers=2, slo=True),
+                                   blocks)
+        # 5 segments listed by 3 manifests, listed by 2 manifests
+        manifest = json.loads(self.cluster.objects[backup.data_path]
+                              .decode('utf-8'))
+        self.assertEqual(2, len(manifest))
+        self.assertTrue(all(segment['sub_slo'] for segment in manifest))
+        self.assertEqual(b''.join(blocks), self.cluster.slo_data(
+            backup.data_path))
+        self.assertEqual(blocks, list(self.storage(
+            download_workers=2, read_ahead=100).backup_blocks(backup)))
+        self.assertEqual(0, self.cluster.listings)
+        # The nested manifests are removed with the backup
+        self.storage().rmtree(backup.data_prefix_path)
+        self.assertFalse([path for path in self.cluster.objects
+                          if path.startswith(backup.data_prefix_path)])
+
+    def test_write_backup_resume(self):
+        blocks = [b'abcd', b'efgh', b'ijkl', b'mnop']
+        backup = self.write_backup(self.storage(), blocks)
+        journal = mock.Mock(resumed_segments=[
+            (len(block), hashlib.md5(block).hexdigest())
+            for block in blocks[:2]])
+        self.write_backup(self.storage(upload_workers=2, slo=True),
+                          [b'qr'], journal)
+        journal.commit.assert_called_once_with(
+            2, 2, hashlib.md5(b'qr').hexdigest())
+        # The segment left after the resumed ones is deleted
+        self.assertNotIn(backup.segments_path + '/00000003',
+                         self.cluster.objects)
+        self.assertEqual([b'abcd', b'efgh', b'qr'],
+                         list(self.storage().backup_blocks(backup)))
+
+    @mock.patch('time.sleep')
+    def test_slo_corrupted_segment(self, sleep):
+        backup = self.write_backup(self.storage(slo=True),
+                                   [b'abcd', b'efgh'])
+        self.cluster.objects[backup.segments_path + '/00000001'] = b'efgX'
+        storage = self.storage(download_workers=2, read_ahead=100)
+        self.assertRaises(IOError, list, storage.backup_blocks(backup))
+
+    def test_prepare(self):
+        self.storage()
+        self.assertEqual({'freezer'}, self.cluster.containers)
+        self.client_manager.get_swift.return_value = mock.Mock(
+            wraps=self.cluster.connection())
+        self.storage()
+        self.assertFalse(
+            self.client_manager.get_swift.return_value.get_account.called)
+
+    def put_backup(self, storage, level_zero_timestamp, timestamp, level):
+        self.backup = base.Backup(self.backup.engine, 'host_backup',
+                                  level_zero_timestamp, timestamp, level)
+        self.write_backup(storage, [b'abcd', b'efgh', b'ij'])
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        metadata = os.path.join(tmpdir, 'metadata')
+        with open(metadata, 'w') as metadata_file:
+            metadata_file.write('{}')
+        storage.put_metadata(metadata, metadata, self.backup)
+
+    def remove_older_than(self, storage):
+        self.put_backup(storage, 1000, 1000, 0)
+        self.put_backup(storage, 1000, 1001, 1)
+        self.put_backup(storage, 2000, 2000, 0)
+        data_prefix = 'freezer/data/tar/host_backup/1000/'
+        removed = [path for path in self.cluster.objects
+                   if path.startswith(data_prefix) or path.startswith(
+                       'freezer/metadata/tar/host_backup/1000/')]
+        storage.remove_older_than(self.backup.engine, 1500, 'host_backup')
+        self.assertFalse(set(removed) & set(self.cluster.objects))
+        self.assertIn('freezer/data/tar/host_backup/2000/0_2000/data',
+                      self.cluster.objects)
+        self.assertEqual([2000], [backup.timestamp for backup in
+                                  self.storage().get_level_zero(
+                                      self.backup.engine, 'host_backup')])
+        return removed
+
+    def test_remove_older_than_bulk_delete(self):
+        self.cluster.bulk_delete = 3
+        removed = self.remove_older_than(self.storage(remove_workers=2))
+        # Two backups of a manifest, an engine metadata, three segments
+        # and a metadata
+        self.assertEqual(12, len(removed))
+        self.assertEqual(4, self.cluster.bulk_requests)
+        self.assertEqual(0, self.cluster.deletes)
+
+    def test_remove_older_than(self):
+        removed = self.remove_older_than(self.storage(remove_workers=3))
+        self.assertEqual(len(removed), self.cluster.deletes)
+        self.assertEqual(0, self.cluster.bulk_requests)
+
+    def test_connection_reuse(self):
+        blocks = [str(index).encode() * 4 for index in range(12)]
+        backup = self.write_backup(self.storage(upload_workers=3), blocks)
+        storage = self.storage(download_workers=3, read_ahead=100)
+        self.assertEqual(blocks, list(storage.backup_blocks(backup)))
+        self.assertEqual(b''.join(blocks),
+                         b''.join(storage.backup_blocks(backup)))
+        # The get_swift connection and the ones of the threads
+        self.assertEqual(4, self.cluster.connections)
@@ -0,0 +1,134 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib
+from multiprocessing import pool
+import os
+import unittest
+
+import mock
+
+from freezer.utils import compress
+
+
+class TestParallelCompressor(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = pool.ThreadPool(3)
+        self.addCleanup(self.pool.terminate)
+
+    def check(self, compression_algo):
+        compressor = compress.ParallelCompressor(compression_algo,
+                                                 self.pool, 3, 1000)
+        compressor.compress_block = mock.Mock(
+            wraps=compressor.compress_block)
+        chunks = [os.urandom(size) for size in (10, 990, 3500, 20, 0, 700)]
+        compressed = [compressor.compress(chunk) for chunk in chunks]
+        compressed.append(compressor.flush())
+        # The 3500 bytes chunk is split in blocks, its end joins the next
+        # chunks
+        self.assertEqual(5, compressor.compress_block.call_count)
+        decompressor = compress.Decompressor(compression_algo)
+        data = b''.join(decompressor.decompress(part) for part in compressed)
+        self.assertEqual(b''.join(chunks), data)
+
+    def test_gzip(self):
+        self.check('gzip')
+
+    def test_bzip2(self):
+        self.check('bzip2')
+
+    def test_adapt_level(self):
+        compressor = compress.ParallelCompressor('gzip', self.pool, 1,
+                                                 level=6, min_level=4)
+        for _ in range(3):
+            compressor.adapt_level(False)
+        self.assertEqual(4, compressor.level)
+        for _ in range(3):
+            compressor.adapt_level(True)
+        self.assertEqual(5, compressor.level)
+
+    def test_estimate_ratio(self):
+        self.assertGreater(compress.estimate_ratio(os.urandom(100000)), 0.95)
+        self.assertLess(compress.estimate_ratio(
+            os.urandom(1000) * 100), 0.5)
+
+
+def installed(compression_algo):
+    try:
+        compress.import_compression_module(compression_algo)
+    except ImportError:
+        return False
+    return True
+
+
+class TestCompression(unittest.TestCase):
+
+    def check(self, compression_algo):
+        data = os.urandom(1000) + b'a' * 100000
+        compressor = compress.Compressor(compression_algo, 1)
+        compressed = compressor.compress(data) + compressor.flush()
+        self.assertLess(len(compressed), 2000)
+        self.assertEqual(compression_algo,
+                         compress.detect_compression_algo(compressed))
+        # Restore decompresses several streams one after the other
+        decompressor = compress.Decompressor(compression_algo)
+        self.assertEqual(data * 2, decompressor.decompress(
+            compressed + compressed[:500]) + decompressor.decompress(
+            compressed[500:]) + decompressor.flush())
+
+    def test_gzip(self):
+        self.check('gzip')
+
+    def test_bzip2(self):
+        self.check('bzip2')
+
+    @unittest.skipIf(not installed('xz'), "No lzma module")
+    def test_xz(self):
+        self.check('xz')
+
+    @unittest.skipIf(not installed('zstd'), "No zstandard module")
+    def test_zstd(self):
+        self.check('zstd')
+
+    @unittest.skipIf(not installed('zstd'), "No zstandard module")
+    def test_zstd_dictionary(self):
+        samples = [u'{0} {1} /etc/freezer/job-{2}.conf\n'.format(
+            index, index * 7919 % 1000, index % 50).encode('utf-8') * 3
+            for index in range(1000)]
+        _, dictionary = compress.train_dictionary(samples, 4096)
+        data = samples[-1]
+        compressed = compress.one_shot_compress('zstd', data,
+                                                dictionary=dictionary)
+        self.assertLess(len(compressed),
+                        len(compress.one_shot_compress('zstd', data)))
+        self.assertEqual(data, compress.one_shot_decompress(
+            'zstd', compressed, dictionary))
+        self.assertRaises(ValueError, compress.Compressor, 'gzip',
+                          dictionary=dictionary)
+
+    @unittest.skipIf(not installed('lz4'), "No lz4 module")
+    def test_lz4(self):
+        self.check('lz4')
+
+    def test_compression_level(self):
+        self.assertEqual(9, compress.get_compression_level('gzip'))
+        self.assertEqual(19, compress.get_compression_level('zstd', '19'))
+        self.assertRaises(ValueError, compress.get_compression_level,
+                          'bzip2', 0)
+        self.assertRaises(ValueError, compress.get_compression_level,
+                          'zip', 1)
+
+    def test_missing_module(self):
+        with mock.patch.object(importlib, 'import_module',
+                               side_effect=ImportError):
+            self.assertRaises(ImportError, compress.Compressor, 'zstd')
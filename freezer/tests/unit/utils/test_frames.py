@@ -0,0 +1,97 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+from multiprocessing import pool
+import os
+import shutil
+import tempfile
+import unittest
+
+from freezer.utils import frames
+
+
+class TestFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = pool.ThreadPool(3)
+        self.addCleanup(self.pool.terminate)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.pass_file = os.path.join(self.tmpdir, 'key')
+        with open(self.pass_file, 'w') as key:
+            key.write('secret\n')
+        self.chunks = [os.urandom(300) + b'a' * 700 for _ in range(10)]
+
+    def encode(self, pass_file=None):
+        encoder = frames.FrameEncoder('gzip', self.pool, 3, 2500,
+                                      pass_file)
+        encoded = [encoder.header()]
+        encoded.extend(encoder.compress(chunk) for chunk in self.chunks[:4])
+        # A new encoder continues the stream after the end of a frame
+        encoded.append(encoder.end_frame())
+        encoder = frames.FrameEncoder('gzip', self.pool, 3, 2500,
+                                      pass_file, encoder.state())
+        encoded.extend(encoder.compress(chunk) for chunk in self.chunks[4:])
+        encoded.append(encoder.flush())
+        return b''.join(encoded)
+
+    def decode(self, stream, pass_file=None):
+        decoder = frames.FrameDecoder('gzip', 3, pass_file)
+        decoded = [decoder.decompress(stream[position:position + 100])
+                   for position in range(0, len(stream), 100)]
+        decoded.append(decoder.flush())
+        return b''.join(decoded)
+
+    def test_decode(self):
+        stream = self.encode()
+        self.assertEqual(b''.join(self.chunks), self.decode(stream))
+
+    def test_encrypted(self):
+        stream = self.encode(self.pass_file)
+        self.assertNotIn(b'a' * 100, stream)
+        self.assertEqual(b''.join(self.chunks),
+                         self.decode(stream, self.pass_file))
+        self.assertRaises(ValueError, self.decode, stream)
+
+    def test_truncated(self):
+        stream = self.encode()
+        self.assertRaises(ValueError, self.decode, stream[:-10])
+
+    def test_read_frames(self):
+        stream = self.encode(self.pass_file)
+        data = b''.join(self.chunks)
+        # Frames of whole chunks up to 2500 bytes at least, and the end
+        # of the 4th chunk ends a frame
+        self.assertEqual([0, 3000, 4000, 7000], [
+            data_offset for _, data_offset in frames.read_index(
+                io.BytesIO(stream))])
+        for data_offset, frame in frames.read_frames(
+                io.BytesIO(stream), 'gzip', self.pass_file, first=2):
+            self.assertEqual(data[data_offset:data_offset + len(frame)],
+                             frame)
+        self.assertEqual(len(data), data_offset + len(frame))
+
+    def test_adaptive(self):
+        encoder = frames.FrameEncoder('gzip', self.pool, 3, 1000,
+                                      self.pass_file, adaptive=True)
+        chunks = [os.urandom(1000), b'a' * 1000, os.urandom(1000)]
+        stream = b''.join([encoder.header()] + [
+            encoder.compress(chunk) for chunk in chunks] + [encoder.flush()])
+        self.assertEqual({'raw_bytes': 2000, 'compressed_bytes': 1000,
+                          'compressed_size': encoder.stats['compressed_size']},
+                         encoder.stats)
+        self.assertLess(encoder.stats['compressed_size'], 100)
+        self.assertEqual(b''.join(chunks),
+                         self.decode(stream, self.pass_file))
+        self.assertEqual(chunks, [frame for _, frame in frames.read_frames(
+            io.BytesIO(stream), 'gzip', self.pass_file)])
@@ -0,0 +1,75 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import unittest
+
+from freezer.utils import ringbuffer
+
+
+def send_streams(ring, streams):
+    for stream in streams:
+        for data in stream:
+            ring.send_bytes(data)
+        ring.send_end()
+
+
+def recv_stream(ring):
+    data = []
+    try:
+        while True:
+            data.append(ring.recv_bytes())
+    except EOFError:
+        return data
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = ringbuffer.RingBuffer(16, 8)
+        self.addCleanup(self.ring.close)
+
+    def test_streams(self):
+        streams = [[b'abc', b'', b'0123456789'], [], [b'x' * 8] * 20]
+        producer = multiprocessing.Process(target=send_streams,
+                                           args=(self.ring, streams))
+        producer.start()
+        self.assertEqual([b'abc', b'', b'01234567', b'89'],
+                         recv_stream(self.ring))
+        self.assertEqual([], recv_stream(self.ring))
+        self.assertEqual([b'x' * 8] * 20, recv_stream(self.ring))
+        producer.join()
+        self.assertEqual(0, producer.exitcode)
+
+    def test_abort(self):
+        self.ring.send_bytes(b'a')
+        self.ring.send_bytes(b'b')
+        self.ring.abort()
+        # The ring is full
+        self.assertRaises(ringbuffer.RingAborted, self.ring.send_bytes, b'c')
+        self.assertEqual(b'a', self.ring.recv_bytes())
+
+    def test_recv_view(self):
+        self.ring.send_bytes(b'abc')
+        self.ring.send_bytes(b'def')
+        view = self.ring.recv_view()
+        self.assertEqual(b'abc', bytes(view))
+        # The slot is lent until the next message is received
+        self.assertFalse(self.ring.free.acquire(False))
+        self.assertEqual(b'def', self.ring.recv_bytes())
+        self.assertTrue(self.ring.free.acquire(False))
+        self.ring.free.release()
+        self.ring.send_bytes(b'ghi')
+        self.ring.send_end()
+        self.assertEqual(b'ghi', bytes(self.ring.recv_view()))
+        self.assertRaises(EOFError, self.ring.recv_view)
+        self.assertIsNone(self.ring.lent)
@@ -12,31 +12,347 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import importlib
+import struct
+import zlib
+
+from oslo_log import log
+import six
+
+LOG = log.getLogger(__name__)
+
 GZIP = 'zlib'
 BZIP2 = 'bz2'
 XZ = 'lzma'
+ZSTD = 'zstandard'
+LZ4 = 'lz4.frame'
 
 COMPRESS_METHOD = 'compress'
 DECOMPRESS_METHOD = 'decompress'
 
+# (minimum, maximum, default) compression level of each algorithm
+COMPRESSION_LEVELS = {
+    'gzip': (0, 9, 9),
+    'bzip2': (1, 9, 9),
+    'xz': (0, 9, 6),
+    'zstd': (1, 22, 3),
+    'lz4': (0, 16, 0),
+}
+
+# Packages of the modules which are not in the standard library
+COMPRESSION_PACKAGES = {
+    'xz': 'backports.lzma',
+    'zstd': 'zstandard',
+    'lz4': 'lz4',
+}
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Magic numbers of the compressed streams
+COMPRESSION_MAGICS = [
+    (ZSTD_MAGIC, 'zstd'),
+    (b'\x04\x22\x4d\x18', 'lz4'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'BZh', 'bzip2'),
+]
+
+# Samples of the data from which the compression ratio is estimated
+RATIO_SAMPLES = 4
+RATIO_SAMPLE_SIZE = 16384
+
+if six.PY2:
+    # The compressors of Python 2 do not read memoryviews
+    _view = buffer  # noqa
+else:
+    def _view(data, offset, size):
+        return memoryview(data)[offset:offset + size]
+
 
 def get_compression_algo(compression_algo):
     algo = {
         'gzip': GZIP,
         'bzip2': BZIP2,
         'xz': XZ,
+        'zstd': ZSTD,
+        'lz4': LZ4,
     }
     return algo.get(compression_algo)
 
 
-def one_shot_compress(compression_algo, data):
-    compression_module = __import__(get_compression_algo(compression_algo))
-    return getattr(compression_module, COMPRESS_METHOD)(data)
+def get_compression_level(compression_algo, level=None):
+    """
+    Checks a compression level.
+
+    :param level: compression level, None for the default level of the
+                  algorithm
+    :return: the compression level
+    :raises ValueError: if the algorithm or the level is not supported
+    """
+    if compression_algo not in COMPRESSION_LEVELS:
+        raise ValueError('Unsupported compression algorithm {0}'.format(
+            compression_algo))
+    minimum, maximum, default = COMPRESSION_LEVELS[compression_algo]
+    if level is None:
+        return default
+    level = int(level)
+    if not minimum <= level <= maximum:
+        raise ValueError(
+            'The {0} compression level must be between {1} and {2}'.format(
+                compression_algo, minimum, maximum))
+    return level
+
+
+def detect_compression_algo(data, default=None):
+    """
+    Detects the algorithm of compressed data from its magic number, or
+    from the zlib header of gzip data.
+
+    :param data: start of the compressed data
+    :param default: algorithm returned if none is detected
+    """
+    for magic, compression_algo in COMPRESSION_MAGICS:
+        if data.startswith(magic):
+            return compression_algo
+    header = bytearray(data[:2])
+    if (len(header) == 2 and header[0] & 0x0f == 8 and
+            (header[0] << 8 | header[1]) % 31 == 0):
+        return 'gzip'
+    return default
+
 
+def estimate_ratio(data):
+    """
+    Estimates the compression ratio of data, compressed size over size,
+    from the ratio of zlib at level 1 on samples spread over the data.
+    """
+    size = RATIO_SAMPLES * RATIO_SAMPLE_SIZE
+    if len(data) <= size:
+        sample = bytes(data)
+    else:
+        step = (len(data) - RATIO_SAMPLE_SIZE) // (RATIO_SAMPLES - 1)
+        sample = b''.join(
+            bytes(data[offset:offset + RATIO_SAMPLE_SIZE])
+            for offset in range(0, step * RATIO_SAMPLES, step))
+    if not sample:
+        return 1.0
+    return len(zlib.compress(sample, 1)) / float(len(sample))
+
+
+def import_compression_module(compression_algo):
+    """
+    :return: the module implementing a compression algorithm
+    :raises ImportError: if the module is not installed
+    """
+    module_name = get_compression_algo(compression_algo)
+    if module_name is None:
+        raise ValueError('Unsupported compression algorithm {0}'.format(
+            compression_algo))
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        if compression_algo == 'xz' and six.PY2:
+            try:
+                return importlib.import_module('backports.lzma')
+            except ImportError:
+                pass
+        raise ImportError('Please install the {0} module to use {1} '
+                          'compression'.format(
+                              COMPRESSION_PACKAGES[compression_algo],
+                              compression_algo))
+
+
+class LZ4Compressobj(object):
+    """
+    lz4.frame compressor with the interface of zlib.compressobj.
+    """
+
+    def __init__(self, module, level):
+        self.compressor = module.LZ4FrameCompressor(compression_level=level)
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, b''
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        header, self.header = self.header, b''
+        return header + self.compressor.flush()
+
+
+def _check_dictionary(compression_algo, dictionary):
+    if dictionary is not None and compression_algo != 'zstd':
+        raise ValueError('Compression dictionaries need zstd compression')
+
+
+def _zstd_dictionary(module, dictionary):
+    # Old versions of python-zstandard do not accept a None dict_data
+    if dictionary is None:
+        return {}
+    return {'dict_data': module.ZstdCompressionDict(dictionary)}
+
+
+def train_dictionary(samples, size):
+    """
+    Trains a zstd dictionary.
+
+    :param samples: list of binary strings typical of the compressed data
+    :param size: maximum size of the dictionary
+    :return: (id, content) of the dictionary
+    :raises ValueError: if the dictionary cannot be trained from the
+                        samples
+    """
+    module = import_compression_module('zstd')
+    try:
+        dictionary = module.train_dictionary(size, samples)
+    except module.ZstdError as e:
+        raise ValueError('Cannot train a compression dictionary: '
+                         '{0}'.format(e))
+    return dictionary.dict_id(), dictionary.as_bytes()
+
+
+class ZstdDecompressobj(object):
+    """
+    Decompressor of a zstd frame with the eof and unused_data attributes
+    of zlib.decompressobj, which the decompressobj of python-zstandard
+    lacks before version 0.15, the last ones supporting Python 2. The
+    end of the frame is found from its header and the headers of its
+    blocks.
+
+    :param dictionary: content of the dictionary of the frame
+    """
 
-def one_shot_decompress(compression_algo, data):
-    compression_module = __import__(get_compression_algo(compression_algo))
-    return getattr(compression_module, DECOMPRESS_METHOD)(data)
+    def __init__(self, module, dictionary=None):
+        self.decompressobj = module.ZstdDecompressor(
+            **_zstd_dictionary(module, dictionary)).decompressobj()
+        self.eof = False
+        self.unused_data = b''
+        # Header being read, of the frame or of a block
+        self.header = b''
+        self.in_frame = False
+        self.checksum = False
+        self.last_block = False
+        # Bytes of the frame to pass before the next header
+        self.skip = 0
+
+    def _header_size(self):
+        if self.in_frame:
+            return 3
+        if len(self.header) < 5:
+            return 5
+        descriptor = bytearray(self.header)[4]
+        fcs_flag = descriptor >> 6
+        single_segment = descriptor >> 5 & 1
+        return (5 + (1 - single_segment) + (0, 1, 2, 4)[descriptor & 3] +
+                (single_segment, 2, 4, 8)[fcs_flag])
+
+    def _read_header(self):
+        if not self.in_frame:
+            if not self.header.startswith(ZSTD_MAGIC):
+                raise ValueError('Invalid zstd frame')
+            self.checksum = bool(bytearray(self.header)[4] & 4)
+            self.in_frame = True
+        else:
+            block_header = struct.unpack('<I', self.header + b'\x00')[0]
+            self.last_block = bool(block_header & 1)
+            # RLE blocks hold one byte
+            self.skip = (1 if block_header >> 1 & 3 == 1
+                         else block_header >> 3)
+            if self.last_block and self.checksum:
+                self.skip += 4
+        self.header = b''
+
+    def _parse(self, data):
+        """
+        :return: the length of the start of data in the frame
+        """
+        position = 0
+        while not self.eof and position < len(data):
+            if self.skip:
+                step = min(self.skip, len(data) - position)
+                self.skip -= step
+                position += step
+            else:
+                size = self._header_size()
+                step = min(size - len(self.header), len(data) - position)
+                self.header += data[position:position + step]
+                position += step
+                if len(self.header) == self._header_size():
+                    self._read_header()
+            self.eof = self.last_block and not self.skip
+        return position
+
+    def decompress(self, data):
+        if self.eof:
+            self.unused_data += data
+            return b''
+        end = self._parse(data)
+        if self.eof:
+            # Copied, data may be a view on a ring buffer slot
+            self.unused_data = bytes(data[end:])
+            data = data[:end]
+        return self.decompressobj.decompress(data) if data else b''
+
+    def flush(self):
+        return self.decompressobj.flush() or b''
+
+
+def create_compressobj(compression_algo, level=None, threads=0,
+                       dictionary=None):
+    """
+    Creates a compressor of a stream, with the interface of
+    zlib.compressobj.
+
+    :param level: compression level, None for the default level
+    :param threads: number of threads of the zstd compressor, 0 to
+                    compress in the calling thread
+    :param dictionary: content of a zstd dictionary, see train_dictionary
+    """
+    _check_dictionary(compression_algo, dictionary)
+    module = import_compression_module(compression_algo)
+    level = get_compression_level(compression_algo, level)
+    if compression_algo == 'gzip':
+        return module.compressobj(level)
+    if compression_algo == 'bzip2':
+        return module.BZ2Compressor(level)
+    if compression_algo == 'xz':
+        return module.LZMACompressor(preset=level)
+    if compression_algo == 'zstd':
+        return module.ZstdCompressor(
+            level=level, threads=threads,
+            **_zstd_dictionary(module, dictionary)).compressobj()
+    return LZ4Compressobj(module, level)
+
+
+def create_decompressobj(compression_algo, dictionary=None):
+    """
+    Creates a decompressor of a stream, with the decompress method and
+    unused_data attribute of zlib.decompressobj.
+
+    :param dictionary: content of the zstd dictionary of the stream
+    """
+    _check_dictionary(compression_algo, dictionary)
+    module = import_compression_module(compression_algo)
+    if compression_algo == 'gzip':
+        return module.decompressobj()
+    if compression_algo == 'bzip2':
+        return module.BZ2Decompressor()
+    if compression_algo == 'xz':
+        return module.LZMADecompressor()
+    if compression_algo == 'zstd':
+        return ZstdDecompressobj(module, dictionary)
+    return module.LZ4FrameDecompressor()
+
+
+def one_shot_compress(compression_algo, data, level=None, dictionary=None):
+    compressobj = create_compressobj(compression_algo, level,
+                                     dictionary=dictionary)
+    return compressobj.compress(data) + compressobj.flush()
+
+
+def one_shot_decompress(compression_algo, data, dictionary=None):
+    decompressor = Decompressor(compression_algo, dictionary)
+    return decompressor.decompress(data) + decompressor.flush()
 
 
 class BaseCompressor(object):
@@ -45,35 +361,32 @@ class BaseCompressor(object):
     """
 
     def __init__(self, compression_algo):
-        # TODO(raliev): lzma module exists in stdlib since Py3 only
-        if compression_algo == 'xz':
-            raise NotImplementedError('XZ compression not implemented yet')
         self.algo = get_compression_algo(compression_algo)
-        self.module = __import__(self.algo)
+        self.module = import_compression_module(compression_algo)
 
 
 class Compressor(BaseCompressor):
     """
     Compress chucks of data.
-    """
 
-    MAX_COMPRESS_LEVEL = 9
+    :param level: compression level, None for the default level of the
+                  algorithm, see COMPRESSION_LEVELS
+    :param threads: number of threads compressing a zstd stream, 0 to
+                    compress in the calling thread
+    :param dictionary: content of a zstd dictionary, see train_dictionary
+    """
 
-    def __init__(self, compression_algo):
+    def __init__(self, compression_algo, level=None, threads=0,
+                 dictionary=None):
         super(Compressor, self).__init__(compression_algo)
+        self.level = get_compression_level(compression_algo, level)
+        self.threads = threads
+        self.dictionary = dictionary
         self.compressobj = self.create_compressobj(compression_algo)
 
     def create_compressobj(self, compression_algo):
-        def get_obj_name():
-            names = {
-                'gzip': 'compressobj',
-                'bzip2': 'BZ2Compressor',
-                'xz': 'compressobj',
-            }
-            return names.get(compression_algo)
-
-        obj_name = get_obj_name()
-        return getattr(self.module, obj_name)(self.MAX_COMPRESS_LEVEL)
+        return create_compressobj(compression_algo, self.level,
+                                  self.threads, self.dictionary)
 
     def compress(self, data):
         return self.compressobj.compress(data)
@@ -82,29 +395,159 @@ class Compressor(BaseCompressor):
         return self.compressobj.flush()
 
 
+class ParallelCompressor(Compressor):
+    """
+    Compresses chunks of data by blocks of BLOCK_SIZE bytes, each one as
+    a separate compressed stream, on a pool of threads. The blocks are
+    compressed on several cores, without being copied to other processes,
+    as long as the compression module releases the GIL while compressing.
+    The compressed blocks are returned in order.
+
+    :param pool: multiprocessing.pool.ThreadPool compressing the blocks
+    :param workers: number of threads of the pool
+    :param block_size: size of the blocks, BLOCK_SIZE if None
+    :param level: compression level, None for the default level
+    :param min_level: lowest level to which the level is lowered while
+                      the stream waits for the compression of its blocks,
+                      None to keep the level
+    :param dictionary: content of a zstd dictionary, see train_dictionary
+    """
+
+    BLOCK_SIZE = 4194304
+
+    def __init__(self, compression_algo, pool, workers, block_size=None,
+                 level=None, min_level=None, dictionary=None):
+        super(ParallelCompressor, self).__init__(
+            compression_algo, level, dictionary=dictionary)
+        self.compression_algo = compression_algo
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.pool = pool
+        # Blocks compressed ahead of the returned data
+        self.max_pending = 2 * workers
+        self.pending = collections.deque()
+        self.chunks = []
+        self.size = 0
+        self.max_level = self.level
+        self.min_level = self.level
+        if min_level is not None:
+            self.min_level = min(self.level, get_compression_level(
+                compression_algo, min_level))
+        # Blocks compressed in time since the stream last waited
+        self.ready_blocks = 0
+
+    def compress_block(self, block):
+        compressobj = self.create_compressobj(self.compression_algo)
+        return compressobj.compress(block) + compressobj.flush()
+
+    def _submit(self, block):
+        self.pending.append(self.pool.apply_async(self.compress_block,
+                                                  (block,)))
+
+    def _submit_chunks(self):
+        if not self.chunks:
+            return
+        if len(self.chunks) == 1:
+            self._submit(self.chunks[0])
+        else:
+            self._submit(b''.join(self.chunks))
+        self.chunks = []
+        self.size = 0
+
+    def compress(self, data):
+        offset = 0
+        if not self.chunks:
+            # The blocks of large chunks are views, not copies
+            while len(data) - offset >= self.block_size:
+                self._submit(_view(data, offset, self.block_size))
+                offset += self.block_size
+        if offset < len(data):
+            self.chunks.append(data[offset:] if offset else data)
+            self.size += len(data) - offset
+            if self.size >= self.block_size:
+                self._submit_chunks()
+
+        compressed = []
+        while self.pending and (len(self.pending) > self.max_pending or
+                                self.pending[0].ready()):
+            result = self.pending.popleft()
+            self.adapt_level(result.ready())
+            compressed.append(self.compressed(result.get()))
+        return b''.join(compressed)
+
+    def adapt_level(self, ready):
+        """
+        Lowers the level of the next blocks when the stream waits for
+        the compression of a block, and raises it back once max_pending
+        blocks were compressed in time.
+
+        :param ready: whether the block was compressed when needed
+        """
+        if self.min_level == self.max_level:
+            return
+        if not ready:
+            self.ready_blocks = 0
+            if self.level > self.min_level:
+                self.level -= 1
+                LOG.debug('Compression level lowered to {0}'.format(
+                    self.level))
+            return
+        self.ready_blocks += 1
+        if (self.ready_blocks >= self.max_pending and
+                self.level < self.max_level):
+            self.ready_blocks = 0
+            self.level += 1
+            LOG.debug('Compression level raised to {0}'.format(self.level))
+
+    def compressed(self, result):
+        """
+        Returns the data of a compressed block, in the order of the blocks.
+        """
+        return result
+
+    def flush(self):
+        self._submit_chunks()
+        compressed = [self.compressed(result.get())
+                      for result in self.pending]
+        self.pending.clear()
+        return b''.join(compressed)
+
+
 class Decompressor(BaseCompressor):
     """
     Decompress chucks of data.
+
+    :param dictionary: content of the zstd dictionary of the data
     """
 
-    def __init__(self, compression_algo):
+    def __init__(self, compression_algo, dictionary=None):
         super(Decompressor, self).__init__(compression_algo)
+        self.compression_algo = compression_algo
+        self.dictionary = dictionary
         self.decompressobj = self.create_decompressobj(compression_algo)
 
     def create_decompressobj(self, compression_algo):
-        def get_obj_name():
-            names = {
-                'gzip': 'decompressobj',
-                'bzip2': 'BZ2Decompressor',
-                'xz': 'decompressobj',
-            }
-            return names.get(compression_algo)
-
-        obj_name = get_obj_name()
-        return getattr(self.module, obj_name)()
+        return create_decompressobj(compression_algo, self.dictionary)
 
     def decompress(self, data):
-        return self.decompressobj.decompress(data)
+        # The stream of a resumable backup holds several compressed
+        # streams, one after the other
+        if getattr(self.decompressobj, 'eof', False):
+            self.decompressobj = self.create_decompressobj(
+                self.compression_algo)
+        try:
+            result = self.decompressobj.decompress(data)
+        except EOFError:
+            self.decompressobj = self.create_decompressobj(
+                self.compression_algo)
+            result = self.decompressobj.decompress(data)
+        while self.decompressobj.unused_data:
+            data = self.decompressobj.unused_data
+            self.decompressobj = self.create_decompressobj(
+                self.compression_algo)
+            result += self.decompressobj.decompress(data)
+        return result
 
     def flush(self):
-        return self.decompressobj.flush()
+        # Only zlib keeps data until the end of the stream
+        flush = getattr(self.decompressobj, 'flush', None)
+        return flush() if flush else b''
@@ -12,10 +12,13 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import binascii
 import hashlib
 
 from Crypto.Cipher import AES
 from Crypto import Random
+from Crypto.Util import Counter
+import six
 
 
 class AESCipher(object):
@@ -36,6 +39,8 @@ class AESCipher(object):
     def _get_pass_from_file(pass_file):
         with open(pass_file) as p_file:
             password = p_file.readline()
+        if isinstance(password, six.text_type):
+            password = password.encode('utf-8')
         return password
 
     @staticmethod
@@ -52,22 +57,44 @@ class AESEncrypt(AESCipher):
     """
     Encrypts chucks of data using AES-256 algorithm.
     OpenSSL compatible.
+
+    :param state: state of a previous cipher, see state(), to continue
+                  its stream
     """
 
-    def __init__(self, pass_file):
+    def __init__(self, pass_file, state=None):
         super(AESEncrypt, self).__init__(pass_file)
-        self._salt = Random.new().read(self.BS - len(self.SALT_HEADER))
+        if state:
+            self._salt = binascii.unhexlify(state['salt'])
+        else:
+            self._salt = Random.new().read(self.BS - len(self.SALT_HEADER))
         key, iv = self._derive_key_and_iv(self._password,
                                           self._salt,
                                           self.AES256_KEY_LENGTH,
                                           self.BS)
-        self.cipher = AES.new(key, AES.MODE_CFB, iv)
+        # In CFB mode the IV of the rest of a stream is the last block of
+        # IV and ciphertext
+        self._register = binascii.unhexlify(state['iv']) if state else iv
+        self.cipher = AES.new(key, AES.MODE_CFB, self._register)
 
     def generate_header(self):
         return self.SALT_HEADER + self._salt
 
     def encrypt(self, data):
-        return self.cipher.encrypt(data)
+        data = self.cipher.encrypt(data)
+        if len(data) >= self.BS:
+            self._register = data[-self.BS:]
+        else:
+            self._register = (self._register + data)[-self.BS:]
+        return data
+
+    def state(self):
+        """
+        Returns the salt and the IV from which a new cipher continues the
+        stream, as hexadecimal strings.
+        """
+        return {'salt': binascii.hexlify(self._salt).decode('ascii'),
+                'iv': binascii.hexlify(self._register).decode('ascii')}
 
 
 class AESDecrypt(AESCipher):
@@ -90,3 +117,39 @@ class AESDecrypt(AESCipher):
 
     def decrypt(self, data):
         return self.cipher.decrypt(data)
+
+
+class AESFrameCipher(AESCipher):
+    """
+    Encrypts and decrypts frames of data independently, each one from its
+    own IV, using AES-256 in CTR mode. The key is derived from the
+    password and the salt of the stream.
+
+    :param salt: salt of the stream, a new one if None
+    """
+
+    def __init__(self, pass_file, salt=None):
+        super(AESFrameCipher, self).__init__(pass_file)
+        self._salt = salt or Random.new().read(
+            self.BS - len(self.SALT_HEADER))
+        self._key, _ = self._derive_key_and_iv(self._password,
+                                               self._salt,
+                                               self.AES256_KEY_LENGTH,
+                                               self.BS)
+
+    @property
+    def salt(self):
+        return self._salt
+
+    def new_iv(self):
+        return Random.new().read(self.BS)
+
+    def _cipher(self, iv):
+        return AES.new(self._key, AES.MODE_CTR, counter=Counter.new(
+            self.BS * 8, initial_value=int(binascii.hexlify(iv), 16)))
+
+    def encrypt(self, iv, data):
+        return self._cipher(iv).encrypt(data)
+
+    def decrypt(self, iv, data):
+        return self._cipher(iv).decrypt(data)
@@ -0,0 +1,316 @@
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Framed backup streams.
+
+The data of a framed stream is cut in frames, each one compressed and
+encrypted independently, so that the frames are encoded and decoded on
+several cores and a reader can start at any frame. The layout of the
+stream is:
+
+    header | frames | index frame | footer
+
+- header: FRAME_MAGIC, format version and salt of the encryption key
+  (zeros if the stream is not encrypted)
+- frame: FRAME_FORMAT header (length of the payload, length of the data,
+  flags and IV) followed by the payload, the compressed data encrypted
+  with AES-256 in CTR mode from the IV of the frame. The payload of a
+  frame flagged FLAG_RAW holds the data itself, not compressed
+- index frame: a frame flagged FLAG_INDEX holding, for each frame, its
+  offset in the stream and the offset of its data (INDEX_FORMAT)
+- footer: offset of the index frame, number of frames and FRAME_MAGIC
+"""
+
+import base64
+import binascii
+import collections
+from multiprocessing import pool
+import os
+import struct
+
+from freezer.utils import compress
+from freezer.utils import crypt
+
+FRAME_MAGIC = b'FRZFRAME'
+FRAME_VERSION = 1
+HEADER_FORMAT = '<8sI8s'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+FRAME_FORMAT = '<IIB16s'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_FORMAT)
+INDEX_FORMAT = '<QQ'
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+FOOTER_FORMAT = '<QQ8s'
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+
+FLAG_INDEX = 1
+FLAG_RAW = 2
+
+# Estimated compression ratio above which an adaptive encoder stores a
+# frame raw, see compress.estimate_ratio
+RAW_RATIO = 0.95
+
+NO_SALT = b'\x00' * 8
+NO_IV = b'\x00' * 16
+
+
+class FrameEncoder(compress.ParallelCompressor):
+    """
+    Encodes a stream in frames of about frame_size bytes of data, on a
+    pool of threads. The frames are returned in order.
+
+    :param pool: multiprocessing.pool.ThreadPool encoding the frames
+    :param workers: number of threads of the pool
+    :param frame_size: size of the data of a frame
+    :param pass_file: key file encrypting the frames, None to not encrypt
+    :param state: state of an encoder, see state(), to continue its stream
+    :param level: compression level, None for the default level
+    :param min_level: see compress.ParallelCompressor
+    :param adaptive: whether to store raw the frames which do not
+                     compress, estimated from samples of their data or
+                     once compressed
+    :param dictionary: content of a zstd dictionary compressing each frame
+    """
+
+    def __init__(self, compression_algo, pool, workers, frame_size,
+                 pass_file=None, state=None, level=None, min_level=None,
+                 adaptive=False, dictionary=None):
+        super(FrameEncoder, self).__init__(compression_algo, pool, workers,
+                                           frame_size, level, min_level,
+                                           dictionary)
+        self.adaptive = adaptive
+        self.cipher = None
+        # Offsets of the next frame in the stream and of its data
+        self.offset = 0
+        self.data_offset = 0
+        self.index = []
+        # Size of the data stored raw and compressed, and of the
+        # compressed payloads
+        self.stats = {'raw_bytes': 0,
+                      'compressed_bytes': 0,
+                      'compressed_size': 0}
+        if state:
+            self.offset = state['offset']
+            self.data_offset = state['data_offset']
+            self.index = [base64.b64decode(state['index'])]
+            self.stats.update(state.get('stats', {}))
+        if pass_file:
+            self.cipher = crypt.AESFrameCipher(pass_file, binascii.unhexlify(
+                state['salt']) if state else None)
+
+    def header(self):
+        """
+        Returns the header of a new stream.
+        """
+        header = struct.pack(HEADER_FORMAT, FRAME_MAGIC, FRAME_VERSION,
+                             self.cipher.salt if self.cipher else NO_SALT)
+        self.offset += len(header)
+        return header
+
+    def compress_block(self, block):
+        flags = 0
+        if self.adaptive and compress.estimate_ratio(block) > RAW_RATIO:
+            flags = FLAG_RAW
+            payload = bytes(block)
+        else:
+            payload = super(FrameEncoder, self).compress_block(block)
+            if self.adaptive and len(payload) >= len(block):
+                flags = FLAG_RAW
+                payload = bytes(block)
+        iv = NO_IV
+        if self.cipher:
+            iv = self.cipher.new_iv()
+            payload = self.cipher.encrypt(iv, payload)
+        return len(block), flags, struct.pack(
+            FRAME_FORMAT, len(payload), len(block), flags, iv) + payload
+
+    def compressed(self, result):
+        data_len, flags, frame = result
+        self.index.append(struct.pack(INDEX_FORMAT, self.offset,
+                                      self.data_offset))
+        self.offset += len(frame)
+        self.data_offset += data_len
+        if flags & FLAG_RAW:
+            self.stats['raw_bytes'] += data_len
+        else:
+            self.stats['compressed_bytes'] += data_len
+            self.stats['compressed_size'] += len(frame) - FRAME_HEADER_SIZE
+        return frame
+
+    def end_frame(self):
+        """
+        Ends the current frame and returns the pending frames.
+        """
+        return super(FrameEncoder, self).flush()
+
+    def state(self):
+        """
+        Returns the JSON serializable state from which a new encoder
+        continues the stream, after end_frame.
+        """
+        return {'offset': self.offset,
+                'data_offset': self.data_offset,
+                'index': base64.b64encode(b''.join(self.index)).decode(
+                    'ascii'),
+                'salt': binascii.hexlify(self.cipher.salt).decode(
+                    'ascii') if self.cipher else None,
+                'stats': dict(self.stats)}
+
+    def flush(self):
+        """
+        Ends the stream, returning the pending frames, the index and the
+        footer.
+        """
+        frames = self.end_frame()
+        index = b''.join(self.index)
+        return b''.join([
+            frames,
+            struct.pack(FRAME_FORMAT, len(index), 0, FLAG_INDEX, NO_IV),
+            index,
+            struct.pack(FOOTER_FORMAT, self.offset,
+                        len(index) // INDEX_SIZE, FRAME_MAGIC)])
+
+
+def decode_frame(compression_algo, cipher, iv, payload, flags=0,
+                 dictionary=None):
+    if cipher:
+        payload = cipher.decrypt(iv, payload)
+    if flags & FLAG_RAW:
+        return payload
+    return compress.one_shot_decompress(compression_algo, payload,
+                                        dictionary)
+
+
+class FrameDecoder(object):
+    """
+    Decodes a framed stream on a pool of threads, with the interface of
+    compress.Decompressor. The data is returned in order.
+
+    :param workers: number of threads decoding the frames
+    :param pass_file: key file of an encrypted stream
+    :param dictionary: content of the zstd dictionary of the frames
+    """
+
+    def __init__(self, compression_algo, workers, pass_file=None,
+                 dictionary=None):
+        self.compression_algo = compression_algo
+        self.pass_file = pass_file
+        self.dictionary = dictionary
+        self.cipher = None
+        self.workers = max(1, workers)
+        self.pool = None
+        self.pending = collections.deque()
+        self.buffer = b''
+        self.started = False
+        self.ended = False
+
+    def _parse(self):
+        position = 0
+        if not self.started:
+            if len(self.buffer) < HEADER_SIZE:
+                return
+            magic, version, salt = struct.unpack(
+                HEADER_FORMAT, self.buffer[:HEADER_SIZE])
+            if magic != FRAME_MAGIC or version != FRAME_VERSION:
+                raise ValueError('Unsupported framed stream')
+            if salt != NO_SALT:
+                if not self.pass_file:
+                    raise ValueError('Encrypted stream without key')
+                self.cipher = crypt.AESFrameCipher(self.pass_file, salt)
+            self.pool = pool.ThreadPool(self.workers)
+            self.started = True
+            position = HEADER_SIZE
+        while (not self.ended and
+               len(self.buffer) - position >= FRAME_HEADER_SIZE):
+            payload_len, _, flags, iv = struct.unpack(
+                FRAME_FORMAT,
+                self.buffer[position:position + FRAME_HEADER_SIZE])
+            end = position + FRAME_HEADER_SIZE + payload_len
+            if end > len(self.buffer):
+                break
+            if flags & FLAG_INDEX:
+                self.ended = True
+            else:
+                self.pending.append(self.pool.apply_async(decode_frame, (
+                    self.compression_algo, self.cipher, iv,
+                    self.buffer[position + FRAME_HEADER_SIZE:end], flags,
+                    self.dictionary)))
+            position = end
+        self.buffer = self.buffer[position:]
+
+    def decompress(self, data):
+        self.buffer += data
+        if not self.ended:
+            self._parse()
+        decoded = []
+        while self.pending and (len(self.pending) > 2 * self.workers or
+                                self.pending[0].ready()):
+            decoded.append(self.pending.popleft().get())
+        return b''.join(decoded)
+
+    def flush(self):
+        """
+        Returns the rest of the data, at the end of the stream.
+
+        :raises ValueError: if the stream is truncated
+        """
+        decoded = [result.get() for result in self.pending]
+        self.pending.clear()
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+        if not self.ended or len(self.buffer) != FOOTER_SIZE:
+            raise ValueError('Truncated framed stream')
+        return b''.join(decoded)
+
+
+def read_index(fd):
+    """
+    Reads the index of a framed stream.
+
+    :param fd: file object of the stream, opened in binary mode
+    :return: list of (offset of the frame, offset of its data)
+    """
+    fd.seek(-FOOTER_SIZE, os.SEEK_END)
+    index_offset, count, magic = struct.unpack(FOOTER_FORMAT,
+                                               fd.read(FOOTER_SIZE))
+    if magic != FRAME_MAGIC:
+        raise ValueError('Truncated framed stream')
+    fd.seek(index_offset + FRAME_HEADER_SIZE)
+    index = fd.read(count * INDEX_SIZE)
+    return [struct.unpack(INDEX_FORMAT,
+                          index[position:position + INDEX_SIZE])
+            for position in range(0, len(index), INDEX_SIZE)]
+
+
+def read_frames(fd, compression_algo, pass_file=None, first=0,
+                dictionary=None):
+    """
+    Reads the frames of a framed stream from the frame first.
+
+    :param fd: file object of the stream, opened in binary mode
+    :param dictionary: content of the zstd dictionary of the frames
+    :return: generator of (offset of the data, data) for each frame
+    """
+    index = read_index(fd)
+    fd.seek(0)
+    _, _, salt = struct.unpack(HEADER_FORMAT, fd.read(HEADER_SIZE))
+    cipher = None
+    if salt != NO_SALT:
+        cipher = crypt.AESFrameCipher(pass_file, salt)
+    for offset, data_offset in index[first:]:
+        fd.seek(offset)
+        payload_len, _, flags, iv = struct.unpack(
+            FRAME_FORMAT, fd.read(FRAME_HEADER_SIZE))
+        yield data_offset, decode_frame(compression_algo, cipher, iv,
+                                        fd.read(payload_len), flags,
+                                        dictionary)
@@ -0,0 +1,201 @@
+"""
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Ring buffer in shared memory carrying streams from a producer process to
+a consumer process.
+
+The buffer is an anonymous memory map divided in slots, created before
+the processes are started. Each slot holds a header (kind of message and
+length) and the message data. A semaphore counts the free slots and
+another the used ones, so that each side waits for the other without
+polling. The producer and the consumer keep their own position in the
+ring.
+
+The consumer can read a slot in place with recv_view: the slot is lent
+until the next message is received, instead of being copied out of the
+ring.
+"""
+
+import mmap
+import multiprocessing
+import struct
+import uuid
+
+import six
+
+from freezer.utils import winutils
+
+# Kind of message and data length
+SLOT_HEADER_FORMAT = '<BQ'
+SLOT_HEADER_SIZE = struct.calcsize(SLOT_HEADER_FORMAT)
+DATA = 0
+END = 1
+# Seconds between two checks of the abort event by a waiting process
+ABORT_CHECK_INTERVAL = 1
+
+
+class RingAborted(IOError):
+    pass
+
+
+class RingBuffer(object):
+    """
+    Shared memory channel between a producer and a consumer process, with
+    the send_bytes and recv_bytes methods of a multiprocessing Connection.
+
+    A producer can send several streams one after the other, each one
+    ended by send_end: recv_bytes raises EOFError at the end of a stream
+    and returns the data of the following one on the next call.
+
+    :param size: number of bytes of data the ring holds
+    :param slot_size: size of a slot, larger messages are sent in
+                      several slots and received in several parts
+    :param aborted: multiprocessing.Event stopping the processes waiting
+                    on the ring, shared with the other rings of a restore
+    """
+
+    def __init__(self, size, slot_size, aborted=None):
+        self.slot_size = slot_size
+        self.slots = max(2, size // slot_size)
+        self.aborted = aborted or multiprocessing.Event()
+        self.free = multiprocessing.Semaphore(self.slots)
+        self.used = multiprocessing.Semaphore(0)
+        self.tagname = None
+        if winutils.is_windows():
+            # The map is shared by name with the spawned processes
+            self.tagname = 'freezer-{0}'.format(uuid.uuid4().hex)
+        self._open()
+        # Next slot of this side of the ring
+        self.position = 0
+        # View on the slot lent by recv_view
+        self.lent = None
+
+    def _open(self):
+        length = self.slots * (SLOT_HEADER_SIZE + self.slot_size)
+        if self.tagname:
+            self.map = mmap.mmap(-1, length, tagname=self.tagname)
+        else:
+            self.map = mmap.mmap(-1, length)
+
+    def __getstate__(self):
+        if not self.tagname:
+            raise TypeError('The ring buffer is shared by forking only')
+        state = self.__dict__.copy()
+        del state['map']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def _acquire(self, semaphore):
+        while not semaphore.acquire(True, ABORT_CHECK_INTERVAL):
+            if self.aborted.is_set():
+                raise RingAborted('Stream aborted')
+
+    def _put(self, kind, data):
+        self._acquire(self.free)
+        offset = self.position * (SLOT_HEADER_SIZE + self.slot_size)
+        struct.pack_into(SLOT_HEADER_FORMAT, self.map, offset, kind,
+                         len(data))
+        offset += SLOT_HEADER_SIZE
+        self.map[offset:offset + len(data)] = data
+        self.position = (self.position + 1) % self.slots
+        self.used.release()
+
+    def send_bytes(self, data):
+        """
+        Copies data in the ring, waiting for free slots.
+        """
+        if len(data) <= self.slot_size:
+            self._put(DATA, data)
+            return
+        for start in range(0, len(data), self.slot_size):
+            self._put(DATA, data[start:start + self.slot_size])
+
+    def send_end(self):
+        """
+        Ends the stream sent.
+        """
+        self._put(END, b'')
+
+    def _give_back(self):
+        """
+        Gives the slot lent by recv_view back to the producer.
+        """
+        if self.lent is None:
+            return
+        if not six.PY2:
+            self.lent.release()
+        self.lent = None
+        self.free.release()
+
+    def _get(self):
+        """
+        Waits for the next slot.
+
+        :return: kind of message, offset and length of the data
+        """
+        self._give_back()
+        self._acquire(self.used)
+        offset = self.position * (SLOT_HEADER_SIZE + self.slot_size)
+        kind, length = struct.unpack_from(SLOT_HEADER_FORMAT, self.map,
+                                          offset)
+        self.position = (self.position + 1) % self.slots
+        return kind, offset + SLOT_HEADER_SIZE, length
+
+    def recv_bytes(self):
+        """
+        Returns a copy of the data of the next slot, waiting for the
+        producer.
+
+        :raises EOFError: at the end of a stream
+        """
+        kind, offset, length = self._get()
+        data = self.map[offset:offset + length]
+        self.free.release()
+        if kind == END:
+            raise EOFError()
+        return data
+
+    def recv_view(self):
+        """
+        Returns the data of the next slot without copying it, waiting for
+        the producer. The view is valid until the next message is
+        received, when the slot is given back to the producer: the data
+        must be consumed or copied before.
+
+        :raises EOFError: at the end of a stream
+        """
+        kind, offset, length = self._get()
+        if kind == END:
+            self.free.release()
+            raise EOFError()
+        if six.PY2:
+            # mmap only has the old buffer interface on Python 2
+            self.lent = buffer(self.map, offset, length)  # noqa
+        else:
+            self.lent = memoryview(self.map)[offset:offset + length]
+        return self.lent
+
+    def abort(self):
+        """
+        Stops the processes waiting on the rings sharing the abort event.
+        """
+        self.aborted.set()
+
+    def close(self):
+        if self.lent is not None and not six.PY2:
+            self.lent.release()
+        self.lent = None
+        self.map.close()